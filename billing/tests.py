@@ -5,7 +5,16 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
+import csv
+import json
+from datetime import datetime
+
 from django.test import TestCase
+from django.contrib.auth.models import User
+
+from netstat.models import Session, Record, UsageRollup, HOUR, DAY, MONTH
+from policy.models import Departament, UserDepartament
+from billing import views
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -21,3 +30,108 @@ Another way to test that 1 + 1 is equal to 2.
 True
 """}
 
+
+
+class ExportTest(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', '', 'secret')
+        self.bob = User.objects.create_user('bob', '', 'secret')
+        self.sessions = []
+        for user, dt in ((self.alice, datetime(2011, 3, 10)),
+                (self.bob, datetime(2011, 3, 31, 23)),
+                (self.alice, datetime(2011, 4, 1))):
+            session = Session.objects.create(user=user, src='10.0.0.1',
+                    dt_finish=dt)
+            Session.objects.filter(id=session.id).update(dt_start=dt)
+            for dst in ('1.1.1.1', '2.2.2.2', '3.3.3.3'):
+                Record.objects.create(session=session, dst=dst, traf_in=10,
+                        traf_out=1)
+
+    def export(self, **params):
+        self.old_chunk = views.EXPORT_CHUNK
+        views.EXPORT_CHUNK = 2
+        try:
+            response = self.client.get('/export/', params)
+            return response, ''.join(response)
+        finally:
+            views.EXPORT_CHUNK = self.old_chunk
+
+    def test_csv(self):
+        self.client.login(username='alice', password='secret')
+        response, data = self.export(month='2011-03')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.reader(data.splitlines()))
+        self.assertEqual(rows[0], list(views.EXPORT_FIELDS))
+        self.assertEqual(rows[1:], [
+            ['alice', '10.0.0.1', '2011-03-10 00:00:00', '2011-03-10 00:00:00',
+                dst, '10', '1'] for dst in ('1.1.1.1', '2.2.2.2', '3.3.3.3')])
+
+    def test_json(self):
+        User.objects.filter(username='alice').update(is_staff=True)
+        self.client.login(username='alice', password='secret')
+        response, data = self.export(month='2011-03', format='json')
+        rows = json.loads(data)
+        self.assertEqual([(i['user'], i['dst']) for i in rows],
+                [('alice', '1.1.1.1'), ('alice', '2.2.2.2'),
+                    ('alice', '3.3.3.3'), ('bob', '1.1.1.1'),
+                    ('bob', '2.2.2.2'), ('bob', '3.3.3.3')])
+
+    def test_bad_request(self):
+        self.client.login(username='alice', password='secret')
+        self.assertEqual(self.client.get('/export/',
+            {'month': '2011'}).status_code, 400)
+        self.assertEqual(self.client.get('/export/',
+            {'format': 'xls'}).status_code, 400)
+
+
+class UsageSeriesTest(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', '', 'secret')
+        self.bob = User.objects.create_user('bob', '', 'secret')
+        self.dep = Departament.objects.create(name='dep', admin=self.alice)
+        UserDepartament.objects.create(user=self.alice, departament=self.dep)
+        UserDepartament.objects.create(user=self.bob, departament=self.dep)
+        for user in (self.alice, self.bob):
+            UsageRollup.objects.add_session_traffic({(1, '1.1.1.1'): [10, 1]},
+                    {1: user.id}, datetime(2011, 3, 10, 12, 30))
+        self.client.login(username='alice', password='secret')
+
+    def get(self, **params):
+        response = self.client.get('/usage/series/', params)
+        if response.status_code != 200:
+            return response.status_code
+        return json.loads(response.content)
+
+    def test_periods(self):
+        data = self.get(**{'from': '2011-03-10 11:00', 'to': '2011-03-10 14:00'})
+        self.assertEqual(data, {'period': HOUR, 'series': [
+            ['2011-03-10 11:00:00', 0, 0],
+            ['2011-03-10 12:00:00', 10, 1],
+            ['2011-03-10 13:00:00', 0, 0],
+        ]})
+
+        data = self.get(**{'from': '2011-01-01', 'to': '2011-12-31'})
+        self.assertEqual(data['period'], DAY)
+        self.assertEqual(len(data['series']), 364)
+        self.assertEqual(data['series'][68], ['2011-03-10 00:00:00', 10, 1])
+
+        data = self.get(**{'from': '2010-01-01', 'to': '2012-01-01'})
+        self.assertEqual(data['period'], MONTH)
+        self.assertEqual(len(data['series']), 24)
+        self.assertEqual(data['series'][14], ['2011-03-01 00:00:00', 10, 1])
+
+        self.assertEqual(self.get(**{'from': '1970-01-01', 'to': '2011-12-31'}),
+                400)
+
+    def test_departament(self):
+        data = self.get(departament=self.dep.id,
+                **{'from': '2011-03-10', 'to': '2011-03-11'})
+        self.assertEqual(data['series'][12], ['2011-03-10 12:00:00', 20, 2])
+
+    def test_permissions(self):
+        self.assertEqual(self.get(user=self.bob.id), 403)
+        self.client.login(username='bob', password='secret')
+        self.assertEqual(self.get(departament=self.dep.id), 403)
+        self.assertEqual(self.get(**{'from': 'yesterday'}), 400)
@@ -1,20 +1,27 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import csv
+import json
 import logging
-from datetime import datetime
+from datetime import datetime, time, timedelta
 
-from django.http import HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, \
+        HttpResponseBadRequest, HttpResponseForbidden
+from django.db.models import Sum
 from django.views.generic import TemplateView
-from django.db.models import Q, Sum
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.utils.decorators import method_decorator
-from netstat.models import Session, Record
+from netstat.models import Session, Record, UsageRollup, HOUR, DAY, MONTH, \
+        period_start, next_period_start
+from policy.models import Departament, UserDepartament
+from netstat import usage_cache
+from session_control import start_session, finish_user_session, \
+        ALREADY_STARTED, TAKEN
+from utils import get_next_month
 #from policy.models import Policy
 
-from tas.utils import get_first_day
-
 
 class IndexView(TemplateView):
 
@@ -29,19 +36,25 @@ class IndexView(TemplateView):
         # Call the base implementation first to get a context
         context = super(IndexView, self).get_context_data(**kwargs)
 
-        context['top10_session'] = Record.objects.filter(
-                session__in=Session.objects.filter(user=self.request.user,
-                    dt_finish=None)
-                ).order_by('-traf_in')[:10]
-
-        context['top10_month'] = Record.objects.filter(
-                session__in=Session.objects.filter(Q(user=self.request.user),
-                    Q(dt_finish__gte=get_first_day()) | Q(dt_finish=None))
-                ).values('dst').annotate(traf_in=Sum('traf_in')
-                        ).order_by('-traf_in')[:10]
+        context.update(usage_cache.get_or_set('index', self.request.user.id,
+            self.get_usage))
 
         return context
 
+    def get_usage(self):
+
+        user = self.request.user
+
+        return {
+            'top10_session': list(Record.objects.filter(
+                session__in=Session.objects.filter(user=user, dt_finish=None)
+                ).order_by('-traf_in')[:10]),
+            'top10_month': list(UsageRollup.objects.filter(
+                user=user, period=MONTH,
+                start=period_start(MONTH, datetime.now())
+                ).exclude(dst='').order_by('-traf_in')[:10]),
+        }
+
 def login(request, *args, **kwargs):
 
     from django.contrib.auth.views import login as auth_login_view
@@ -51,16 +64,13 @@ def login(request, *args, **kwargs):
 
         ip = request.META['REMOTE_ADDR']
 
-        if Session.objects.filter(src=ip, dt_finish=None).count():
-            if Session.objects.filter(user=request.user, src=ip, dt_finish=None).count():
-                messages.success(request, 'Интернет уже включен для %s.' % ip)
-            else:
-                messages.warning(request, 'Интернет для адреса %s был включен другим пользователем, отключаем его.' % ip)
-                session = Session.objects.get(src=ip, dt_finish=None)
-                session.dt_finish = datetime.now()
-                session.save()
+        result, session = start_session(request.user, ip)
+
+        if result == ALREADY_STARTED:
+            messages.success(request, 'Интернет уже включен для %s.' % ip)
+        elif result == TAKEN:
+            messages.warning(request, 'Интернет для адреса %s был включен другим пользователем, отключаем его.' % ip)
         else:
-            Session(user=request.user, src=ip).save()
             messages.success(request, 'Интернет включен для адреса %s.' % ip)
 
     return ret
@@ -70,10 +80,7 @@ def logout(request, *args, **kwargs):
 
     ip = request.META['REMOTE_ADDR']
 
-    if Session.objects.filter(src=ip, dt_finish=None).count():
-        session = Session.objects.get(user=request.user, src=ip, dt_finish=None)
-        session.dt_finish = datetime.now()
-        session.save()
+    if finish_user_session(request.user, ip) is not None:
         messages.success(request, 'Интернет отключен для адреса %s.' % ip)
     else:
         messages.warning(request, 'Для вашего адреса не включен Интернет!')
@@ -81,3 +88,217 @@ def logout(request, *args, **kwargs):
     from django.contrib.auth.views import logout_then_login
     return logout_then_login(request, *args, **kwargs)
 
+
+EXPORT_FIELDS = ('user', 'src', 'dt_start', 'dt_finish', 'dst', 'traf_in',
+        'traf_out')
+
+# records per query of export
+EXPORT_CHUNK = 5000
+
+
+def iter_records(records, chunk=EXPORT_CHUNK):
+    """
+    Iterate over records in chunks with keyset pagination by id, so
+    memory usage doesn't depend on the number of records and every query
+    is an index range scan.
+
+    Yields tuples of values of EXPORT_FIELDS.
+    """
+
+    records = records.order_by('id').values_list('id',
+            'session__user__username', 'session__src', 'session__dt_start',
+            'session__dt_finish', 'dst', 'traf_in', 'traf_out')
+    last = 0
+    while True:
+        rows = list(records.filter(id__gt=last)[:chunk])
+        for row in rows:
+            yield row[1:]
+        if len(rows) < chunk:
+            return
+        last = rows[-1][0]
+
+
+class Line(object):
+    """
+    File-like object returning written data, for csv.writer.
+    """
+
+    def write(self, data):
+        return data
+
+
+def format_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat(' ')
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def iter_csv(rows):
+    writer = csv.writer(Line())
+    yield writer.writerow(EXPORT_FIELDS)
+    for row in rows:
+        yield writer.writerow([format_value(i) for i in row])
+
+
+def iter_json(rows):
+    yield '['
+    sep = '\n'
+    for row in rows:
+        yield sep + json.dumps(dict(zip(EXPORT_FIELDS,
+            [format_value(i) for i in row])))
+        sep = ',\n'
+    yield '\n]\n'
+
+
+EXPORT_FORMATS = {
+    'csv': (iter_csv, 'text/csv'),
+    'json': (iter_json, 'application/json'),
+}
+
+
+@login_required
+def export(request):
+    """
+    Export traffic of sessions started in a month per destination.
+
+    Staff gets records of all users, other users only their own.
+    Response is generated while it is sent.
+
+    GET parameters:
+
+        month - YYYY-MM, current month by default
+        format - csv or json, csv by default
+    """
+
+    try:
+        month = request.GET.get('month')
+        if month:
+            start = datetime.strptime(month, '%Y-%m')
+        else:
+            start = datetime.now().replace(day=1)
+        generate, mimetype = EXPORT_FORMATS[request.GET.get('format', 'csv')]
+    except (ValueError, KeyError):
+        return HttpResponseBadRequest('Bad month or format.')
+    start = datetime.combine(start.date(), time())
+    finish = datetime.combine(get_next_month(start), time())
+
+    records = Record.objects.filter(session__dt_start__gte=start,
+            session__dt_start__lt=finish)
+    if not request.user.is_staff:
+        records = records.filter(session__user=request.user)
+
+    response = HttpResponse(generate(iter_records(records)), mimetype=mimetype)
+    response['Content-Disposition'] = 'attachment; filename=traffic-%s.%s' % (
+            start.strftime('%Y-%m'), request.GET.get('format', 'csv'))
+    return response
+
+
+# maximum number of points of usage series
+SERIES_POINTS = 500
+
+SERIES_FORMATS = ('%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+
+def parse_datetime(value):
+    for format in SERIES_FORMATS:
+        try:
+            return datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise ValueError('bad datetime: %r' % value)
+
+
+def series_period(start, finish, points=SERIES_POINTS):
+    """
+    Get the finest rollup period giving at most points points between
+    start and finish.
+
+    Returns None if even months give more points.
+    """
+
+    seconds = (finish - start).days * 86400 + (finish - start).seconds
+    if seconds <= points * 3600:
+        return HOUR
+    if seconds <= points * 86400:
+        return DAY
+    if (finish.year - start.year) * 12 + finish.month - start.month < points:
+        return MONTH
+    return None
+
+
+def get_series(users, start, finish, period):
+    """
+    Get traffic of users between start and finish from rollups of period.
+
+    Returns list of [start of period, traf_in, traf_out], periods without
+    traffic are included with zeros.
+    """
+
+    start = period_start(period, start)
+    totals = dict((i['start'], (i['traf_in'], i['traf_out']))
+            for i in UsageRollup.objects.filter(user__in=users, period=period,
+                dst='', start__gte=start, start__lt=finish
+                ).values('start').annotate(traf_in=Sum('traf_in'),
+                    traf_out=Sum('traf_out')).order_by())
+
+    series = []
+    while start < finish:
+        traf_in, traf_out = totals.get(start, (0, 0))
+        series.append([start.isoformat(' '), traf_in, traf_out])
+        start = next_period_start(period, start)
+    return series
+
+
+@login_required
+def usage_series(request):
+    """
+    Traffic of user or departament over time as JSON.
+
+    Rollup period is chosen so there are at most SERIES_POINTS points,
+    the cost doesn't depend on the length of the window. Wider windows
+    are rejected.
+
+    GET parameters:
+
+        from, to - 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM', the last day by
+            default
+        user - id of user, the current user by default, staff only
+        departament - id of departament, staff and admin of the
+            departament only
+    """
+
+    try:
+        finish = parse_datetime(request.GET['to']) if 'to' in request.GET \
+                else datetime.now()
+        start = parse_datetime(request.GET['from']) if 'from' in request.GET \
+                else finish - timedelta(days=1)
+        user = int(request.GET.get('user', request.user.id))
+        departament = request.GET.get('departament')
+        if departament is not None:
+            departament = Departament.objects.get(id=int(departament))
+    except (ValueError, Departament.DoesNotExist):
+        return HttpResponseBadRequest('Bad parameters.')
+    if start >= finish:
+        return HttpResponseBadRequest('Empty window.')
+
+    if departament is not None:
+        if not request.user.is_staff and departament.admin_id != request.user.id:
+            return HttpResponseForbidden()
+        users = list(UserDepartament.objects.filter(departament=departament
+            ).values_list('user', flat=True))
+    else:
+        if not request.user.is_staff and user != request.user.id:
+            return HttpResponseForbidden()
+        users = [user]
+
+    period = series_period(start, finish)
+    if period is None:
+        return HttpResponseBadRequest('Too wide window.')
+    data = {
+        'period': period,
+        'series': get_series(users, start, finish, period),
+    }
+    return HttpResponse(json.dumps(data), mimetype='application/json')
+
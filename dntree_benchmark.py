@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010-2011 Andrew Grigorev <andrew@ei-grad.ru>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+DnTree microbenchmark.
+
+Builds synthetic organization trees of the given sizes and reports time
+of bulk loading, adding nodes one by one in random order, rendering,
+traversal and removing nodes.
+"""
+
+import sys
+import random
+import logging
+
+from time import time
+
+from utils import DnTree
+
+
+REPORT = """\
+nodes:             %(nodes)d
+from_iterable:     %(from_iterable).3f s
+add:               %(add).3f s
+render:            %(render).3f s
+iter_subtree:      %(iter_subtree).3f s
+remove:            %(remove).3f s
+"""
+
+
+def generate_names(nodes, fanout):
+    """
+    Get distinguished names of a tree of nodes, every node has fanout
+    childs.
+    """
+
+    names = ['org']
+    i = 0
+    while len(names) < nodes:
+        names.append('n%d.%s' % (len(names), names[i // fanout]))
+        i += 1
+    return names
+
+
+def benchmark(nodes, fanout):
+
+    names = generate_names(nodes, fanout)
+    result = {'nodes': len(names)}
+
+    t = time()
+    tree = DnTree.from_iterable(names)
+    result['from_iterable'] = time() - t
+
+    shuffled = list(names)
+    random.shuffle(shuffled)
+    t = time()
+    other = DnTree()
+    for dn in shuffled:
+        other.add(dn)
+    result['add'] = time() - t
+
+    t = time()
+    str(tree)
+    result['render'] = time() - t
+
+    t = time()
+    for dn in tree.iter_subtree('org'):
+        pass
+    result['iter_subtree'] = time() - t
+
+    # leaves first, so every remove is of a single node
+    t = time()
+    for dn in reversed(names):
+        tree.remove(dn)
+    result['remove'] = time() - t
+
+    return result
+
+
+if __name__ == "__main__":
+
+    from optparse import OptionParser
+
+    usage = 'Usage: %prog [options]'
+
+    parser = OptionParser(usage=usage, version='0.1.1')
+
+    parser.add_option('-d', '--debug', action='store_true', dest='debug',
+            help='print debug messages',
+            default=False)
+    parser.add_option('-n', '--nodes', dest='nodes', metavar='N[,N...]',
+            help='comma-separated sizes of trees',
+            default='10000,50000,100000')
+    parser.add_option('-f', '--fanout', dest='fanout', metavar='N',
+            help='number of childs per node',
+            default=10)
+
+    opt, args = parser.parse_args()
+
+    if opt.debug:
+        logging.basicConfig(level=logging.DEBUG, format="%(message)s")
+    else:
+        logging.basicConfig(level=logging.WARNING, format="%(message)s")
+
+    for nodes in opt.nodes.split(','):
+        sys.stdout.write(REPORT % benchmark(int(nodes), int(opt.fanout)))
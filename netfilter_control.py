@@ -20,117 +20,611 @@
 """
 Firewall of Traffic Accounting System
 
+Complete ruleset is generated in memory and loaded with a single
+iptables-restore call, so it is applied atomically and takes one process
+whatever the number of users is. Rules are kept in tas-* chains jumped
+to from the builtin FORWARD and PREROUTING chains and loaded with
+--noflush, other rules of the gateway (e.g. MASQUERADE or INPUT ones)
+are left intact.
+
+Addresses of open sessions are members of ipsets matched by a fixed set
+of rules, so starting and finishing a session is a single ipset add or
+del, and the per-packet cost doesn't grow with the number of sessions.
+
+Commands:
+
+    load - load ruleset
+    dump - print ruleset
+    sync - sync used quotas from the firewall
 
 """
 
-from threading import Thread
-from time import sleep
+import os
+os.environ['DJANGO_SETTINGS_MODULE'] = 'tas.settings'
+
+import re
+import sys
+import logging
 import traceback
 
-from netfilter.rule import Rule, Match
-from netfilter.table import Table
+from threading import Thread, Event
+from time import sleep
+from subprocess import Popen, PIPE, STDOUT
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connection, transaction, reset_queries
+from netstat.models import Session
+from policy.models import UserDepartament, UserQuotaPolicy, \
+        DepartamentQuotaPolicy, quota_crossed
 
 
-class Firewall(object):
+class FirewallError(Exception):
+    pass
+
+
+def run(cmd, data=None):
+    """
+    Run command, feeding data to its stdin.
+
+    Raises FirewallError if it fails.
+    """
+
+    try:
+        proc = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=STDOUT)
+    except OSError, e:
+        raise FirewallError('%s: %s' % (cmd[0], e))
+    output = proc.communicate(data)[0]
+    if proc.returncode != 0:
+        raise FirewallError('%s failed with code %d: %s' % (
+            ' '.join(cmd), proc.returncode, output.strip()))
+    return output
+
+
+FORWARD_CHAIN = 'tas-forward'
+PREROUTING_CHAIN = 'tas-prerouting'
+
+CHAIN_PREFIX = 'tas-'
+
+
+def parse_save(data):
+    """
+    Get chains and rules of tables from iptables-save output.
+
+    Returns dict {table: (set of chains, set of rules)}.
+    """
+
+    tables = {}
+    chains, rules = None, None
+    for line in data.splitlines():
+        if line.startswith('*'):
+            chains, rules = tables.setdefault(line[1:], (set(), set()))
+        elif chains is None:
+            continue
+        elif line.startswith(':'):
+            chains.add(line[1:].split()[0])
+        elif line.startswith('-A ') or line.startswith('['):
+            # strip counters of iptables-save -c
+            if line.startswith('['):
+                line = line.split(' ', 1)[1]
+            rules.add(line)
+    return tables
+
+
+class Ruleset(object):
+    """
+    Contents of tas-* chains in iptables-restore --noflush format and of
+    ipsets in ipset restore format.
+    """
+
+    # builtin chain -> chain jumped to from it
+    HOOKS = {
+        'filter': (('FORWARD', FORWARD_CHAIN),),
+        'nat': (('PREROUTING', PREROUTING_CHAIN),),
+    }
 
     def __init__(self):
+        self.tables = OrderedDict() # table -> (chains, rules)
+        self.sets = OrderedDict() # set -> (type, members)
+
+    def table(self, table):
+        if table not in self.tables:
+            chains = OrderedDict((chain, '-')
+                    for builtin, chain in self.HOOKS[table])
+            self.tables[table] = (chains, [])
+        return self.tables[table]
+
+    def chain(self, table, chain):
+        """
+        Create user-defined chain.
+        """
+
+        self.table(table)[0][chain] = '-'
+
+    def append(self, table, chain, rule):
+        """
+        Append rule to chain.
+
+        @param rule:
+            rule specification as iptables arguments, e.g. '-s 10.0.0.1 -j ACCEPT'
+        """
+
+        self.table(table)[1].append('-A %s %s' % (chain, rule))
+
+    def ipset(self, name, type='hash:ip'):
+        """
+        Create ipset.
+        """
+
+        if name not in self.sets:
+            self.sets[name] = (type, [])
+        return self.sets[name][1]
+
+    def render(self, current=''):
+        """
+        Render tables for iptables-restore --noflush.
+
+        Declared chains are flushed on load, jumps to them from the
+        builtin chains are inserted if they are missing, and tas-* chains
+        which are not in the ruleset anymore are deleted.
+
+        @param current:
+            current rules in iptables-save format
+        """
+
+        current = parse_save(current)
+        lines = []
+        for table, (chains, rules) in self.tables.items():
+            existing, existing_rules = current.get(table, (set(), set()))
+            lines.append('*%s' % table)
+            for chain, policy in chains.items():
+                lines.append(':%s %s [0:0]' % (chain, policy))
+            stale = sorted(i for i in existing
+                    if i.startswith(CHAIN_PREFIX) and i not in chains)
+            # flush first, stale chains may jump to each other
+            lines.extend('-F %s' % i for i in stale)
+            lines.extend('-X %s' % i for i in stale)
+            for builtin, chain in self.HOOKS[table]:
+                if '-A %s -j %s' % (builtin, chain) not in existing_rules:
+                    lines.append('-I %s 1 -j %s' % (builtin, chain))
+            lines.extend(rules)
+            lines.append('COMMIT')
+        return '\n'.join(lines) + '\n'
+
+    def render_sets(self):
+        """
+        Sets are filled under temporary names and swapped with the
+        current ones, so each of them is replaced atomically.
+        """
+
+        lines = []
+        for name, (type, members) in self.sets.items():
+            new = name + '-new'
+            lines.append('create %s %s -exist' % (name, type))
+            lines.append('create %s %s -exist' % (new, type))
+            lines.append('flush %s' % new)
+            for member in members:
+                lines.append('add %s %s' % (new, member))
+            lines.append('swap %s %s' % (new, name))
+            lines.append('destroy %s' % new)
+        return '\n'.join(lines) + '\n'
+
+
+def user_quota_chain(user_id):
+    return 'tas-u%d-quota' % user_id
+
+def departament_quota_chain(departament_id):
+    return 'tas-d%d-quota' % departament_id
+
+# addresses of sessions are kept in ipsets, one per policy class: users
+# with their own quota, users of a departament with quota, and users
+# without quota
+def user_set(user_id):
+    return 'tas-u%d' % user_id
+
+def departament_set(departament_id):
+    return 'tas-d%d' % departament_id
+
+FREE_SET = 'tas-free'
+
+# list of all the sets above
+ONLINE_SET = 'tas-online'
+
+
+class Firewall(object):
+
+    def __init__(self, in_interface=None, redirector=None, restore=None,
+            ipset=None, save=None):
+        """
+        Create new Firewall object, settings are used by default.
+
+        @param in_interface:
+            interface of the local network
+        @param redirector:
+            (ip, port) to redirect HTTP requests of unauthorized clients to
+        @param restore:
+            iptables-restore command
+        @param ipset:
+            ipset command
+        @param save:
+            iptables-save command
+        """
+
+        if in_interface is None:
+            in_interface = getattr(settings, 'FIREWALL_IN_INTERFACE', None)
+        if redirector is None:
+            redirector = getattr(settings, 'FIREWALL_REDIRECTOR', None)
+        if restore is None:
+            restore = getattr(settings, 'IPTABLES_RESTORE', 'iptables-restore')
+        if ipset is None:
+            ipset = getattr(settings, 'IPSET', 'ipset')
+        if save is None:
+            save = getattr(settings, 'IPTABLES_SAVE', 'iptables-save')
+
+        self.in_interface = in_interface
+        self.redirector = redirector
+        self.restore = restore
+        self.ipset = ipset
+        self.save = save
+
+    def build(self):
+        """
+        Generate ruleset from the database.
+
+        The number of rules depends on the number of quota policies only,
+        sessions are members of ipsets.
+        """
+
+        ruleset = Ruleset()
+        ruleset.table('filter')
+        ruleset.table('nat')
+
+        # traffic of user goes to the quota chain of user, then to the
+        # quota chain of his departament, and is accepted if there is
+        # quota left in both
+        targets = {}
+        for policy in DepartamentQuotaPolicy.objects.all():
+            chain = departament_quota_chain(policy.departament_id)
+            self.create_quota_chain(ruleset, chain,
+                    policy.full - policy.used, 'ACCEPT')
+            targets[policy.departament_id] = chain
+            self.create_session_set(ruleset,
+                    departament_set(policy.departament_id), chain)
+
+        departaments = dict(UserDepartament.objects.filter(
+            departament__in=targets.keys()).values_list('user', 'departament'))
+
+        users = set()
+        for policy in UserQuotaPolicy.objects.all():
+            chain = user_quota_chain(policy.user_id)
+            self.create_quota_chain(ruleset, chain, policy.full - policy.used,
+                    targets.get(departaments.get(policy.user_id), 'ACCEPT'))
+            users.add(policy.user_id)
+            self.create_session_set(ruleset, user_set(policy.user_id), chain)
+
+        self.create_session_set(ruleset, FREE_SET, 'ACCEPT')
+
+        for user, src in Session.objects.filter(dt_finish=None
+                ).values_list('user', 'src').order_by('src'):
+            ruleset.ipset(self.get_set(user, users, departaments)).append(src)
+
+        ruleset.ipset(ONLINE_SET, 'list:set').extend(
+                i for i in ruleset.sets if i != ONLINE_SET)
+        ruleset.append('nat', PREROUTING_CHAIN,
+                '-m set --match-set %s src -j ACCEPT' % ONLINE_SET)
+
+        self.create_redirect_rules(ruleset)
+
+        return ruleset
+
+    def get_set(self, user_id, users, departaments):
+        """
+        Get name of ipset for sessions of user.
+
+        @param users:
+            ids of users with quota policy
+        @param departaments:
+            dict {user_id: departament_id} of users of departaments with
+            quota policy
+        """
+
+        if user_id in users:
+            return user_set(user_id)
+        if user_id in departaments:
+            return departament_set(departaments[user_id])
+        return FREE_SET
+
+    def create_session_set(self, ruleset, name, target):
+        ruleset.ipset(name)
+        ruleset.append('filter', FORWARD_CHAIN,
+                '-m set --match-set %s src -j %s' % (name, target))
+        ruleset.append('filter', FORWARD_CHAIN,
+                '-m set --match-set %s dst -j %s' % (name, target))
+
+    def create_quota_chain(self, ruleset, chain, quota, target):
+        ruleset.chain('filter', chain)
+        ruleset.append('filter', chain, '-m quota --quota %d -j %s' % (
+            max(quota, 0), target))
+        ruleset.append('filter', chain, '-j DROP')
+
+    def create_redirect_rules(self, ruleset):
+        if self.in_interface is None:
+            return
+        if self.redirector is not None:
+            ruleset.append('nat', PREROUTING_CHAIN,
+                    '-i %s -p tcp --dport 80 -j DNAT --to-destination %s:%d' % (
+                        self.in_interface, self.redirector[0],
+                        self.redirector[1]))
+        ruleset.append('filter', FORWARD_CHAIN,
+                '-i %s -j DROP' % self.in_interface)
+
+    def load(self, ruleset=None):
+        """
+        Load ipsets with one ipset restore and rules in one
+        iptables-restore --noflush transaction, the current rules are
+        kept if it fails.
+        """
+
+        if ruleset is None:
+            ruleset = self.build()
+        run([self.ipset, 'restore'], ruleset.render_sets())
+        data = ruleset.render(run([self.save]))
+        run([self.restore, '--noflush'], data)
+        logging.debug('ruleset loaded: %d lines' % data.count('\n'))
+
+    def session_set(self, session):
+        """
+        Get name of ipset for session.
+        """
+
+        user = session.user_id
+        users = set(UserQuotaPolicy.objects.filter(user=user
+            ).values_list('user', flat=True))
+        departaments = dict(UserDepartament.objects.filter(user=user,
+            departament__departamentquotapolicy__isnull=False
+            ).values_list('user', 'departament'))
+        return self.get_set(user, users, departaments)
+
+    def add_session(self, session):
+        """
+        Allow traffic of session.
+        """
+
+        run([self.ipset, 'add', self.session_set(session), session.src,
+            '-exist'])
+
+    def online_sets(self):
+        """
+        Get names of session sets, members of ONLINE_SET.
+        """
+
+        output = run([self.ipset, 'list', ONLINE_SET])
+        if 'Members:' not in output:
+            return []
+        return output.split('Members:', 1)[1].split()
+
+    def remove_session(self, session):
+        """
+        Deny traffic of session.
+
+        Address is deleted from all session sets in one ipset restore,
+        policies of user may have changed since the session was started,
+        so it may be in a set other than session_set() one.
+        """
+
+        data = ''.join('del %s %s -exist\n' % (name, session.src)
+                for name in self.online_sets())
+        if data:
+            run([self.ipset, 'restore'], data)
+
+    def sync_quotas(self):
+        """
+        Update used quotas from the remaining quotas of quota chains.
+
+        All of them are read from a single iptables-save snapshot, only
+        changed policies are written.
+
+        Returns number of updated policies.
+        """
+
+        users, departaments = parse_quotas(
+                run([self.save, '-c', '-t', 'filter']))
+        with transaction.commit_on_success():
+            updated = update_used(UserQuotaPolicy, 'user', users)
+            updated += update_used(DepartamentQuotaPolicy, 'departament',
+                    departaments)
+        logging.debug('sync_quotas: %d policies updated' % updated)
+        return updated
+
+
+QUOTA_RULE = re.compile(r'-A tas-([ud])(\d+)-quota .*-m quota --quota (\d+)')
+
+def parse_quotas(data):
+    """
+    Get remaining quotas from iptables-save output.
+
+    Returns tuple of dicts ({user_id: quota}, {departament_id: quota}).
+    """
+
+    quotas = {'u': {}, 'd': {}}
+    for match in QUOTA_RULE.finditer(data):
+        kind, id, quota = match.groups()
+        quotas[kind].setdefault(int(id), int(quota))
+    return quotas['u'], quotas['d']
+
+def update_used(model, key, quotas):
+    """
+    Set used quota of policies of model to full quota minus the
+    remaining one, with a single executemany UPDATE.
+
+    Used quota is never decreased, the firewall can't have less than
+    zero quota remaining.
+
+    @param key:
+        name of field, which values are keys of quotas
+    """
+
+    if not quotas:
+        return 0
+    rows = []
+    for id, k, full, used in model.objects.filter(**{
+            '%s__in' % key: quotas.keys()}).values_list(
+                    'id', key, 'full', 'used'):
+        new_used = max(full - quotas[k], used)
+        if new_used != used:
+            rows.append((new_used, id))
+    if rows:
+        connection.cursor().executemany('UPDATE %s SET used = %%s'
+                ' WHERE id = %%s' % connection.ops.quote_name(
+                    model._meta.db_table), rows)
+    return len(rows)
+
+
+class QuotaSyncThread(Thread):
+    """
+    Background thread syncing used quotas every interval seconds.
+    """
+
+    def __init__(self, firewall, interval):
+        Thread.__init__(self)
+        self.daemon = True
+        self.firewall = firewall
+        self.interval = interval
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.firewall.sync_quotas()
+            except Exception:
+                logging.error(traceback.format_exc())
+            reset_queries()
+
+    def stop(self):
+        self.stopped.set()
+
+
+class FirewallReloader(Thread):
+    """
+    Background thread reloading ruleset on request.
+
+    Requests made before a reload starts are served by a single reload,
+    failed reloads are logged and retried every interval seconds.
+    """
+
+    def __init__(self, firewall=None, interval=1):
+        Thread.__init__(self)
+        self.daemon = True
+        self.firewall = firewall
+        self.interval = interval
+        self.requested = Event()
+        self.stopped = Event()
+        self.reloads = 0
+        self.failures = 0
+
+    def request(self):
+        self.requested.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            if not self.requested.wait(self.interval):
+                continue
+            self.requested.clear()
+            if not self.reload():
+                self.requested.set()
+                self.stopped.wait(self.interval)
+
+    def reload(self):
+        """
+        Reload ruleset, returns False if it failed.
+        """
 
-        for user in User.objects.all():
-            self.create_user_tables(user)
-            
-        for session in Session.objects.filter(dt_finish=None)
-            username = session.user.username
-            Table('filter').append_rule('FORWARD',
-                    Rule(
-                        source=session.src,
-                        jump=username+'-access-out'
-                ))
-            Table('filter').append_rule('FORWARD',
-                    Rule(
-                        destination=session.src,
-                        jump=username+'-access-in'
-                ))
-            Table('nat').append_rule('PREROUTING',
-                    Rule(
-                        source=session.src,
-                        jump='ACCEPT'
-                    )
-            
-        self.create_redirect_rules()
-    
-    def create_user_tables(self, user):
-
-        if UserDepartament.objects.filter(user=user).count():
-            depart = UserDepartament.objects.get(user=user).departament
-            depart_quota_chain = ":".join(depart.name, "quota")
-            user_quota_chain_jump = depart_quota_chain
-        else:
-            user_quota_chain_jump = 'RETURN'
-
-        if UserQuotaPolicy.objects.filter(user=user).count():
-            user_quota_policy = UserQuotaPolicy.objects.get(user=user)
-
-            user_quota_chain = ":".join(user, "quota")
-            
-            Table('filter').create_chain(user_quota_chain)
-            Table('filter').append_rule(user_quota_chain,
-                Rule(
-                    jump=user_quota_chain_jump,
-                    matches=[Match('quota', '--quota %d' % (
-                user_quota_policy.quota.full - user_quota_policy.user
-                            ))],
-                        ))
-
-        # append user departament rules
         try:
-            Table('filter').append_rule(user_quota_chain,
-                    Rule(jump=depart_quota_chain)
-                )
-        except:
-            Table('filter').append_rule(user_quota_chain,
-                    Rule(jump='RETURN')
-                )
-
-        
-        Table('filter').append_rule(user+'-access', Rule(jump=user+'-quota'))
-        
-        Table('filter').append_rule(user+'-quota', Rule(jump=user+'-childs', matches=[
-            Match('quota', '--quota ' + str(users[user].quota_left))
-        ]))
-        
-        for i in tree.get_childs(user):
-            create_rules_for_user(i, users, tree)
-            Table('filter').append_rule(user+'-childs', Rule(jump=i+'-access', matches=[
-                Match('recent', '--rcheck --rsource --name ' + i)]))
-            Table('filter').append_rule(user+'-childs', Rule(jump=i+'-access', matches=[
-                Match('recent', '--rcheck --rdest --name ' + i)]))
-
-def create_redirect_rules(self):
-    Table('nat').append_rule('PREROUTING',
-            Rule(
-                in_interface=self.in_interface,
-                jump='DNAT --to-destination %s:%s' % \
-                        (self.redirector_ip, self.redirector_port)
-        ))
-
-
-#    global sync_quotas_timer
-#    sync_quotas_timer = Timer(config.sync_quotas_interval,
-#        sync_quotas, (users.keys(),))
-#    print "sync_quotas: set"
-#    sync_quotas_timer.setDaemon(True)
-#
-def sync_quotas(s, users):
-    
-    print "sync_quotas: start"
-    
-    for i in users:
-        quota_left = int(Table('filter').list_rules(i.login+'-quota')[-1].\
-            matches[0].options()['quota'][0])
-        if i.quota_left != quota_left:
-            print "sync_quotas: differ", i.login, i.quota_left, "->", quota_left
-            i.quota_left = quota_left
-            s.update(i)
-    
-    print "sync_quotas: finish"
+            (self.firewall or Firewall()).load()
+        except Exception:
+            self.failures += 1
+            logging.error('firewall reload failed\n%s' % traceback.format_exc())
+            return False
+        finally:
+            reset_queries()
+        self.reloads += 1
+        return True
+
+    def stop(self):
+        self.stopped.set()
+
+
+def enforce_quotas(request):
+    """
+    Connect receiver of quota_crossed, calling request when a quota is
+    exhausted, so the ruleset is reloaded and traffic is dropped even if
+    the quota counter of the firewall has drifted.
+
+    @param request:
+        function requesting reload, e.g. FirewallReloader.request, it
+        shouldn't block
+
+    Returns the receiver.
+    """
+
+    def receiver(sender, threshold, **kwargs):
+        if threshold >= 1:
+            request()
+
+    quota_crossed.connect(receiver, weak=False)
+    return receiver
+
+
+def load():
+    Firewall().load()
+
+def dump():
+    sys.stdout.write(Firewall().build().render())
+
+def sync(interval=None):
+    firewall = Firewall()
+    if interval is None:
+        firewall.sync_quotas()
+        return
+    thread = QuotaSyncThread(firewall, interval)
+    thread.start()
+    while thread.is_alive():
+        sleep(1)
+
+if __name__ == "__main__":
+
+    from optparse import OptionParser
+
+    usage = 'Usage: %prog [options] cmd'
+
+    parser = OptionParser(usage=usage, version='0.1.1')
+
+    parser.add_option('-d', '--debug', action='store_true', dest='debug',
+           help='print debug messages',
+           default=False)
+
+    parser.add_option('-i', '--interval', action='store', dest='interval',
+           type='float', help='sync quotas every INTERVAL seconds',
+           metavar='INTERVAL', default=None)
+
+    opt, args = parser.parse_args()
+
+    if opt.debug:
+        logging.basicConfig(level=logging.DEBUG, format="%(message)s")
+    else:
+        logging.basicConfig(level=logging.WARNING, format="%(message)s")
+
+    commands = {
+            'load': load,
+            'dump': dump,
+            'sync': lambda: sync(opt.interval),
+    }
+
+    if len(args) == 0:
+        logging.error(usage + __doc__)
+        sys.exit(1)
 
+    if args[0] in commands:
+        commands[args[0]](*args[1:])
+    else:
+        logging.error('No such command!\n\n' + __doc__)
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010-2011 Andrew Grigorev <andrew@ei-grad.ru>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Conntrack logger benchmark.
+
+Feeds ConntrackLogger with synthetic DESTROY events through a fake
+listener and reports its throughput, flush latency and number of
+queries per event. Runs against a test database created from the
+database selected with --database.
+"""
+
+import os
+os.environ['DJANGO_SETTINGS_MODULE'] = 'tas.settings'
+
+import sys
+import random
+import logging
+
+from time import time, sleep
+from threading import Thread
+
+from django.conf import settings
+
+
+class EventGenerator(object):
+    """
+    Generates plaintext conntrack DESTROY events.
+
+    Every subscriber talks to its own set of fanout destinations chosen
+    from a common pool, so popular destinations are shared like in real
+    traffic.
+    """
+
+    def __init__(self, subscribers=1000, fanout=50, pool=10000, seed=0):
+        """
+        Create new EventGenerator object.
+
+        @param subscribers:
+            number of subscriber addresses, 10.0.0.0/8 is used for them
+        @param fanout:
+            number of distinct destinations per subscriber
+        @param pool:
+            number of distinct destinations at all
+        @param seed:
+            random seed
+        """
+
+        self.random = random.Random(seed)
+        self.subscribers = ['10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255,
+            i & 255) for i in range(1, subscribers + 1)]
+        pool = ['%d.%d.%d.%d' % (self.random.randint(11, 223),
+            self.random.randint(0, 255), self.random.randint(0, 255),
+            self.random.randint(1, 254)) for i in range(pool)]
+        self.fanout = dict((src, self.random.sample(pool, min(fanout, len(pool))))
+                for src in self.subscribers)
+
+    def event(self):
+        rnd = self.random
+        src = rnd.choice(self.subscribers)
+        dst = rnd.choice(self.fanout[src])
+        sport = rnd.randint(1024, 65535)
+        if rnd.random() < 0.8:
+            proto, num, dport = 'tcp', 6, rnd.choice((80, 443, 443, 443, 22))
+        else:
+            proto, num, dport = 'udp', 17, rnd.choice((53, 123, 443))
+        packets_out = rnd.randint(1, 100)
+        packets_in = rnd.randint(1, 200)
+        return ('[DESTROY] %s      %d src=%s dst=%s sport=%d dport=%d '
+                'packets=%d bytes=%d src=%s dst=%s sport=%d dport=%d '
+                'packets=%d bytes=%d [ASSURED] mark=0 use=1' % (
+                    proto, num, src, dst, sport, dport,
+                    packets_out, packets_out * rnd.randint(40, 1500),
+                    dst, src, dport, sport,
+                    packets_in, packets_in * rnd.randint(40, 1500)))
+
+
+class FakeEventListener(object):
+    """
+    Stand-in for Conntrack.EventListener calling callback with generated
+    events from its own thread.
+    """
+
+    def __init__(self, callback, generator, count, rate=None):
+        """
+        Create new FakeEventListener object.
+
+        @param callback:
+            function to call with every event
+        @param generator:
+            EventGenerator object
+        @param count:
+            number of events to generate
+        @param rate:
+            events per second, as fast as possible if None
+        """
+
+        self.callback = callback
+        self.generator = generator
+        self.count = count
+        self.rate = rate
+        self.sent = 0
+        self._running = False
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self._running = True
+        self.started = time()
+        self.thread.start()
+
+    def stop(self):
+        self._running = False
+
+    def run(self):
+        # send events in batches of 1/100 second
+        if self.rate is None:
+            batch = 1000
+        else:
+            batch = max(1, int(self.rate / 100))
+        while self._running and self.sent < self.count:
+            n = min(batch, self.count - self.sent)
+            for i in xrange(n):
+                self.callback(self.generator.event())
+            self.sent += n
+            if self.rate is not None:
+                delay = self.started + float(self.sent) / self.rate - time()
+                if delay > 0:
+                    sleep(delay)
+        self._running = False
+
+    def is_alive(self):
+        return self._running
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def benchmark(generator, count, rate=None, interval=1):
+    """
+    Run ConntrackLogger on generated events.
+
+    Returns dict with results.
+    """
+
+    from django.db import connection, transaction
+    from django.contrib.auth.models import User
+    from netstat.models import Session
+    from netstat.conntrack_logger import ConntrackLogger
+
+    with transaction.commit_on_success():
+        for n, src in enumerate(generator.subscribers):
+            user = User.objects.create(username='bench%d' % n)
+            Session.objects.create(user=user, src=src)
+
+    class BenchmarkLogger(ConntrackLogger):
+
+        flush_times = []
+        queries = 0
+        events = 0
+
+        def create_listener(self):
+            return FakeEventListener(self.event_callback, generator, count, rate)
+
+        def handle_event(self, event):
+            self.events += 1
+            super(BenchmarkLogger, self).handle_event(event)
+
+        def flush(self):
+            t0 = time()
+            rows = super(BenchmarkLogger, self).flush()
+            self.flush_times.append(time() - t0)
+            # the loop resets queries after every flush
+            self.queries += len(connection.queries)
+            return rows
+
+    logger = BenchmarkLogger(interval=interval, queue_size=max(count, 1))
+
+    def watch():
+        while logger.listener.is_alive():
+            sleep(0.01)
+        logger.stop()
+
+    watcher = Thread(target=watch)
+    watcher.daemon = True
+    watcher.start()
+
+    t0 = logger.listener.started
+    logger.run()
+    elapsed = time() - t0
+
+    return {
+        'events': logger.events,
+        'dropped': logger.queue.dropped,
+        'elapsed': elapsed,
+        'rate': logger.events / elapsed,
+        'flushes': len(logger.flush_times),
+        'flush_p50': percentile(logger.flush_times, 50),
+        'flush_p90': percentile(logger.flush_times, 90),
+        'flush_p99': percentile(logger.flush_times, 99),
+        'flush_max': max(logger.flush_times or [0]),
+        'queries_per_event': float(logger.queries) / max(logger.events, 1),
+    }
+
+
+REPORT = """\
+database:          %(database)s (%(engine)s)
+events:            %(events)d (%(dropped)d dropped)
+elapsed:           %(elapsed).2f s
+events/sec:        %(rate).0f
+flushes:           %(flushes)d
+flush latency:     p50 %(flush_p50).3f s, p90 %(flush_p90).3f s, p99 %(flush_p99).3f s, max %(flush_max).3f s
+queries per event: %(queries_per_event).4f
+"""
+
+
+if __name__ == "__main__":
+
+    from optparse import OptionParser
+
+    usage = 'Usage: %prog [options]'
+
+    parser = OptionParser(usage=usage, version='0.1.1')
+
+    parser.add_option('-d', '--debug', action='store_true', dest='debug',
+            help='print debug messages',
+            default=False)
+    parser.add_option('-v', '--verbose', action='store_true', dest='verbose',
+            help='print info messages',
+            default=False)
+    parser.add_option('-D', '--database', dest='database', metavar='ALIAS',
+            help='benchmark on test copy of DATABASES[ALIAS]',
+            default='default')
+    parser.add_option('-e', '--events', dest='events', metavar='N',
+            help='number of events to generate',
+            default=100000)
+    parser.add_option('-r', '--rate', dest='rate', metavar='N',
+            help='events per second, as fast as possible if not given',
+            default=None)
+    parser.add_option('-u', '--subscribers', dest='subscribers', metavar='N',
+            help='number of subscribers',
+            default=1000)
+    parser.add_option('-f', '--fanout', dest='fanout', metavar='N',
+            help='number of destinations per subscriber',
+            default=50)
+    parser.add_option('-i', '--interval', dest='interval', metavar='SECONDS',
+            help='interval in seconds to syncronize data with database',
+            default=1)
+    parser.add_option('-m', '--min-rate', dest='min_rate', metavar='N',
+            help='exit with error if less than N events/sec were processed',
+            default=None)
+
+    opt, args = parser.parse_args()
+
+    if opt.debug:
+        logging.basicConfig(level=logging.DEBUG, format="%(message)s")
+    elif opt.verbose:
+        logging.basicConfig(level=logging.INFO, format="%(message)s")
+    else:
+        logging.basicConfig(level=logging.WARNING, format="%(message)s")
+
+    # must be done before django.db is imported
+    settings.DATABASES['default'] = settings.DATABASES[opt.database]
+    # queries are counted with connection.queries
+    settings.DEBUG = True
+
+    from django.db import connection
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+
+    try:
+        result = benchmark(
+                EventGenerator(int(opt.subscribers), int(opt.fanout)),
+                int(opt.events),
+                opt.rate and float(opt.rate),
+                int(opt.interval))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    result.update(database=opt.database,
+            engine=settings.DATABASES['default']['ENGINE'])
+    sys.stdout.write(REPORT % result)
+
+    if opt.min_rate is not None and result['rate'] < float(opt.min_rate):
+        sys.exit(1)
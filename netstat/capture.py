@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010-2011 Andrew Grigorev <andrew@ei-grad.ru>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Capture of conntrack data besides DESTROY events.
+
+In dump mode the whole conntrack table is dumped with counters zeroed
+every interval, so every dump contains traffic of flows since the
+previous one. Cost of a dump depends on the size of the table instead
+of the rate of new flows, and long-lived flows are accounted while they
+last. Flows which are removed from the table between dumps are lost,
+so the interval should be shorter than the shortest conntrack timeout
+of finished flows (e.g. TIME_WAIT). Byte counters require conntrack
+accounting to be enabled (net.netfilter.nf_conntrack_acct=1).
+
+In events mode netlink socket may overrun when events come faster than
+they are read, OverrunMonitor detects it.
+"""
+
+import os
+import logging
+import traceback
+
+from threading import Thread, Event
+from subprocess import Popen, PIPE
+
+
+EVENTS = 'events'
+DUMP = 'dump'
+
+MODES = (EVENTS, DUMP)
+
+NETLINK_NETFILTER = 12
+
+
+def to_event(line):
+    """
+    Convert entry of conntrack table dump to plaintext event format.
+    """
+
+    return '[UPDATE] ' + line.strip()
+
+
+def parse_dump(lines):
+    """
+    Get entries of conntrack table dump with traffic in plaintext event
+    format, entries without traffic since the previous dump are skipped.
+    """
+
+    events = []
+    for line in lines:
+        for field in line.split():
+            if field.startswith('bytes=') and field != 'bytes=0':
+                events.append(to_event(line))
+                break
+    return events
+
+
+class ConntrackDump(object):
+    """
+    Dumps conntrack table zeroing counters with conntrack utility.
+    """
+
+    def __init__(self, command=('conntrack', '-L', '-z')):
+        self.command = list(command)
+
+    def __call__(self):
+        """
+        Returns list of entries in plaintext event format.
+        """
+
+        proc = Popen(self.command, stdout=PIPE, stderr=PIPE)
+        output, errors = proc.communicate()
+        if proc.returncode != 0:
+            raise OSError('%s failed with code %d: %s' % (
+                ' '.join(self.command), proc.returncode, errors.strip()))
+        return parse_dump(output.splitlines())
+
+
+class FileDump(object):
+    """
+    Replays recorded dumps of conntrack table, one file per call.
+    """
+
+    def __init__(self, filenames):
+        self.filenames = list(filenames)
+
+    def __call__(self):
+        if not self.filenames:
+            return []
+        f = open(self.filenames.pop(0))
+        try:
+            return parse_dump(f)
+        finally:
+            f.close()
+
+
+class DumpPoller(Thread):
+    """
+    Calls dump source every interval seconds and passes its entries to
+    callback, can be used in place of EventListener.
+    """
+
+    def __init__(self, dump, callback, interval=10):
+        """
+        Create new DumpPoller object.
+
+        @param dump:
+            function returning list of entries in plaintext event format,
+            e.g. ConntrackDump or FileDump object
+        @param callback:
+            function to call for every entry
+        @param interval:
+            interval in seconds between dumps
+        """
+
+        Thread.__init__(self)
+        self.daemon = True
+        self.dump = dump
+        self.callback = callback
+        self.interval = interval
+        self.stopped = Event()
+        self.dumps = 0
+        self.failures = 0
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.poll()
+            self.stopped.wait(self.interval)
+
+    def poll(self):
+        """
+        Dump table once.
+
+        Returns number of entries.
+        """
+
+        try:
+            entries = self.dump()
+        except Exception:
+            self.failures += 1
+            logging.error('conntrack dump failed\n%s' % traceback.format_exc())
+            return 0
+        for entry in entries:
+            self.callback(entry)
+        self.dumps += 1
+        logging.debug('conntrack dump: %d entries' % len(entries))
+        return len(entries)
+
+    def stop(self):
+        self.stopped.set()
+
+
+def netlink_drops(netlink='/proc/net/netlink', fd_dir='/proc/self/fd'):
+    """
+    Get number of messages dropped by overruns of netfilter netlink
+    sockets of the process.
+    """
+
+    inodes = set()
+    for fd in os.listdir(fd_dir):
+        try:
+            target = os.readlink(os.path.join(fd_dir, fd))
+        except OSError:
+            continue
+        if target.startswith('socket:['):
+            inodes.add(target[8:-1])
+
+    drops = 0
+    f = open(netlink)
+    try:
+        header = f.readline().split()
+        protocol = header.index('Eth')
+        drops_column = header.index('Drops')
+        inode = header.index('Inode')
+        for line in f:
+            fields = line.split()
+            if len(fields) < len(header):
+                continue
+            if int(fields[protocol]) == NETLINK_NETFILTER and \
+                    fields[inode] in inodes:
+                drops += int(fields[drops_column])
+    finally:
+        f.close()
+    return drops
+
+
+class OverrunMonitor(object):
+    """
+    Detects overruns of netlink sockets receiving conntrack events.
+    """
+
+    def __init__(self, netlink='/proc/net/netlink', fd_dir='/proc/self/fd'):
+        self.netlink = netlink
+        self.fd_dir = fd_dir
+        self.drops = self.read()
+
+    def read(self):
+        """
+        Returns cumulative number of dropped messages or None if it
+        can't be read.
+        """
+
+        try:
+            return netlink_drops(self.netlink, self.fd_dir)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def check(self):
+        """
+        Returns number of messages dropped since the last successful
+        check.
+        """
+
+        drops = self.read()
+        if drops is None:
+            return 0
+        if self.drops is None:
+            # the first successful read is the baseline
+            self.drops = drops
+            return 0
+        new, self.drops = max(drops - self.drops, 0), drops
+        return new
@@ -28,10 +28,80 @@ import logging
 import traceback
 
 from time import time, sleep
+from threading import Thread, Lock, Event
+from multiprocessing import Process, Pipe
 from Conntrack import EventListener, NFCT_T_DESTROY, NFCT_O_PLAIN, parse_plaintext_event
 
-from django.db import reset_queries, transaction
-from netstat.models import Session, Record
+from django.conf import settings
+from django.db import reset_queries, transaction, DatabaseError
+from netstat.models import Session
+from netstat.event_queue import EventQueue, BLOCK, DROP_OLDEST, POLICIES
+from netstat.rawstat import RawStatWriter, is_ipv6, event_protocol
+from netstat.metrics import Metrics
+from netstat.shards import shard_of, event_sources
+from netstat.sessions import SessionIndex
+from netstat.prefixes import DstAggregator, load_prefixes
+from netstat.usage_cache import bump_versions
+from netstat.journal import Journal, JournalCommitter, write_traffic
+from netstat.capture import EVENTS, DUMP, MODES, ConntrackDump, DumpPoller, \
+        OverrunMonitor
+from policy.models import send_crossings
+from netfilter_control import FirewallReloader, enforce_quotas
+
+# sent by workers to the dispatcher to reload firewall ruleset
+RELOAD = 'reload'
+
+
+def create_listener(callback, capture=EVENTS, dump=None, dump_interval=10):
+    """
+    Create listener calling callback with plaintext events.
+
+    @param capture:
+        EVENTS to listen DESTROY events or DUMP to dump conntrack table
+        with counters zeroed every dump_interval seconds
+    @param dump:
+        dump source for DUMP mode, ConntrackDump by default
+    """
+
+    if capture == DUMP:
+        if dump is None:
+            dump = ConntrackDump()
+        return DumpPoller(dump, callback, dump_interval)
+    return EventListener(callback, NFCT_T_DESTROY, NFCT_O_PLAIN)
+
+
+def check_overruns(monitor, metrics=None):
+    """
+    Report events lost by netlink socket overruns.
+    """
+
+    drops = monitor.check()
+    if drops:
+        logging.warning('netlink socket overrun, %d events lost' % drops)
+        if metrics is not None:
+            metrics.inc('netlink_overruns', drops)
+
+
+class SessionRefresher(Thread):
+    """
+    Refreshes session index and splits sessions of ConntrackLogger in
+    background, so a stalled database doesn't block draining of events.
+    """
+
+    def __init__(self, logger):
+        Thread.__init__(self)
+        self.daemon = True
+        self.logger = logger
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.logger.refresh_sessions()
+            self.logger.check_split()
+            self.stopped.wait(self.logger.interval)
+
+    def stop(self):
+        self.stopped.set()
 
 
 class ConntrackLogger(object):
@@ -39,14 +109,47 @@ class ConntrackLogger(object):
     ConntrackLogger
     """
 
-    def __init__(self, interval=1, rawfile=None):
+    def __init__(self, interval=1, rawfile=None, queue_size=100000,
+            queue_policy=DROP_OLDEST, spillfile=None, shard=None,
+            metricsfile=None, aggregator=None, split_interval=None,
+            journal=None, capture=EVENTS, dump=None, dump_interval=10):
         """
         Create new ConntrackLogger object.
 
         @param interval:
             interval in seconds to syncronize data with database
         @param rawfile:
-            file object to put raw statistics
+            RawStatWriter object to put raw statistics
+        @param queue_size:
+            maximum number of events waiting for processing in memory
+        @param queue_policy:
+            what to do with events when queue is full, see EventQueue
+        @param spillfile:
+            file object to spill events to, used by spill policy
+        @param shard:
+            tuple (shard, shards) to run as a worker of ShardedLogger,
+            events are put to queue by the caller then
+        @param metricsfile:
+            file name to write metrics in Prometheus text format to
+            after every interval
+        @param aggregator:
+            DstAggregator object to map destinations of Records, exact
+            addresses are used by default
+        @param split_interval:
+            split sessions every split_interval seconds, right after a
+            flush unless there is a journal, only the first shard does it
+            in sharded mode
+        @param journal:
+            Journal object to append traffic to instead of writing it to
+            database, a JournalCommitter thread writes it then, and a
+            SessionRefresher thread refreshes and splits sessions, so the
+            main loop makes no queries
+        @param capture:
+            EVENTS or DUMP, see create_listener()
+        @param dump:
+            dump source for DUMP mode
+        @param dump_interval:
+            interval in seconds to dump conntrack table in DUMP mode
         """
 
         #super(ConntrackLogger, self).__init__()
@@ -54,18 +157,78 @@ class ConntrackLogger(object):
         self.rawfile = rawfile
         self.interval = int(interval)
 
-        self.listener = EventListener(self.event_callback,
-                NFCT_T_DESTROY, NFCT_O_PLAIN)
-        self.listener.start()
+        if shard is not None and shard[0] != 0:
+            split_interval = None
+        self.split_interval = split_interval
+        if split_interval is not None:
+            self.split_period = int(time()) // split_interval
+
+        self.queue = EventQueue(queue_size, queue_policy, spillfile)
+        self.dropped = 0
+
+        self.metricsfile = metricsfile
+        if shard is None:
+            self.metrics = Metrics('conntrack_logger')
+        else:
+            self.metrics = Metrics('conntrack_logger', {'shard': shard[0]})
+
+        self.capture = capture
+        self.dump = dump
+        self.dump_interval = dump_interval
+        self.overruns = None
+        if shard is None:
+            self.listener = self.create_listener()
+            self.listener.start()
+            if capture == EVENTS:
+                self.overruns = OverrunMonitor()
+        else:
+            self.listener = None
         self._running = False
 
-        self.events = []
+        self.deltas = {}
+        self.flushed_users = set()
+        self.crossings = []
+        if aggregator is None:
+            aggregator = DstAggregator()
+        self.aggregate = aggregator.aggregate
+
+        self.journal = journal
+        self.refresher = None
+        if journal is not None:
+            self.committer = JournalCommitter(journal, self.interval)
+            self.refresher = SessionRefresher(self)
+
+        # workers of sharded logger request reloads from the dispatcher
+        self.reloader = None
+        if settings.FIREWALL and shard is None:
+            self.reloader = FirewallReloader()
+            enforce_quotas(self.reloader.request)
+
+        self.sessions = SessionIndex(shard)
+        self.sessions.load()
 
         logging.debug('Conntrack logger initialized! interval=%d' % interval)
 
+    def create_listener(self):
+        return create_listener(self.event_callback, self.capture, self.dump,
+                self.dump_interval)
+
     def run(self):
         self._running = True
+        if self.journal is not None:
+            self.committer.start()
+            self.refresher.start()
+        if self.reloader is not None:
+            self.reloader.start()
         self.loop()
+        if self.journal is not None:
+            self.refresher.stop()
+            self.refresher.join()
+            self.committer.stop()
+            self.committer.join()
+            self.journal.close()
+        if self.reloader is not None:
+            self.reloader.stop()
 
     def loop(self):
         """
@@ -75,22 +238,55 @@ class ConntrackLogger(object):
         logging.debug('Main loop started!')
 
         try:
-            while self._running or self.events:
+            while self._running or len(self.queue):
 
                 t0 = time()
 
-                events = self.events
-                self.events = []
+                events = self.queue.get()
+
+                if self.queue.dropped > self.dropped:
+                    logging.warning('event queue is full, %d events dropped' % (
+                        self.queue.dropped - self.dropped))
+                    self.dropped = self.queue.dropped
+
+                if self.overruns is not None:
+                    check_overruns(self.overruns, self.metrics)
+
+                if self.refresher is None:
+                    self.refresh_sessions()
 
                 if events:
                     t1 = time()
                     logging.info('processing %d events...' % len(events))
+                    for event in events:
+                        self.handle_event(event)
+                    t2 = time()
                     with transaction.commit_on_success():
-                        if events:
-                            for event in events:
-                                self.handle_event(event)
+                        rows = self.flush()
+                    # invalidate only after the data is visible to others
+                    bump_versions(self.flushed_users)
+                    for model, id, owner, threshold, used, full in self.crossings:
+                        logging.info('%s %d: %d%% of quota used' % (
+                            model.__name__, owner, threshold * 100))
+                    send_crossings(self.crossings)
+                    t3 = time()
+                    if self.rawfile is not None:
+                        self.rawfile.flush()
                     reset_queries()
-                    logging.info('processed %d events in %.1f seconds' % (len(events), time() - t1))
+                    logging.info('processed %d events (%d records) in %.1f seconds' % (
+                        len(events), rows, time() - t1))
+
+                    self.metrics.observe('process_seconds', t2 - t1)
+                    self.metrics.observe('flush_seconds', t3 - t2)
+                    self.metrics.inc('flushes')
+                    self.metrics.inc('rows_written', rows)
+                    self.metrics.inc('quota_crossings', len(self.crossings))
+                    self.metrics.set('last_flush_timestamp', int(t3))
+
+                if self.refresher is None:
+                    self.check_split()
+
+                self.update_metrics(time() - t0)
 
                 if self._running and t0 < time():
                     sleep(self.interval - time() % self.interval)
@@ -98,22 +294,112 @@ class ConntrackLogger(object):
             traceback.print_exc()
             self.stop()
 
+        if self.rawfile is not None:
+            self.rawfile.close()
+
+    def refresh_sessions(self):
+        """
+        Apply session changes to the index, see SessionIndex.refresh().
+        """
+
+        try:
+            self.sessions.refresh()
+        except DatabaseError:
+            if self.journal is None:
+                raise
+            self.database_error()
+
+    def check_split(self):
+        """
+        Split sessions if split_interval has passed.
+        """
+
+        if self.split_interval is None:
+            return
+        period = int(time()) // self.split_interval
+        if period != self.split_period:
+            self.split_period = period
+            try:
+                self.split_sessions()
+            except DatabaseError:
+                if self.journal is None:
+                    raise
+                self.database_error()
+
+    def split_sessions(self):
+        """
+        Finish all open sessions and start new ones, see
+        SessionManager.split().
+        """
+
+        with transaction.commit_on_success():
+            sessions = Session.objects.split()
+        self.sessions.replace(sessions)
+        bump_versions(set(user for src, session, user in sessions))
+        self.metrics.inc('sessions_split', len(sessions))
+        logging.info('%d sessions split' % len(sessions))
+
+    def database_error(self):
+        """
+        Log database error of SessionRefresher and go on, traffic is kept
+        in journal meanwhile.
+        """
+
+        logging.error(traceback.format_exc())
+        self.metrics.inc('database_errors')
+        transaction.rollback_unless_managed()
+
+    def update_metrics(self, loop_time):
+        queue = self.queue
+        self.metrics.counters['events_received'] = queue.enqueued
+        self.metrics.counters['events_dropped'] = queue.dropped
+        self.metrics.counters['events_spilled'] = queue.spilled
+        self.metrics.set('queue_depth', len(queue))
+        self.metrics.set('queue_high_watermark', queue.high_watermark)
+        self.metrics.set('loop_seconds', loop_time)
+        self.metrics.set('open_sessions', len(self.sessions.sessions))
+        if self.journal is not None:
+            self.metrics.set('journal_pending',
+                    self.journal.last - self.journal.committed)
+            self.metrics.set('journal_commit_failures',
+                    self.committer.failures)
+            self.metrics.counters['journal_rejected_batches'] = \
+                    self.committer.rejected
+        if isinstance(self.listener, DumpPoller):
+            self.metrics.counters['conntrack_dumps'] = self.listener.dumps
+            self.metrics.counters['conntrack_dump_failures'] = \
+                    self.listener.failures
+        if self.metricsfile is not None:
+            self.metrics.write(self.metricsfile)
+
     def raw_stat(self, *args):
         if not self.rawfile is None:
-            self.rawfile.write(":".join(*args)+"\n")
+            self.rawfile.write(*args)
 
     def handle_event(self, event):
 
         proto, d_in, d_out = parse_plaintext_event(event)
+        self.metrics.inc('events_parsed')
 
         fields = set(('src', 'dst', 'bytes'))
 
         if not (fields.issubset(d_in) and fields.issubset(d_out)):
             logging.warning('incomplete event: "%s"' % event)
+            self.metrics.inc('events_incomplete')
+            return
+
+        if is_ipv6(d_in['src']):
+            # sessions and raw statistics are of IPv4 addresses only
+            self.metrics.inc('events_ipv6')
             return
 
-        self.raw_stat(int(time()), proto, d_in['src'], d_in.get('sport', '0'),
-                d_in['dst'], d_in.get('dport', 0), d_in['bytes'], d_out['bytes'])
+        # in sharded mode the event is sent to shards of both sources,
+        # only the shard of the originating one logs it
+        primary = self.sessions.in_shard(d_in['src'])
+
+        if primary:
+            self.raw_stat(int(time()), event_protocol(event, proto), d_in['src'], d_in.get('sport', '0'),
+                    d_in['dst'], d_in.get('dport', 0), d_in['bytes'], d_out['bytes'])
 
         handled = False
 
@@ -127,31 +413,52 @@ class ConntrackLogger(object):
             handled = True
             self.update_session(session, d_out, d_in)
 
-        if handled is False:
+        if handled is False and primary:
             logging.warning('unhandled connection: "%s"' % event)
+            self.metrics.inc('events_unhandled')
 
     def get_session(self, src):
-        try:
-            return Session.objects.get(src=src, dt_finish=None)
-        except Session.DoesNotExist:
-            return None
-
-    def get_record(self, session, dst):
-        return Record.objects.get_or_create(session=session, dst=dst)[0]
+        return self.sessions.get(src)
 
     def update_session(self, session, d_in, d_out):
         logging.debug('updating %s -> %s: %s %s' % (d_in['src'], d_in['dst'], d_in['bytes'], d_out['bytes']))
-        rec = self.get_record(session, d_in['dst'])
-        rec.traf_in += int(d_in['bytes'])
-        rec.traf_out += int(d_out['bytes'])
-        rec.save()
+        key = (session, self.aggregate(d_in['dst']))
+        traf = self.deltas.get(key)
+        if traf is None:
+            traf = self.deltas[key] = [0, 0]
+        traf[0] += int(d_in['bytes'])
+        traf[1] += int(d_out['bytes'])
+
+    def flush(self):
+        """
+        Write traffic accumulated since the last flush to database and
+        add it to users' usage rollups and used quotas. Users whose
+        traffic was written are kept in flushed_users, quota thresholds
+        passed by them in crossings.
+
+        If there is a journal, traffic is appended to it instead.
+
+        Returns number of (session, dst) pairs written.
+        """
+
+        deltas, self.deltas = self.deltas, {}
+        users = self.sessions.users
+        if self.journal is not None:
+            if deltas:
+                self.journal.append(deltas, users, time())
+            self.flushed_users, self.crossings = set(), []
+        else:
+            self.flushed_users, self.crossings = write_traffic(deltas, users)
+        self.sessions.prune_users()
+        return len(deltas)
 
     def stop(self):
         """
         Stop main loop.
         """
 
-        self.listener.stop()
+        if self.listener is not None:
+            self.listener.stop()
         self._running = False
 
     def event_callback(self, event):
@@ -159,7 +466,202 @@ class ConntrackLogger(object):
         Callback for Netfilter netlink interface.
         """
 
-        self.events.append(event)
+        self.queue.put(event)
+
+
+def run_worker(shard, conn, kwargs):
+    """
+    Run ConntrackLogger for shard, fed with lists of events from conn.
+
+    None received from conn stops the worker. If rawfile is given, it is
+    a base name of archive and the worker writes its own archive with the
+    shard number as a suffix, the same is done with journal. Shard number
+    is inserted before extension of metricsfile too.
+    """
+
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # don't share database connection with the parent process
+    from django.db import connection
+    connection.close()
+
+    rawfile_options = kwargs.pop('rawfile_options', {})
+    if kwargs.get('rawfile') is not None:
+        kwargs['rawfile'] = RawStatWriter('%s.%d' % (kwargs['rawfile'], shard[0]),
+                **rawfile_options)
+
+    if kwargs.get('journal') is not None:
+        kwargs['journal'] = Journal('%s.%d' % (kwargs['journal'], shard[0]))
+
+    if kwargs.get('metricsfile') is not None:
+        root, ext = os.path.splitext(kwargs['metricsfile'])
+        kwargs['metricsfile'] = '%s.%d%s' % (root, shard[0], ext)
+
+    logger = ConntrackLogger(shard=shard, **kwargs)
+
+    if settings.FIREWALL:
+        # crossings are sent by the main loop and the journal committer
+        lock = Lock()
+        def request():
+            with lock:
+                conn.send(RELOAD)
+        enforce_quotas(request)
+
+    def feed():
+        while True:
+            events = conn.recv()
+            if events is None:
+                break
+            for event in events:
+                logger.queue.put(event)
+        logger.stop()
+
+    feeder = Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+
+    logger.run()
+
+
+class ShardedLogger(object):
+    """
+    Listens conntrack events and dispatches them to ConntrackLogger worker
+    processes by hash of subscriber address.
+
+    Each worker keeps sessions and traffic of its shard only and writes
+    to database independently, so parsing and accounting scale with the
+    number of processes. Firewall ruleset is reloaded by the dispatcher
+    only, on requests of workers.
+    """
+
+    def __init__(self, workers, interval=1, queue_size=100000,
+            queue_policy=DROP_OLDEST, dispatch_interval=0.1, capture=EVENTS,
+            dump=None, dump_interval=10, **kwargs):
+        """
+        Create new ShardedLogger object.
+
+        @param workers:
+            number of worker processes
+        @param dispatch_interval:
+            interval in seconds to send events to workers
+        @param capture, dump, dump_interval:
+            see create_listener()
+        @param kwargs:
+            other ConntrackLogger arguments for workers, rawfile is a base
+            name of archive and rawfile_options are RawStatWriter
+            arguments, journal is a base name of journals, see
+            run_worker(); metrics of the dispatcher are written to
+            metricsfile with '.dispatcher' inserted before extension
+        """
+
+        if queue_policy not in (DROP_OLDEST, BLOCK):
+            raise ValueError('queue policy %s is not supported in sharded mode'
+                    % queue_policy)
+
+        self.workers = int(workers)
+        self.dispatch_interval = dispatch_interval
+        self.reloader = None
+        self.metrics = Metrics('conntrack_dispatcher')
+        self.metricsfile = None
+        if kwargs.get('metricsfile') is not None:
+            root, ext = os.path.splitext(kwargs['metricsfile'])
+            self.metricsfile = '%s.dispatcher%s' % (root, ext)
+        self.dropped = 0
+        self.capture = capture
+        self.dump = dump
+        self.dump_interval = dump_interval
+
+        kwargs.update(interval=interval, queue_size=queue_size,
+                queue_policy=queue_policy)
+
+        self.queues = []
+        self.conns = []
+        self.processes = []
+        for shard in range(self.workers):
+            self.queues.append(EventQueue(queue_size, queue_policy))
+            conn, worker_conn = Pipe()
+            self.conns.append(conn)
+            self.processes.append(Process(target=run_worker,
+                args=((shard, self.workers), worker_conn, dict(kwargs))))
+
+        self._running = False
+
+    def run(self):
+        for process in self.processes:
+            process.start()
+
+        if settings.FIREWALL:
+            self.reloader = FirewallReloader()
+            self.reloader.start()
+
+        self.listener = create_listener(self.event_callback, self.capture,
+                self.dump, self.dump_interval)
+        self.listener.start()
+        if self.capture == EVENTS:
+            overruns = OverrunMonitor()
+        else:
+            overruns = None
+        self._running = True
+
+        logging.debug('Dispatching events to %d workers' % self.workers)
+
+        try:
+            updated = 0
+            while self._running:
+                self.dispatch()
+                if overruns is not None:
+                    check_overruns(overruns, self.metrics)
+                if time() - updated >= 1:
+                    updated = time()
+                    self.update_metrics()
+                sleep(self.dispatch_interval)
+            self.dispatch()
+            self.update_metrics()
+        except:
+            traceback.print_exc()
+            self.listener.stop()
+
+        for conn in self.conns:
+            conn.send(None)
+        for process in self.processes:
+            process.join()
+        if self.reloader is not None:
+            self.reloader.stop()
+
+    def dispatch(self):
+        for queue, conn in zip(self.queues, self.conns):
+            events = queue.get()
+            if events:
+                conn.send(events)
+            while conn.poll():
+                if conn.recv() == RELOAD and self.reloader is not None:
+                    self.reloader.request()
+
+    def update_metrics(self):
+        dropped = sum(queue.dropped for queue in self.queues)
+        if dropped > self.dropped:
+            logging.warning('dispatcher queues are full, %d events dropped' % (
+                dropped - self.dropped))
+            self.dropped = dropped
+        self.metrics.counters['events_queued'] = sum(queue.enqueued
+                for queue in self.queues)
+        self.metrics.counters['events_dropped'] = dropped
+        self.metrics.set('queue_depth', sum(len(queue) for queue in self.queues))
+        if self.metricsfile is not None:
+            self.metrics.write(self.metricsfile)
+
+    def stop(self):
+        self.listener.stop()
+        self._running = False
+
+    def event_callback(self, event):
+        orig, reply = event_sources(event)
+        shard = shard_of(orig, self.workers)
+        self.queues[shard].put(event)
+        reply_shard = shard_of(reply, self.workers)
+        if reply_shard != shard:
+            self.queues[reply_shard].put(event)
 
 if __name__ == "__main__":
 
@@ -177,11 +679,58 @@ if __name__ == "__main__":
             help='print info messages',
             default=False)
     parser.add_option('-w', '--rawfile', dest='rawfile', metavar="FILENAME",
-            help='write raw statistics to file',
+            help='write raw statistics to hourly archive FILENAME.YYYYmmddHH',
             default=None)
+    parser.add_option('--rotate-size', dest='rotate_size', metavar='MB',
+            help='also start new raw statistics file after MB megabytes',
+            default=None)
+    parser.add_option('-z', '--compress', action='store_true', dest='compress',
+            help='gzip closed raw statistics files',
+            default=False)
+    parser.add_option('--index', action='store_true', dest='index',
+            help='index closed raw statistics files for query_rawstat.py',
+            default=False)
     parser.add_option('-i', '--interval', dest='interval', metavar='SECONDS',
             help='interval in seconds to syncronize data with database',
             default=1)
+    parser.add_option('-q', '--queue-size', dest='queue_size', metavar='EVENTS',
+            help='maximum number of events kept in memory',
+            default=100000)
+    parser.add_option('-p', '--queue-policy', dest='queue_policy',
+            type='choice', choices=POLICIES, metavar='POLICY',
+            help='what to do when queue is full: %s' % ', '.join(POLICIES),
+            default=DROP_OLDEST)
+    parser.add_option('-m', '--metrics', dest='metricsfile', metavar='FILENAME',
+            help='write metrics in Prometheus text format to file',
+            default=None)
+    parser.add_option('--dst-prefix-len', dest='dst_prefix_len', metavar='BITS',
+            help='account destinations by /BITS networks instead of addresses',
+            default=32)
+    parser.add_option('--dst-prefixes', dest='dst_prefixes', metavar='FILENAME',
+            help='account destinations by labels of prefixes listed in file',
+            default=None)
+    parser.add_option('--split-interval', dest='split_interval', metavar='SECONDS',
+            help='split sessions every SECONDS instead of session_control.py split',
+            default=None)
+    parser.add_option('-n', '--workers', dest='workers', metavar='N',
+            help='dispatch events to N worker processes by subscriber address',
+            default=0)
+    parser.add_option('-s', '--spillfile', dest='spillfile', metavar="FILENAME",
+            help='file to spill events to when queue is full',
+            default=None)
+    parser.add_option('-c', '--capture', dest='capture', type='choice',
+            choices=MODES, metavar='MODE',
+            help='%s to account DESTROY events, %s to dump conntrack table'
+                ' zeroing counters every --dump-interval' % MODES,
+            default=EVENTS)
+    parser.add_option('--dump-interval', dest='dump_interval',
+            metavar='SECONDS',
+            help='interval in seconds to dump conntrack table in %s mode' % DUMP,
+            default=10)
+    parser.add_option('-j', '--journal', dest='journal', metavar="FILENAME",
+            help='append traffic to journal FILENAME and write it to database'
+                ' in background',
+            default=None)
 
     opt, args = parser.parse_args()
 
@@ -192,13 +741,52 @@ if __name__ == "__main__":
     else:
         logging.basicConfig(level=logging.WARNING, format="%(message)s")
 
-    if opt.rawfile is None:
-        rawfile = None
+    if opt.dst_prefixes is None:
+        prefixes = ()
     else:
-        rawfile = open(opt.rawfile, 'a')
+        prefixes = load_prefixes(opt.dst_prefixes)
+    aggregator = DstAggregator(int(opt.dst_prefix_len), prefixes)
 
-    # Initialize ContrackLogger
-    c = ConntrackLogger(rawfile=rawfile, interval=int(opt.interval))
+    if opt.split_interval is None:
+        split_interval = None
+    else:
+        split_interval = int(opt.split_interval)
+
+    rawfile_options = {'compress': opt.compress, 'index': opt.index}
+    if opt.rotate_size is not None:
+        rawfile_options['max_size'] = int(opt.rotate_size) << 20
+
+    if int(opt.workers):
+        # Initialize ShardedLogger, workers open their raw files themselves
+        c = ShardedLogger(int(opt.workers), rawfile=opt.rawfile,
+                rawfile_options=rawfile_options, metricsfile=opt.metricsfile,
+                aggregator=aggregator, split_interval=split_interval,
+                interval=int(opt.interval), queue_size=int(opt.queue_size),
+                queue_policy=opt.queue_policy, journal=opt.journal,
+                capture=opt.capture, dump_interval=float(opt.dump_interval))
+    else:
+        if opt.rawfile is None:
+            rawfile = None
+        else:
+            rawfile = RawStatWriter(opt.rawfile, **rawfile_options)
+
+        if opt.spillfile is None:
+            spillfile = None
+        else:
+            spillfile = open(opt.spillfile, 'w+')
+
+        if opt.journal is None:
+            journal = None
+        else:
+            journal = Journal(opt.journal)
+
+        # Initialize ContrackLogger
+        c = ConntrackLogger(rawfile=rawfile, interval=int(opt.interval),
+                queue_size=int(opt.queue_size), queue_policy=opt.queue_policy,
+                spillfile=spillfile, metricsfile=opt.metricsfile,
+                aggregator=aggregator, split_interval=split_interval,
+                journal=journal, capture=opt.capture,
+                dump_interval=float(opt.dump_interval))
 
     # Make handler for SIGINT
     def sigint_handler(signum, frame):
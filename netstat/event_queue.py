@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010-2011 Andrew Grigorev <andrew@ei-grad.ru>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Bounded queue of conntrack events.
+"""
+
+from collections import deque
+from threading import Condition
+
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop-oldest'
+SPILL = 'spill'
+
+POLICIES = (BLOCK, DROP_OLDEST, SPILL)
+
+
+class EventQueue(object):
+    """
+    Thread-safe ring buffer between the netlink listener thread and the
+    logger loop.
+
+    When the buffer is full, put() behaves according to policy:
+
+        block - wait until the loop takes events out
+        drop-oldest - discard the oldest event
+        spill - append the event to spillfile, it is read back by get()
+    """
+
+    def __init__(self, capacity=100000, policy=DROP_OLDEST, spillfile=None):
+        """
+        Create new EventQueue object.
+
+        @param capacity:
+            maximum number of events kept in memory
+        @param policy:
+            one of POLICIES
+        @param spillfile:
+            file object opened for reading and writing, required for
+            the spill policy
+        """
+
+        if policy not in POLICIES:
+            raise ValueError('unknown queue policy: %s' % policy)
+        if policy == SPILL and spillfile is None:
+            raise ValueError('spill policy requires spillfile')
+
+        self.capacity = int(capacity)
+        self.policy = policy
+        self.spillfile = spillfile
+
+        self.events = deque()
+        self.cond = Condition()
+
+        self.enqueued = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.high_watermark = 0
+
+        self._spill_pending = 0
+        self._spill_pos = 0
+
+    def __len__(self):
+        return len(self.events) + self._spill_pending
+
+    def put(self, event):
+        """
+        Add event to queue.
+        """
+
+        with self.cond:
+            if len(self.events) >= self.capacity:
+                if self.policy == BLOCK:
+                    while len(self.events) >= self.capacity:
+                        self.cond.wait()
+                elif self.policy == DROP_OLDEST:
+                    self.events.popleft()
+                    self.dropped += 1
+                else:
+                    self.spillfile.seek(0, 2)
+                    self.spillfile.write(event + '\n')
+                    self._spill_pending += 1
+                    self.spilled += 1
+                    self.enqueued += 1
+                    return
+            self.events.append(event)
+            self.enqueued += 1
+            if len(self.events) > self.high_watermark:
+                self.high_watermark = len(self.events)
+
+    def get(self):
+        """
+        Take all events kept in memory, at most capacity events.
+
+        Spilled events are moved to memory and returned by the next
+        calls.
+        """
+
+        with self.cond:
+            events = list(self.events)
+            self.events.clear()
+            if self._spill_pending:
+                self._unspill()
+            self.cond.notify_all()
+        return events
+
+    def _unspill(self):
+        self.spillfile.flush()
+        self.spillfile.seek(self._spill_pos)
+        while self._spill_pending and len(self.events) < self.capacity:
+            self.events.append(self.spillfile.readline().rstrip('\n'))
+            self._spill_pending -= 1
+        if self._spill_pending:
+            self._spill_pos = self.spillfile.tell()
+        else:
+            self.spillfile.seek(0)
+            self.spillfile.truncate()
+            self._spill_pos = 0
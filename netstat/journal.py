@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010-2011 Andrew Grigorev <andrew@ei-grad.ru>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Write-ahead journal of traffic deltas.
+
+Conntrack logger appends a batch of deltas to the journal on every
+flush, JournalCommitter writes them to database in background, so
+database stalls and failures don't block capture.
+
+Journal is a text file, a line per batch:
+
+    <batch id> <crc32 of data, hex> <data as JSON>
+
+Batch ids increase by one. The last committed id is kept in
+<journal>.checkpoint and in JournalCheckpoint row of the journal, which
+is updated in the same transaction as the deltas, so a batch is never
+written to database twice. Ids continue from the row if the checkpoint
+file is lost. Batches are read from the offset of the first uncommitted
+one, the journal is truncated when all its batches are committed and
+the committed ones are cut off when they take more than compact_size
+bytes.
+
+Batches which can't be written while database is available are moved
+to <journal>.rejected, so they don't block the following ones.
+"""
+
+import os
+import json
+import shutil
+import logging
+import traceback
+
+from zlib import crc32
+from threading import Thread, Lock, Event
+from datetime import datetime
+
+from django.db import transaction, reset_queries, connection, \
+        DatabaseError, IntegrityError
+from netstat.models import Record, UsageRollup, JournalCheckpoint
+from netstat.usage_cache import bump_versions
+from policy.models import add_used_quota, send_crossings
+
+
+def write_traffic(deltas, users, when=None):
+    """
+    Add traffic of sessions to records, usage rollups and used quotas.
+
+    @param deltas:
+        dict {(session_id, dst): [traf_in, traf_out]}
+    @param users:
+        dict {session_id: user_id}
+    @param when:
+        datetime to account traffic at, now by default
+
+    Returns tuple (set of ids of users with traffic, quota crossings).
+    """
+
+    if deltas:
+        Record.objects.add_traffic(deltas)
+        UsageRollup.objects.add_session_traffic(deltas, users, when)
+    used = {}
+    for (session, dst), traf in deltas.items():
+        user = users[session]
+        used[user] = used.get(user, 0) + traf[0] + traf[1]
+    crossings = add_used_quota(used)
+    return set(user for user, traf in used.items() if traf), crossings
+
+
+class Journal(object):
+
+    # committed batches are cut off when they take this many bytes
+    compact_size = 1 << 20
+
+    def __init__(self, filename):
+        """
+        Open journal, creating it if needed.
+
+        @param filename:
+            name of journal file, its absolute path identifies the
+            journal in database
+        """
+
+        self.filename = filename
+        self.name = os.path.abspath(filename)
+        self.lock = Lock()
+
+        self.committed = 0
+        if os.path.exists(self.checkpoint_name()):
+            self.committed = int(open(self.checkpoint_name()).read())
+
+        self.last = self.committed
+        # the checkpoint file may be lost while the database keeps the
+        # last written batch, new ids must not be below it or the new
+        # batches are skipped as already written
+        for batch in JournalCheckpoint.objects.filter(journal=self.name
+                ).values_list('batch', flat=True):
+            self.last = max(self.last, batch)
+        # offset of the first uncommitted batch and ends of the read ones
+        self.offset = 0
+        self.ends = {}
+        valid = 0
+        if os.path.exists(filename):
+            f = open(filename, 'rb')
+            for line in f:
+                batch = self.parse(line)
+                if batch is None:
+                    break
+                self.last = max(self.last, batch[0])
+                valid += len(line)
+                if batch[0] <= self.committed:
+                    self.offset = valid
+            f.close()
+
+        self.file = open(filename, 'ab')
+        size = os.path.getsize(filename)
+        if size > valid:
+            # the last write was torn by a crash
+            logging.warning('journal %s: dropping %d bytes of a torn batch' % (
+                filename, size - valid))
+            self.file.truncate(valid)
+            self.sync()
+
+    def checkpoint_name(self):
+        return self.filename + '.checkpoint'
+
+    def rejected_name(self):
+        return self.filename + '.rejected'
+
+    def parse(self, line):
+        """
+        Parse journal line.
+
+        Returns tuple (batch_id, data) or None if line is incomplete or
+        corrupted.
+        """
+
+        if not line.endswith('\n'):
+            return None
+        try:
+            batch_id, crc, data = line[:-1].split(' ', 2)
+            if int(crc, 16) != crc32(data) & 0xffffffff:
+                return None
+            return int(batch_id), json.loads(data)
+        except ValueError:
+            return None
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def append(self, deltas, users, when):
+        """
+        Durably append batch of deltas.
+
+        @param deltas:
+            dict {(session_id, dst): [traf_in, traf_out]}
+        @param users:
+            dict {session_id: user_id}, may contain other sessions
+        @param when:
+            timestamp to account traffic at
+
+        Returns batch id.
+        """
+
+        data = json.dumps({
+            'when': when,
+            'deltas': [[session, dst, traf[0], traf[1]]
+                for (session, dst), traf in deltas.items()],
+            'users': [[session, users[session]]
+                for session in set(session for session, dst in deltas)],
+        }, separators=(',', ':'))
+        with self.lock:
+            self.last += 1
+            self.file.write('%d %08x %s\n' % (self.last,
+                crc32(data) & 0xffffffff, data))
+            self.sync()
+            return self.last
+
+    def pending(self):
+        """
+        Get batches which are not committed yet.
+
+        Returns list of (batch_id, deltas, users, when) tuples.
+        """
+
+        with self.lock:
+            self.file.flush()
+            f = open(self.filename, 'rb')
+            f.seek(self.offset)
+            lines = f.readlines()
+            f.close()
+            end = self.offset
+
+        batches = []
+        for line in lines:
+            batch = self.parse(line)
+            if batch is None:
+                break
+            end += len(line)
+            batch_id, data = batch
+            if batch_id <= self.committed:
+                continue
+            self.ends[batch_id] = end
+            deltas = dict(((session, dst), [traf_in, traf_out])
+                    for session, dst, traf_in, traf_out in data['deltas'])
+            batches.append((batch_id, deltas, dict(data['users']),
+                data['when']))
+        return batches
+
+    def reject(self, batch_id):
+        """
+        Copy batch to the rejected file and mark it committed.
+        """
+
+        with self.lock:
+            self.file.flush()
+            f = open(self.filename, 'rb')
+            f.seek(self.offset)
+            lines = [line for line in f
+                    if line.split(' ', 1)[0] == str(batch_id)]
+            f.close()
+        f = open(self.rejected_name(), 'ab')
+        f.writelines(lines)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        self.commit(batch_id)
+
+    def commit(self, batch_id):
+        """
+        Mark batches up to batch_id committed, truncate journal if there
+        are no other batches or cut off the committed ones if they take
+        more than compact_size bytes.
+
+        Batches must be read by pending() first.
+        """
+
+        tmp = self.checkpoint_name() + '.tmp'
+        f = open(tmp, 'w')
+        f.write('%d\n' % batch_id)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(tmp, self.checkpoint_name())
+
+        with self.lock:
+            self.committed = batch_id
+            self.offset = self.ends.pop(batch_id, self.offset)
+            for i in [i for i in self.ends if i < batch_id]:
+                del self.ends[i]
+            if self.committed == self.last:
+                self.file.truncate(0)
+                self.sync()
+                self.offset = 0
+            elif self.offset > self.compact_size:
+                self.compact()
+
+    def compact(self):
+        """
+        Cut off committed batches, should be called with lock held.
+        """
+
+        self.file.flush()
+        tmp = self.filename + '.tmp'
+        src = open(self.filename, 'rb')
+        src.seek(self.offset)
+        dst = open(tmp, 'wb')
+        shutil.copyfileobj(src, dst)
+        dst.flush()
+        os.fsync(dst.fileno())
+        dst.close()
+        src.close()
+        os.rename(tmp, self.filename)
+        self.file.close()
+        self.file = open(self.filename, 'ab')
+        self.ends = dict((i, end - self.offset)
+                for i, end in self.ends.items())
+        self.offset = 0
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class JournalCommitter(Thread):
+    """
+    Writes batches of journal to database, retrying on errors.
+    """
+
+    def __init__(self, journal, interval=1, retry_interval=1,
+            max_retry_interval=60, max_attempts=5):
+        """
+        Create new JournalCommitter object.
+
+        @param journal:
+            Journal object
+        @param interval:
+            interval in seconds to check journal for new batches
+        @param retry_interval:
+            seconds to wait after the first failed attempt, doubled after
+            every next one up to max_retry_interval
+        @param max_attempts:
+            number of attempts to write batch while database is
+            available, batch is rejected after them; batches are retried
+            while database is unavailable, and are rejected at once if
+            they fail with IntegrityError or an error not related to
+            database
+        """
+
+        Thread.__init__(self)
+        self.daemon = True
+        self.journal = journal
+        self.interval = interval
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.max_attempts = max_attempts
+        self.stopped = Event()
+        self.failures = 0
+        self.rejected = 0
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.drain()
+            self.stopped.wait(self.interval)
+        # try to write the last batches, they are kept in journal anyway
+        self.drain(retry=False)
+
+    def stop(self):
+        self.stopped.set()
+
+    def drain(self, retry=True):
+        """
+        Write all pending batches.
+
+        Returns number of written batches.
+        """
+
+        count = 0
+        for batch in self.journal.pending():
+            written = self.write(batch, retry)
+            if written is None:
+                break
+            self.failures = 0
+            if written:
+                self.journal.commit(batch[0])
+                count += 1
+            else:
+                self.journal.reject(batch[0])
+                self.rejected += 1
+        return count
+
+    def write(self, batch, retry=True):
+        """
+        Write batch, retrying on errors.
+
+        Returns True if batch is written, False if it is rejected and None
+        if it isn't written yet.
+        """
+
+        attempts = 0
+        while True:
+            try:
+                self.apply(*batch)
+                return True
+            except Exception, e:
+                error = traceback.format_exc()
+                self.failures += 1
+                if self.available():
+                    attempts += 1
+                if isinstance(e, IntegrityError) or \
+                        not isinstance(e, DatabaseError) or \
+                        attempts >= self.max_attempts:
+                    logging.error('journal %s: batch %d is rejected\n%s' % (
+                        self.journal.name, batch[0], error))
+                    return False
+                delay = min(self.retry_interval * 2 ** (self.failures - 1),
+                        self.max_retry_interval)
+                logging.error('journal %s: failed to write batch %d,'
+                        ' retrying in %d seconds\n%s' % (self.journal.name,
+                            batch[0], delay, error))
+                if not retry or self.stopped.wait(delay):
+                    return None
+
+    def available(self):
+        """
+        Check if database is available.
+        """
+
+        try:
+            connection.cursor().execute('SELECT 1')
+        except DatabaseError:
+            return False
+        return True
+
+    def apply(self, batch_id, deltas, users, when):
+        """
+        Write batch to database unless it was written already.
+
+        Returns False if batch was skipped.
+        """
+
+        with transaction.commit_on_success():
+            updated = JournalCheckpoint.objects.filter(
+                    journal=self.journal.name, batch__lt=batch_id
+                    ).update(batch=batch_id)
+            if not updated:
+                if JournalCheckpoint.objects.filter(
+                        journal=self.journal.name).exists():
+                    logging.info('journal %s: batch %d is already written' % (
+                        self.journal.name, batch_id))
+                    return False
+                JournalCheckpoint.objects.create(journal=self.journal.name,
+                        batch=batch_id)
+            flushed_users, crossings = write_traffic(deltas, users,
+                    datetime.fromtimestamp(when))
+        reset_queries()
+        # invalidate only after the data is visible to others
+        bump_versions(flushed_users)
+        send_crossings(crossings)
+        return True
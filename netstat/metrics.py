@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010-2011 Andrew Grigorev <andrew@ei-grad.ru>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Counters, gauges and histograms exported in Prometheus text format.
+"""
+
+import os
+
+from bisect import bisect_left
+
+
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=SECONDS_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics(object):
+    """
+    Registry of metrics sharing a common name prefix and labels.
+    """
+
+    def __init__(self, prefix, labels=None):
+        self.prefix = prefix
+        self.labels = labels or {}
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        self.gauges[name] = value
+
+    def observe(self, name, value):
+        try:
+            self.histograms[name].observe(value)
+        except KeyError:
+            self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+    def _labels(self, extra=None):
+        labels = dict(self.labels)
+        if extra:
+            labels.update(extra)
+        if not labels:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % i for i in sorted(labels.items()))
+
+    def render(self):
+        """
+        Get metrics in Prometheus text exposition format.
+        """
+
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            name = '%s_%s_total' % (self.prefix, name)
+            lines.append('# TYPE %s counter' % name)
+            lines.append('%s%s %s' % (name, self._labels(), value))
+        for name, value in sorted(self.gauges.items()):
+            name = '%s_%s' % (self.prefix, name)
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s%s %s' % (name, self._labels(), value))
+        for name, hist in sorted(self.histograms.items()):
+            name = '%s_%s' % (self.prefix, name)
+            lines.append('# TYPE %s histogram' % name)
+            count = 0
+            for le, n in zip(hist.buckets, hist.counts):
+                count += n
+                lines.append('%s_bucket%s %d' % (name,
+                    self._labels({'le': repr(float(le))}), count))
+            lines.append('%s_bucket%s %d' % (name,
+                self._labels({'le': '+Inf'}), hist.count))
+            lines.append('%s_sum%s %s' % (name, self._labels(), repr(hist.sum)))
+            lines.append('%s_count%s %d' % (name, self._labels(), hist.count))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+        """
+        Atomically replace filename with rendered metrics, suitable for
+        node_exporter textfile collector.
+        """
+
+        tmp = '%s.%d.tmp' % (filename, os.getpid())
+        f = open(tmp, 'w')
+        f.write(self.render())
+        f.close()
+        os.rename(tmp, filename)
@@ -1,13 +1,204 @@
-from django.db import models
+from datetime import datetime, timedelta
+
+from django.db import models, connection
+from django.db.models.signals import post_save
 from django.contrib.auth.models import User
 
+from netstat import usage_cache
+
+
+class SessionManager(models.Manager):
+
+    def split(self, now=None, chunk=1000):
+        """
+        Finish all open sessions and start their successors at now.
+
+        Open sessions are selected and locked first, then they are split
+        by chunks with one UPDATE and one INSERT ... SELECT of exactly
+        those ids, both are logged to SessionChange the same way, so
+        sessions finished concurrently within the same second are left
+        alone. SessionChange older than a day is deleted, running
+        loggers have consumed it long ago. Should be called in a
+        transaction, cached usage of users should be invalidated after it
+        is committed.
+
+        Returns list of (src, session_id, user_id) of the new sessions.
+        """
+
+        if now is None:
+            now = datetime.now()
+        now = now.replace(microsecond=0)
+
+        qn = connection.ops.quote_name
+        tables = {
+            'session': qn(self.model._meta.db_table),
+            'change': qn(SessionChange._meta.db_table),
+        }
+
+        # concurrent logouts wait for the split to be committed
+        lock = ''
+        if connection.vendor != 'sqlite':
+            lock = ' FOR UPDATE'
+
+        cursor = connection.cursor()
+        cursor.execute('SELECT id, src FROM %(session)s'
+                ' WHERE dt_finish IS NULL AND dt_start < %%s' % tables + lock,
+                [now])
+        rows = cursor.fetchall()
+
+        new = []
+        for i in range(0, len(rows), chunk):
+            ids = [row[0] for row in rows[i:i + chunk]]
+            srcs = [row[1] for row in rows[i:i + chunk]]
+            tables['ids'] = ', '.join(['%s'] * len(ids))
+            tables['srcs'] = ', '.join(['%s'] * len(srcs))
+            # finish first, there may be only one open session per address
+            cursor.execute('UPDATE %(session)s SET dt_finish = %%s'
+                    ' WHERE id IN (%(ids)s)' % tables, [now] + ids)
+            cursor.execute('INSERT INTO %(session)s (user_id, src, dt_start)'
+                    ' SELECT user_id, src, %%s FROM %(session)s'
+                    ' WHERE id IN (%(ids)s)' % tables, [now] + ids)
+            cursor.execute('INSERT INTO %(change)s'
+                    ' (session_id, src, finished, dt)'
+                    ' SELECT id, src, %%s, %%s FROM %(session)s'
+                    ' WHERE id IN (%(ids)s)' % tables, [True, now] + ids)
+            # the only open sessions of the addresses are the successors
+            cursor.execute('SELECT src, id, user_id FROM %(session)s'
+                    ' WHERE dt_finish IS NULL AND dt_start = %%s'
+                    ' AND src IN (%(srcs)s)' % tables, [now] + srcs)
+            started = cursor.fetchall()
+            new.extend(started)
+            if not started:
+                continue
+            tables['ids'] = ', '.join(['%s'] * len(started))
+            cursor.execute('INSERT INTO %(change)s'
+                    ' (session_id, src, finished, dt)'
+                    ' SELECT id, src, %%s, %%s FROM %(session)s'
+                    ' WHERE id IN (%(ids)s)' % tables,
+                    [False, now] + [row[1] for row in started])
+        SessionChange.objects.filter(dt__lt=now - timedelta(days=1)).delete()
+
+        return new
+
 
 class Session(models.Model):
     user = models.ForeignKey(User)
     src = models.IPAddressField(db_index=True)
-    dt_start = models.DateTimeField(auto_now=True)
+    dt_start = models.DateTimeField(auto_now_add=True)
     dt_finish = models.DateTimeField(null=True, db_index=True)
 
+    objects = SessionManager()
+
+    def finish(self, when=None):
+        """
+        Finish session with a single UPDATE.
+
+        Returns False if session was already finished, e.g. by a
+        concurrent logout, the change is logged by the one who finished
+        it then.
+        """
+
+        if when is None:
+            when = datetime.now()
+        if not Session.objects.filter(id=self.id, dt_finish=None
+                ).update(dt_finish=when):
+            return False
+        self.dt_finish = when
+        log_session_change(Session, self)
+        return True
+
+
+class TrafficManager(models.Manager):
+    """
+    Manager of models with traf_in and traf_out counters, which are
+    incremented in bulk.
+
+    Subclasses set keys to names of fields identifying a row.
+    """
+
+    keys = ()
+
+    # rows per statement, keeps sqlite under its 999 parameters limit
+    batch_size = 100
+
+    def supports_upsert(self):
+        """
+        Check if database can INSERT ... ON CONFLICT DO UPDATE.
+        """
+
+        if connection.vendor == 'postgresql':
+            connection.cursor()
+            # only psycopg2 tells the server version
+            version = getattr(connection.connection, 'server_version', 0)
+            return version >= 90500
+        if connection.vendor == 'sqlite':
+            from django.db.backends.sqlite3.base import Database
+            return Database.sqlite_version_info >= (3, 24, 0)
+        return connection.vendor == 'mysql'
+
+    def add_traffic(self, deltas):
+        """
+        Add traffic to rows, creating missing ones.
+
+        @param deltas:
+            dict {(key values): [traf_in, traf_out]}
+        """
+
+        items = [key + tuple(traf) for key, traf in deltas.items()]
+
+        if self.supports_upsert():
+            add = self._upsert
+        else:
+            add = self._update_or_insert
+
+        cursor = connection.cursor()
+        for i in range(0, len(items), self.batch_size):
+            add(cursor, items[i:i + self.batch_size])
+
+    def _columns(self):
+        qn = connection.ops.quote_name
+        return [qn(self.model._meta.get_field(key).column) for key in self.keys]
+
+    def _upsert(self, cursor, items):
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        columns = self._columns()
+        row = '(%s)' % ', '.join(['%s'] * (len(columns) + 2))
+        sql = 'INSERT INTO %s (%s, traf_in, traf_out) VALUES %s' % (
+                table, ', '.join(columns), ', '.join([row] * len(items)))
+        if connection.vendor == 'mysql':
+            sql += (' ON DUPLICATE KEY UPDATE'
+                    ' traf_in = traf_in + VALUES(traf_in),'
+                    ' traf_out = traf_out + VALUES(traf_out)')
+        else:
+            sql += (' ON CONFLICT (%(columns)s) DO UPDATE SET'
+                    ' traf_in = %(table)s.traf_in + excluded.traf_in,'
+                    ' traf_out = %(table)s.traf_out + excluded.traf_out'
+                    % {'table': table, 'columns': ', '.join(columns)})
+        cursor.execute(sql, [i for item in items for i in item])
+
+    def _update_or_insert(self, cursor, items):
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        columns = self._columns()
+        n = len(columns)
+        lookup = dict(('%s__in' % key, list(set(item[i] for item in items)))
+                for i, key in enumerate(self.keys))
+        existing = set(self.filter(**lookup).values_list(*self.keys))
+        update = [item[n:] + item[:n] for item in items if item[:n] in existing]
+        insert = [item for item in items if item[:n] not in existing]
+        if update:
+            cursor.executemany('UPDATE %s SET traf_in = traf_in + %%s,'
+                    ' traf_out = traf_out + %%s WHERE %s' % (table,
+                        ' AND '.join('%s = %%s' % i for i in columns)), update)
+        if insert:
+            cursor.executemany('INSERT INTO %s (%s, traf_in, traf_out)'
+                    ' VALUES (%s)' % (table, ', '.join(columns),
+                        ', '.join(['%s'] * (n + 2))), insert)
+
+
+class RecordManager(TrafficManager):
+
+    keys = ('session', 'dst')
+
 
 class Record(models.Model):
     session = models.ForeignKey(Session)
@@ -15,3 +206,181 @@ class Record(models.Model):
     traf_in = models.BigIntegerField(default=0)
     traf_out = models.BigIntegerField(default=0)
 
+    objects = RecordManager()
+
+    class Meta:
+        unique_together = (('session', 'dst'),)
+
+
+HOUR = 'h'
+DAY = 'd'
+MONTH = 'm'
+
+PERIODS = (
+    (HOUR, 'hour'),
+    (DAY, 'day'),
+    (MONTH, 'month'),
+)
+
+
+def period_start(period, dt):
+    """
+    Get start of period containing dt.
+    """
+
+    dt = dt.replace(minute=0, second=0, microsecond=0)
+    if period == HOUR:
+        return dt
+    dt = dt.replace(hour=0)
+    if period == DAY:
+        return dt
+    return dt.replace(day=1)
+
+
+def next_period_start(period, dt):
+    """
+    Get start of period following the one containing dt.
+    """
+
+    dt = period_start(period, dt)
+    if period == HOUR:
+        return dt + timedelta(hours=1)
+    if period == DAY:
+        return dt + timedelta(days=1)
+    if dt.month == 12:
+        return dt.replace(year=dt.year + 1, month=1)
+    return dt.replace(month=dt.month + 1)
+
+
+class UsageRollupManager(TrafficManager):
+
+    keys = ('user', 'period', 'start', 'dst')
+
+    def add_session_traffic(self, deltas, users, when=None):
+        """
+        Add traffic of sessions to hour, day and month rollups.
+
+        @param deltas:
+            dict {(session_id, dst): [traf_in, traf_out]}
+        @param users:
+            dict {session_id: user_id}
+        @param when:
+            datetime to account traffic at, now by default
+        """
+
+        if when is None:
+            when = datetime.now()
+        starts = [(period, period_start(period, when)) for period, name in PERIODS]
+
+        rollups = {}
+        for (session, dst), traf in deltas.items():
+            user = users[session]
+            for period, start in starts:
+                for key in ((user, period, start, dst), (user, period, start, '')):
+                    try:
+                        rollup = rollups[key]
+                        rollup[0] += traf[0]
+                        rollup[1] += traf[1]
+                    except KeyError:
+                        rollups[key] = list(traf)
+
+        self.add_traffic(rollups)
+
+    def rebuild(self, users=None, dt_from=None, dt_to=None, chunk=1000):
+        """
+        Replace rollups with ones computed from Records.
+
+        Records have no time, traffic of a session is accounted at its
+        start. Whole months are rebuilt, so day and month rollups contain
+        all sessions of them. Should be called in a transaction.
+
+        @param users:
+            ids of users to rebuild rollups of, all by default
+        @param dt_from, dt_to:
+            rebuild months from the one of dt_from to the one of dt_to,
+            all by default
+        @param chunk:
+            number of sessions to read records of per query
+
+        Returns number of sessions.
+        """
+
+        sessions = Session.objects.all()
+        rollups = self.all()
+        if users is not None:
+            sessions = sessions.filter(user__in=users)
+            rollups = rollups.filter(user__in=users)
+        if dt_from is not None:
+            dt_from = period_start(MONTH, dt_from)
+            sessions = sessions.filter(dt_start__gte=dt_from)
+            rollups = rollups.filter(start__gte=dt_from)
+        if dt_to is not None:
+            dt_to = next_period_start(MONTH, dt_to)
+            sessions = sessions.filter(dt_start__lt=dt_to)
+            rollups = rollups.filter(start__lt=dt_to)
+        rollups.delete()
+
+        sessions = list(sessions.values_list('id', 'user', 'dt_start'))
+        for i in range(0, len(sessions), chunk):
+            part = sessions[i:i + chunk]
+            users = dict((id, user) for id, user, dt_start in part)
+            hours = dict((id, period_start(HOUR, dt_start))
+                    for id, user, dt_start in part)
+            deltas = {}
+            for session, dst, traf_in, traf_out in Record.objects.filter(
+                    session__in=users.keys()).values_list('session', 'dst',
+                        'traf_in', 'traf_out'):
+                deltas.setdefault(hours[session], {})[session, dst] = \
+                        [traf_in, traf_out]
+            for hour, hour_deltas in deltas.items():
+                self.add_session_traffic(hour_deltas, users, hour)
+        return len(sessions)
+
+
+class UsageRollup(models.Model):
+    """
+    Traffic of user per period, to the destination dst or in total if dst
+    is empty.
+    """
+
+    user = models.ForeignKey(User)
+    period = models.CharField(max_length=1, choices=PERIODS)
+    start = models.DateTimeField()
+    dst = models.CharField(max_length=64, blank=True)
+    traf_in = models.BigIntegerField(default=0)
+    traf_out = models.BigIntegerField(default=0)
+
+    objects = UsageRollupManager()
+
+    class Meta:
+        unique_together = (('user', 'period', 'start', 'dst'),)
+
+
+class JournalCheckpoint(models.Model):
+    """
+    The last batch of journal written to database, see netstat.journal.
+    """
+
+    journal = models.CharField(max_length=255, unique=True)
+    batch = models.BigIntegerField()
+
+
+class SessionChange(models.Model):
+    """
+    Feed of started and finished sessions.
+
+    Conntrack logger reads it to keep its in-memory session index up to
+    date without querying Session for every event.
+    """
+    session = models.ForeignKey(Session)
+    src = models.IPAddressField()
+    finished = models.BooleanField(default=False)
+    dt = models.DateTimeField(auto_now_add=True, db_index=True)
+
+
+def log_session_change(sender, instance, **kwargs):
+    SessionChange(session=instance, src=instance.src,
+            finished=instance.dt_finish is not None).save()
+    usage_cache.bump_versions([instance.user_id])
+
+post_save.connect(log_session_change, sender=Session)
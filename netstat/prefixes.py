@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010-2011 Andrew Grigorev <andrew@ei-grad.ru>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Aggregation of destination addresses to prefixes.
+"""
+
+from netstat.rawstat import ip2int, int2ip, is_ipv6
+
+
+# labels are stored in Record.dst
+MAX_LABEL_LENGTH = 64
+
+
+def parse_prefix(prefix):
+    """
+    Parse 'a.b.c.d/len' to tuple (network, len).
+    """
+
+    if '/' in prefix:
+        ip, length = prefix.split('/')
+        length = int(length)
+    else:
+        ip, length = prefix, 32
+    if not 0 <= length <= 32:
+        raise ValueError('bad prefix length: %s' % prefix)
+    return ip2int(ip) & mask(length), length
+
+
+def mask(length):
+    return (0xffffffff << (32 - length)) & 0xffffffff
+
+
+def load_prefixes(filename):
+    """
+    Read prefix list from file.
+
+    Each line contains prefix and optional label, e.g. provider or AS
+    name. Empty lines and lines starting with # are ignored.
+
+    Raises ValueError if a label is longer than MAX_LABEL_LENGTH.
+
+    Returns list of (prefix, label) tuples.
+    """
+
+    prefixes = []
+    for number, line in enumerate(open(filename), 1):
+        line = line.split('#', 1)[0].split()
+        if not line:
+            continue
+        if len(line) > 1:
+            prefix, label = line[0], line[1]
+        else:
+            prefix, label = line[0], line[0]
+        if len(label) > MAX_LABEL_LENGTH:
+            raise ValueError('%s:%d: label is longer than %d characters' % (
+                filename, number, MAX_LABEL_LENGTH))
+        prefixes.append((prefix, label))
+    return prefixes
+
+
+class PrefixTable(object):
+    """
+    Binary trie for longest prefix match of IPv4 addresses.
+
+    Node is a list [child for bit 0, child for bit 1, value], lookup
+    takes at most 32 steps whatever the number of prefixes is.
+    """
+
+    def __init__(self, prefixes=()):
+        self.root = [None, None, None]
+        self.size = 0
+        for prefix, value in prefixes:
+            self.add(prefix, value)
+
+    def __len__(self):
+        return self.size
+
+    def add(self, prefix, value):
+        network, length = parse_prefix(prefix)
+        node = self.root
+        for i in range(length):
+            bit = (network >> (31 - i)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        if node[2] is None:
+            self.size += 1
+        node[2] = value
+
+    def lookup(self, ip):
+        """
+        Get value of the longest prefix containing ip (integer), None if
+        there is no such prefix.
+        """
+
+        node = self.root
+        value = node[2]
+        shift = 31
+        while shift >= 0:
+            node = node[(ip >> shift) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                value = node[2]
+            shift -= 1
+        return value
+
+
+class DstAggregator(object):
+    """
+    Maps destination address to the key Records are accounted by.
+
+    Address is mapped to the label of the longest matching prefix from
+    the prefix list, addresses not covered by the list are truncated to
+    prefix_len bits ('a.b.c.0/24') or kept as is when prefix_len is 32.
+    IPv6 addresses are kept as is.
+    """
+
+    def __init__(self, prefix_len=32, prefixes=()):
+        """
+        Create new DstAggregator object.
+
+        @param prefix_len:
+            prefix length for addresses not covered by prefixes
+        @param prefixes:
+            iterable of (prefix, label) tuples
+        """
+
+        if not 0 <= prefix_len <= 32:
+            raise ValueError('bad prefix length: %d' % prefix_len)
+        self.prefix_len = prefix_len
+        self.mask = mask(prefix_len)
+        self.table = PrefixTable(prefixes)
+
+    def aggregate(self, dst):
+        if self.prefix_len == 32 and not self.table.size or is_ipv6(dst):
+            return dst
+        return self.aggregate_int(ip2int(dst), dst)
+
+    def aggregate_int(self, ip, dst=None):
+        if self.table.size:
+            label = self.table.lookup(ip)
+            if label is not None:
+                return label
+        if self.prefix_len == 32:
+            return dst or int2ip(ip)
+        return '%s/%d' % (int2ip(ip & self.mask), self.prefix_len)
@@ -0,0 +1,491 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010-2011 Andrew Grigorev <andrew@ei-grad.ru>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Binary archive of raw statistics.
+
+Archive is a sequence of segment files, one per hour (or less, if a
+segment grows over the size limit). Segment starts with MAGIC followed
+by fixed-width records:
+
+    timestamp   uint32
+    proto       uint8
+    src         uint32
+    sport       uint16
+    dst         uint32
+    dport       uint16
+    bytes_in    uint64
+    bytes_out   uint64
+
+all in network byte order. Closed segments may be gzipped.
+
+Closed segments may have a sidecar index <segment>.idx (without .gz),
+for looking up records of an address without reading whole segments.
+Records of a segment are grouped in blocks of INDEX_BLOCK records, the
+index consists of:
+
+    INDEX_MAGIC
+    header      INDEX_HEADER: records per block, time range of
+                segment, number of blocks and of entries of both tables
+    blocks      BLOCK_ENTRY per block: time range of its records
+    dst table   ADDRESS_ENTRY per distinct (dst, block), sorted
+    src table   ADDRESS_ENTRY per distinct (src, block), sorted
+
+It is read through mmap, a lookup takes a binary search per table.
+"""
+
+import os
+import gzip
+import mmap
+import struct
+import socket
+import logging
+
+from bisect import bisect_left
+
+from time import strftime, localtime
+from threading import Thread
+
+
+MAGIC = 'TASRAW\x00\x01'
+
+RECORD = struct.Struct('!IBIHIHQQ')
+
+PROTOCOLS = {'icmp': 1, 'tcp': 6, 'udp': 17, 'gre': 47, 'esp': 50,
+        'sctp': 132, 'udplite': 136}
+
+PROTOCOL_NAMES = dict((v, k) for k, v in PROTOCOLS.items())
+
+# stored for protocols which are neither known by name nor numeric
+UNKNOWN_PROTOCOL = 255
+
+INDEX_MAGIC = 'TASIDX\x00\x01'
+
+INDEX_HEADER = struct.Struct('!IIIIII')
+
+BLOCK_ENTRY = struct.Struct('!II')
+
+ADDRESS_ENTRY = struct.Struct('!II')
+
+# records per indexed block
+INDEX_BLOCK = 1024
+
+
+def ip2int(ip):
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+def is_ipv6(ip):
+    return ':' in ip
+
+
+def int2ip(i):
+    return socket.inet_ntoa(struct.pack('!I', i))
+
+
+def proto2int(proto):
+    try:
+        return PROTOCOLS[proto]
+    except KeyError:
+        pass
+    try:
+        return int(proto)
+    except ValueError:
+        logging.warning('unknown protocol %r is stored as %d' % (proto,
+            UNKNOWN_PROTOCOL))
+        return UNKNOWN_PROTOCOL
+
+
+def event_protocol(event, proto):
+    """
+    Get protocol of plaintext event, its number is taken if the name is
+    not known, e.g. for 'dccp     33 src=...' or 'unknown  41 src=...'.
+    """
+
+    if proto in PROTOCOLS:
+        return proto
+    fields = event.split(None, 4)
+    if proto in fields:
+        i = fields.index(proto) + 1
+        if i < len(fields) and fields[i].isdigit():
+            return fields[i]
+    return proto
+
+
+def int2proto(i):
+    return PROTOCOL_NAMES.get(i, str(i))
+
+
+def pack(timestamp, proto, src, sport, dst, dport, bytes_in, bytes_out):
+    return RECORD.pack(int(timestamp), proto2int(proto), ip2int(src),
+            int(sport), ip2int(dst), int(dport), int(bytes_in), int(bytes_out))
+
+
+class RawStatWriter(object):
+    """
+    Writes raw statistics to rotating segments named
+    <basename>.<YYYYmmddHH>[.<N>].
+    """
+
+    def __init__(self, basename, max_size=None, compress=False,
+            block_size=4096, index=False):
+        """
+        Create new RawStatWriter object.
+
+        @param basename:
+            path prefix of segment files
+        @param max_size:
+            start a new segment when current one exceeds this size in bytes
+        @param compress:
+            gzip closed segments in background
+        @param block_size:
+            number of records buffered before writing to file
+        @param index:
+            build indexes of closed segments in background
+        """
+
+        self.basename = basename
+        self.max_size = max_size
+        self.compress = compress
+        self.index = index
+        self.block_size = block_size
+
+        self.buffer = []
+        self.file = None
+        self.hour = None
+        self.size = 0
+
+    def write(self, timestamp, proto, src, sport, dst, dport, bytes_in,
+            bytes_out):
+        """
+        Add record to archive.
+        """
+
+        hour = strftime('%Y%m%d%H', localtime(timestamp))
+        if hour != self.hour or (self.max_size is not None and
+                self.size >= self.max_size):
+            self.rotate(hour)
+
+        self.buffer.append(pack(timestamp, proto, src, sport, dst, dport,
+            bytes_in, bytes_out))
+
+        if len(self.buffer) >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write buffered records to current segment.
+        """
+
+        if self.buffer:
+            data = ''.join(self.buffer)
+            self.buffer = []
+            self.file.write(data)
+            self.size += len(data)
+        if self.file is not None:
+            self.file.flush()
+
+    def rotate(self, hour):
+        self.close()
+
+        name = '%s.%s' % (self.basename, hour)
+        n = 0
+        while os.path.exists(name) or os.path.exists(name + '.gz'):
+            n += 1
+            name = '%s.%s.%d' % (self.basename, hour, n)
+
+        logging.debug('raw statistics: starting segment %s' % name)
+
+        self.hour = hour
+        self.file = open(name, 'wb')
+        self.file.write(MAGIC)
+        self.size = len(MAGIC)
+
+    def close(self):
+        """
+        Flush and close current segment.
+        """
+
+        self.flush()
+        if self.file is None:
+            return
+        self.file.close()
+        if self.compress or self.index:
+            thread = Thread(target=close_segment, args=(self.file.name,
+                self.index, self.compress))
+            thread.start()
+        self.file = None
+
+
+def close_segment(name, index, compress):
+    """
+    Build index of closed segment and compress it.
+    """
+
+    if index:
+        build_index(name)
+    if compress:
+        compress_segment(name)
+
+
+def compress_segment(name):
+    """
+    Replace closed segment with its gzipped copy.
+    """
+
+    src = open(name, 'rb')
+    dst = gzip.open(name + '.gz.tmp', 'wb')
+    while True:
+        data = src.read(1 << 20)
+        if not data:
+            break
+        dst.write(data)
+    dst.close()
+    src.close()
+    os.rename(name + '.gz.tmp', name + '.gz')
+    os.unlink(name)
+
+
+def open_segment(name):
+    if name.endswith('.gz'):
+        f = gzip.open(name, 'rb')
+    else:
+        f = open(name, 'rb')
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('%s is not a raw statistics segment' % name)
+    return f
+
+
+def read_segment(name, block_size=4096):
+    """
+    Iterate over records of segment.
+
+    Yields tuples (timestamp, proto, src, sport, dst, dport, bytes_in,
+    bytes_out) with protocols and addresses converted back to strings.
+    """
+
+    for rec in read_segment_raw(name, block_size):
+        timestamp, proto, src, sport, dst, dport, bytes_in, bytes_out = rec
+        yield (timestamp, int2proto(proto), int2ip(src), sport, int2ip(dst),
+                dport, bytes_in, bytes_out)
+
+
+def read_segment_raw(name, block_size=4096):
+    """
+    Iterate over records of segment as unpacked integer tuples.
+    """
+
+    f = open_segment(name)
+    size = RECORD.size
+    unpack_from = RECORD.unpack_from
+    try:
+        while True:
+            data = f.read(size * block_size)
+            if not data:
+                break
+            for offset in xrange(0, len(data) - len(data) % size, size):
+                yield unpack_from(data, offset)
+    finally:
+        f.close()
+
+
+def index_name(name):
+    """
+    Get name of index of segment.
+    """
+
+    if name.endswith('.gz'):
+        name = name[:-3]
+    return name + '.idx'
+
+
+def build_index(name, block_records=INDEX_BLOCK):
+    """
+    Write index of closed segment.
+    """
+
+    blocks = []
+    dst_entries = set()
+    src_entries = set()
+    block = -1
+    for i, rec in enumerate(read_segment_raw(name)):
+        if i % block_records == 0:
+            block += 1
+            blocks.append([rec[0], rec[0]])
+        times = blocks[block]
+        if rec[0] < times[0]:
+            times[0] = rec[0]
+        elif rec[0] > times[1]:
+            times[1] = rec[0]
+        src_entries.add((rec[2], block))
+        dst_entries.add((rec[4], block))
+
+    if blocks:
+        t_min = min(i[0] for i in blocks)
+        t_max = max(i[1] for i in blocks)
+    else:
+        t_min = t_max = 0
+
+    tmp = index_name(name) + '.tmp'
+    f = open(tmp, 'wb')
+    f.write(INDEX_MAGIC)
+    f.write(INDEX_HEADER.pack(block_records, t_min, t_max, len(blocks),
+        len(dst_entries), len(src_entries)))
+    f.write(''.join(BLOCK_ENTRY.pack(*i) for i in blocks))
+    f.write(''.join(ADDRESS_ENTRY.pack(*i) for i in sorted(dst_entries)))
+    f.write(''.join(ADDRESS_ENTRY.pack(*i) for i in sorted(src_entries)))
+    f.close()
+    os.rename(tmp, index_name(name))
+    logging.debug('raw statistics: %s indexed, %d blocks' % (name, len(blocks)))
+
+
+class AddressTable(object):
+    """
+    Sequence of addresses of index table, for bisect.
+    """
+
+    def __init__(self, data, offset, count):
+        self.data = data
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return ADDRESS_ENTRY.unpack_from(self.data,
+                self.offset + i * ADDRESS_ENTRY.size)[0]
+
+    def blocks(self, ip):
+        """
+        Get numbers of blocks containing ip.
+        """
+
+        i = bisect_left(self, ip)
+        while i < self.count:
+            entry_ip, block = ADDRESS_ENTRY.unpack_from(self.data,
+                    self.offset + i * ADDRESS_ENTRY.size)
+            if entry_ip != ip:
+                break
+            yield block
+            i += 1
+
+
+class SegmentIndex(object):
+    """
+    Memory-mapped index of segment.
+    """
+
+    def __init__(self, name):
+        """
+        Open index of segment.
+
+        @param name:
+            name of segment
+        """
+
+        f = open(index_name(name), 'rb')
+        try:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        if self.data[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            self.data.close()
+            raise ValueError('%s is not a raw statistics index' % name)
+
+        offset = len(INDEX_MAGIC)
+        (self.block_records, self.t_min, self.t_max, self.block_count,
+                dst_count, src_count) = INDEX_HEADER.unpack_from(self.data,
+                        offset)
+        self.blocks_offset = offset + INDEX_HEADER.size
+        offset = self.blocks_offset + self.block_count * BLOCK_ENTRY.size
+        self.dst = AddressTable(self.data, offset, dst_count)
+        offset += dst_count * ADDRESS_ENTRY.size
+        self.src = AddressTable(self.data, offset, src_count)
+
+    def close(self):
+        self.data.close()
+
+    def overlaps(self, t_from, t_to):
+        return self.block_count and self.t_min <= t_to and t_from <= self.t_max
+
+    def find_blocks(self, ip, t_from, t_to, src=True, dst=True):
+        """
+        Get sorted numbers of blocks having records of ip within time
+        range.
+        """
+
+        if not self.overlaps(t_from, t_to):
+            return []
+        blocks = set()
+        if dst:
+            blocks.update(self.dst.blocks(ip))
+        if src:
+            blocks.update(self.src.blocks(ip))
+        result = []
+        for block in sorted(blocks):
+            b_min, b_max = BLOCK_ENTRY.unpack_from(self.data,
+                    self.blocks_offset + block * BLOCK_ENTRY.size)
+            if b_min <= t_to and t_from <= b_max:
+                result.append(block)
+        return result
+
+
+def query_segment(name, ip, t_from, t_to, src=True, dst=True):
+    """
+    Iterate over records of segment with ip as src or dst within time
+    range, as unpacked integer tuples.
+
+    Only blocks listed in the index are read if segment has one.
+    """
+
+    ip = ip2int(ip)
+
+    def matches(rec):
+        return t_from <= rec[0] <= t_to and (
+                (src and rec[2] == ip) or (dst and rec[4] == ip))
+
+    if not os.path.exists(index_name(name)):
+        for rec in read_segment_raw(name):
+            if matches(rec):
+                yield rec
+        return
+
+    index = SegmentIndex(name)
+    try:
+        blocks = index.find_blocks(ip, t_from, t_to, src, dst)
+        block_records = index.block_records
+    finally:
+        index.close()
+    if not blocks:
+        return
+
+    size = RECORD.size
+    f = open_segment(name)
+    try:
+        for block in blocks:
+            # gzip files seek forward by decompressing
+            f.seek(len(MAGIC) + block * block_records * size)
+            data = f.read(block_records * size)
+            for offset in xrange(0, len(data) - len(data) % size, size):
+                rec = RECORD.unpack_from(data, offset)
+                if matches(rec):
+                    yield rec
+    finally:
+        f.close()
+
@@ -0,0 +1,255 @@
+"""
+Non-blocking reverse DNS resolver with cache.
+
+Lookups are done by a pool of threads, callers either take what is
+already cached (resolve) or wait for a batch of lookups for a limited
+time (resolve_many). Names and failures are cached with their own TTLs
+in an LRU cache, entries which are still used when they are about to
+expire are refreshed in background.
+"""
+
+import socket
+import struct
+import random
+
+from time import time
+from threading import Thread, Lock, Event
+from Queue import Queue
+from collections import OrderedDict
+
+
+def system_lookup(ip):
+    """
+    Resolve address with the system resolver.
+    """
+
+    return socket.gethostbyaddr(ip)[0]
+
+
+class DnsLookup(object):
+    """
+    Resolves addresses by querying PTR records from the DNS server
+    directly, so every lookup has a timeout.
+    """
+
+    def __init__(self, server=('127.0.0.1', 53), timeout=2.0):
+        self.server = server
+        self.timeout = timeout
+
+    def __call__(self, ip):
+        qid = random.randint(0, 0xffff)
+        query = struct.pack('!HHHHHH', qid, 0x0100, 1, 0, 0, 0)
+        for label in ip.split('.')[::-1] + ['in-addr', 'arpa']:
+            query += chr(len(label)) + label
+        query += '\0' + struct.pack('!HH', 12, 1)
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.settimeout(self.timeout)
+            sock.sendto(query, self.server)
+            deadline = time() + self.timeout
+            while True:
+                sock.settimeout(max(deadline - time(), 0.001))
+                data, addr = sock.recvfrom(4096)
+                if len(data) >= 12 and struct.unpack('!H', data[:2])[0] == qid:
+                    break
+        finally:
+            sock.close()
+
+        return parse_ptr_response(data)
+
+
+def read_name(data, offset):
+    """
+    Read domain name from DNS message.
+
+    Returns tuple (name, offset after the name).
+    """
+
+    labels = []
+    end = None
+    for i in range(128):
+        length = ord(data[offset])
+        if length & 0xc0 == 0xc0:
+            if end is None:
+                end = offset + 2
+            offset = struct.unpack('!H', data[offset:offset + 2])[0] & 0x3fff
+        elif length == 0:
+            if end is None:
+                end = offset + 1
+            return '.'.join(labels), end
+        else:
+            labels.append(data[offset + 1:offset + 1 + length])
+            offset += 1 + length
+    raise ValueError('too long name')
+
+
+def parse_ptr_response(data):
+    """
+    Get name from the first PTR record of DNS response.
+    """
+
+    qid, flags, qdcount, ancount, nscount, arcount = struct.unpack(
+            '!HHHHHH', data[:12])
+    if flags & 0xf:
+        raise socket.herror('DNS error %d' % (flags & 0xf))
+
+    offset = 12
+    for i in range(qdcount):
+        offset = read_name(data, offset)[1] + 4
+    for i in range(ancount):
+        offset = read_name(data, offset)[1]
+        rtype, rclass, ttl, rdlength = struct.unpack('!HHIH',
+                data[offset:offset + 10])
+        offset += 10
+        if rtype == 12:
+            return read_name(data, offset)[0]
+        offset += rdlength
+    raise socket.herror('no PTR record')
+
+
+class Resolver(object):
+
+    def __init__(self, lookup=system_lookup, size=10000, ttl=3600,
+            negative_ttl=300, threads=4):
+        """
+        Create new Resolver object.
+
+        @param lookup:
+            function returning name of address, raising exception if it
+            can't be resolved
+        @param size:
+            maximum number of cached entries
+        @param ttl:
+            seconds to cache names for
+        @param negative_ttl:
+            seconds to cache failed lookups for
+        @param threads:
+            number of lookup threads
+        """
+
+        self.lookup = lookup
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.threads = threads
+
+        self.cache = OrderedDict() # ip -> (name or None, expires)
+        self.pending = {} # ip -> Event set when lookup is done
+        self.lock = Lock()
+        self.queue = Queue()
+        self.workers = []
+
+    def get(self, ip):
+        """
+        Get cached entry.
+
+        Returns tuple (hit, name), name is None if address was not
+        resolved.
+        """
+
+        now = time()
+        with self.lock:
+            try:
+                name, expires = self.cache.pop(ip)
+            except KeyError:
+                return False, None
+            if expires <= now:
+                return False, None
+            self.cache[ip] = (name, expires)
+        if name is not None and expires - now < self.ttl / 10.0:
+            # refresh popular names before they expire
+            self.submit(ip)
+        return True, name
+
+    def resolve(self, ip):
+        """
+        Get name of ip if it is cached, otherwise start resolving it and
+        return ip.
+        """
+
+        if not is_ip(ip):
+            return ip
+        hit, name = self.get(ip)
+        if not hit:
+            self.submit(ip)
+        return name or ip
+
+    def resolve_many(self, ips, timeout):
+        """
+        Resolve addresses concurrently, waiting at most timeout seconds
+        in total.
+
+        Returns dict {ip: name or ip}, lookups which didn't finish in
+        time are left running and are cached for the next calls.
+        """
+
+        result = {}
+        waiting = {}
+        for ip in set(ips):
+            if not is_ip(ip):
+                result[ip] = ip
+                continue
+            hit, name = self.get(ip)
+            if hit:
+                result[ip] = name or ip
+            else:
+                waiting[ip] = self.submit(ip)
+
+        deadline = time() + timeout
+        for ip, event in waiting.items():
+            event.wait(max(deadline - time(), 0))
+            hit, name = self.get(ip)
+            result[ip] = name or ip
+        return result
+
+    def submit(self, ip):
+        """
+        Start lookup of ip if it is not in progress.
+
+        Returns Event which is set when the lookup is done.
+        """
+
+        with self.lock:
+            event = self.pending.get(ip)
+            if event is not None:
+                return event
+            event = self.pending[ip] = Event()
+            if len(self.workers) < self.threads:
+                worker = Thread(target=self.work)
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+        self.queue.put(ip)
+        return event
+
+    def work(self):
+        while True:
+            ip = self.queue.get()
+            try:
+                name = self.lookup(ip)
+            except Exception:
+                name = None
+            self.store(ip, name)
+
+    def store(self, ip, name):
+        if name is None:
+            expires = time() + self.negative_ttl
+        else:
+            expires = time() + self.ttl
+        with self.lock:
+            self.cache.pop(ip, None)
+            self.cache[ip] = (name, expires)
+            while len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+            event = self.pending.pop(ip, None)
+        if event is not None:
+            event.set()
+
+
+def is_ip(ip):
+    try:
+        socket.inet_aton(ip)
+    except socket.error:
+        return False
+    return ip.count('.') == 3
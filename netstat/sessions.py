@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010-2011 Andrew Grigorev <andrew@ei-grad.ru>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Resident index of open sessions.
+"""
+
+import logging
+
+from threading import Lock
+
+from django.db.models import Max
+from netstat.models import Session, SessionChange
+from netstat.shards import shard_of
+
+
+class SessionIndex(object):
+    """
+    Resident map of source address to the id of its open Session.
+
+    The index is loaded once and then kept up to date by consuming the
+    SessionChange feed, so looking up a session costs no queries. It may
+    be refreshed by another thread than the one looking sessions up.
+    """
+
+    # ids of SessionChange are taken before commit, so a change may
+    # become visible after ones with greater ids; changes this many ids
+    # behind the last one are read again to catch such ones
+    window = 100
+
+    def __init__(self, shard=None):
+        """
+        Create new SessionIndex object.
+
+        @param shard:
+            tuple (shard, shards), if given only sessions of this shard
+            are kept
+        """
+
+        self.shard = shard
+        self.sessions = {}
+        self.users = {}
+        self.last_change = 0
+        self.seen = set()
+        self.lock = Lock()
+
+    def in_shard(self, src):
+        return self.shard is None or shard_of(src, self.shard[1]) == self.shard[0]
+
+    def load(self):
+        """
+        Load all open sessions from database.
+        """
+
+        # remember the feed position first, changes made while loading
+        # would be replayed by the next refresh()
+        self.last_change = SessionChange.objects.aggregate(
+                Max('id'))['id__max'] or 0
+        self.seen = set(SessionChange.objects.filter(
+            id__gt=self.last_change - self.window, id__lte=self.last_change
+            ).values_list('id', flat=True))
+        self.sessions = {}
+        self.users = {}
+        for src, session_id, user_id in Session.objects.filter(dt_finish=None
+                ).values_list('src', 'id', 'user'):
+            if self.in_shard(src):
+                self.sessions[src] = session_id
+                self.users[session_id] = user_id
+        logging.debug('session index loaded: %d open sessions' % len(self.sessions))
+
+    def refresh(self):
+        """
+        Apply changes made since the last load() or refresh().
+
+        If a change behind the last applied one has appeared, all changes
+        of the window are applied again in order of ids.
+        """
+
+        changes = list(SessionChange.objects.filter(
+            id__gt=self.last_change - self.window).order_by('id').values_list(
+                'id', 'session', 'src', 'finished', 'session__user'))
+
+        late = [i for i in changes
+                if i[0] < self.last_change and i[0] not in self.seen]
+        if late:
+            logging.warning('%d session changes have appeared late' % len(late))
+        else:
+            changes = [i for i in changes if i[0] > self.last_change]
+
+        with self.lock:
+            for change_id, session_id, src, finished, user_id in changes:
+                self.last_change = max(self.last_change, change_id)
+                self.seen.add(change_id)
+                if not self.in_shard(src):
+                    continue
+                if finished:
+                    if self.sessions.get(src) == session_id:
+                        del self.sessions[src]
+                else:
+                    self.sessions[src] = session_id
+                    self.users[session_id] = user_id
+
+        if changes:
+            self.seen = set(i for i in self.seen
+                    if i > self.last_change - self.window)
+
+    def get(self, src):
+        return self.sessions.get(src)
+
+    def replace(self, sessions):
+        """
+        Put new sessions to index.
+
+        @param sessions:
+            iterable of (src, session_id, user_id)
+        """
+
+        with self.lock:
+            for src, session_id, user_id in sessions:
+                if self.in_shard(src):
+                    self.sessions[src] = session_id
+                    self.users[session_id] = user_id
+
+    def prune_users(self):
+        """
+        Forget users of finished sessions, traffic of a session may be
+        flushed after it is finished, so it is done after flush.
+        """
+
+        with self.lock:
+            if len(self.users) > len(self.sessions):
+                self.users = dict((i, self.users[i])
+                        for i in self.sessions.values())
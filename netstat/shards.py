@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2010-2011 Andrew Grigorev <andrew@ei-grad.ru>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Sharding of conntrack events by subscriber address.
+"""
+
+from zlib import crc32
+
+
+def shard_of(src, shards):
+    """
+    Get number of shard which handles subscriber address src.
+    """
+
+    return crc32(src) % shards
+
+
+def event_sources(event):
+    """
+    Get source addresses of both directions of plaintext event without
+    parsing it completely.
+    """
+
+    start = event.find('src=') + 4
+    orig = event[start:event.find(' ', start)]
+    start = event.find('src=', start) + 4
+    reply = event[start:event.find(' ', start)]
+    return orig, reply
@@ -0,0 +1,2 @@
+-- At most one open session per address, start_session() relies on it.
+CREATE UNIQUE INDEX netstat_session_open_src ON netstat_session (src) WHERE dt_finish IS NULL;
@@ -1,19 +1,74 @@
-from socket import gethostbyaddr
-
 from django.conf import settings
 
 from django import template
 from django.template.defaultfilters import stringfilter
 
+from netstat.resolver import Resolver, DnsLookup, system_lookup
+
 register = template.Library()
 
+_resolver = None
+
+def get_resolver():
+    global _resolver
+    if _resolver is None:
+        server = getattr(settings, 'RESOLV_IP_SERVER', None)
+        if server is None:
+            lookup = system_lookup
+        else:
+            lookup = DnsLookup(server, getattr(settings, 'RESOLV_IP_TIMEOUT', 2.0))
+        _resolver = Resolver(lookup,
+                size=getattr(settings, 'RESOLV_IP_CACHE_SIZE', 10000),
+                ttl=getattr(settings, 'RESOLV_IP_TTL', 3600),
+                negative_ttl=getattr(settings, 'RESOLV_IP_NEGATIVE_TTL', 300),
+                threads=getattr(settings, 'RESOLV_IP_THREADS', 4))
+    return _resolver
+
 @register.filter(name='resolv_ip')
 @stringfilter
 def resolv_ip(ip):
+    """
+    Get name of ip from cache, never waits for DNS. Use resolv_ips tag
+    to resolve addresses of a page beforehand.
+    """
     if settings.RESOLV_IP == True:
-        try:
-            return gethostbyaddr(ip)[0]
-        except:
-            pass
+        return get_resolver().resolve(ip)
     return ip
 
+
+class ResolvIpsNode(template.Node):
+
+    def __init__(self, lists):
+        self.lists = [template.Variable(i) for i in lists]
+
+    def render(self, context):
+        if settings.RESOLV_IP != True:
+            return ''
+        ips = []
+        for var in self.lists:
+            try:
+                items = var.resolve(context)
+            except template.VariableDoesNotExist:
+                continue
+            for i in items or ():
+                if isinstance(i, dict):
+                    ips.append(i['dst'])
+                else:
+                    ips.append(i.dst)
+        get_resolver().resolve_many(ips,
+                getattr(settings, 'RESOLV_IP_RENDER_BUDGET', 0.5))
+        return ''
+
+@register.tag
+def resolv_ips(parser, token):
+    """
+    Resolve dst addresses of all items of the given lists concurrently,
+    waiting at most RESOLV_IP_RENDER_BUDGET seconds.
+
+    {% resolv_ips top10_session top10_month %}
+    """
+    bits = token.split_contents()
+    if len(bits) < 2:
+        raise template.TemplateSyntaxError(
+                '%r tag requires at least one argument' % bits[0])
+    return ResolvIpsNode(bits[1:])
@@ -5,7 +5,42 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
+from datetime import datetime, timedelta
+from time import mktime, time, sleep
+from threading import Thread
+import socket
+import struct
+import logging
+from tempfile import TemporaryFile, mkdtemp
+from shutil import rmtree
+import os
+
 from django.test import TestCase
+from django.conf import settings
+from django.core.cache import get_cache
+from django.db import DatabaseError, IntegrityError
+from django.contrib.auth.models import User
+
+from netstat.models import Session, SessionChange, Record, UsageRollup, \
+        HOUR, DAY, MONTH
+from netstat.event_queue import EventQueue, DROP_OLDEST, SPILL
+from netstat.rawstat import RawStatWriter, read_segment, compress_segment, \
+        build_index, query_segment, SegmentIndex, index_name, ip2int, \
+        event_protocol, UNKNOWN_PROTOCOL
+from netstat.metrics import Metrics
+from netstat.prefixes import DstAggregator, load_prefixes
+from netstat import usage_cache
+from netstat.journal import Journal, JournalCommitter
+from netstat.resolver import Resolver, DnsLookup, read_name
+from netstat.capture import FileDump, DumpPoller, OverrunMonitor
+from netstat.shards import shard_of, event_sources
+from netstat.sessions import SessionIndex
+
+from replay_rawstat import SessionIntervals, replay
+import session_control
+from session_control import start_session, finish_session, \
+        finish_user_session, STARTED, ALREADY_STARTED, TAKEN
+
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -21,3 +56,876 @@ Another way to test that 1 + 1 is equal to 2.
 True
 """}
 
+
+class SessionChangeTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test')
+
+    def test_start_and_finish(self):
+        session = Session(user=self.user, src='10.0.0.1')
+        session.save()
+        session.dt_finish = datetime.now()
+        session.save()
+        self.assertEqual(list(SessionChange.objects.order_by('id'
+            ).values_list('session', 'src', 'finished')), [
+                (session.id, '10.0.0.1', False),
+                (session.id, '10.0.0.1', True),
+            ])
+
+
+class SessionSplitTest(TestCase):
+
+    def test_split(self):
+        user = User.objects.create(username='test')
+        t = datetime(2011, 3, 1, 12, 0)
+        sessions = []
+        for src in ('10.0.0.1', '10.0.0.2'):
+            session = Session.objects.create(user=user, src=src)
+            session.dt_start = t
+            session.save()
+            sessions.append(session)
+        finished = Session.objects.create(user=user, src='10.0.0.3',
+                dt_finish=t)
+        SessionChange.objects.all().delete()
+        old = SessionChange.objects.create(session=finished, src='10.0.0.3',
+                finished=True)
+        SessionChange.objects.filter(id=old.id).update(dt=t - timedelta(days=1))
+
+        now = t + timedelta(hours=1)
+        new = Session.objects.split(now)
+
+        self.assertEqual(sorted(src for src, session, user_id in new),
+                ['10.0.0.1', '10.0.0.2'])
+        for session in sessions:
+            self.assertEqual(Session.objects.get(id=session.id).dt_finish, now)
+        self.assertEqual(Session.objects.get(id=finished.id).dt_finish, t)
+        self.assertEqual(Session.objects.filter(dt_finish=None).count(), 2)
+        self.assertEqual(sorted(SessionChange.objects.values_list(
+            'session', 'finished')), sorted(
+                [(i.id, True) for i in sessions] +
+                [(session, False) for src, session, user_id in new]))
+
+    def test_same_second(self):
+        user = User.objects.create(username='test')
+        t = datetime(2011, 3, 1, 12, 0)
+        now = t + timedelta(hours=1)
+        session = Session.objects.create(user=user, src='10.0.0.1')
+        session.dt_start = t
+        session.save()
+        # finished by a logout within the second of split
+        closed = Session.objects.create(user=user, src='10.0.0.2')
+        closed.dt_start = t
+        closed.save()
+        closed.finish(now)
+
+        new = Session.objects.split(now)
+        self.assertEqual([src for src, session_id, user_id in new],
+                ['10.0.0.1'])
+        changes = SessionChange.objects.count()
+
+        # the second split within the second has nothing to do
+        self.assertEqual(Session.objects.split(now), [])
+        self.assertEqual(SessionChange.objects.count(), changes)
+        self.assertEqual(list(Session.objects.filter(dt_finish=None
+            ).values_list('src', flat=True)), ['10.0.0.1'])
+
+
+class SessionIndexTest(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+
+    def test_login_logout(self):
+        result, old = start_session(self.alice, '10.0.0.1')
+        index = SessionIndex()
+        index.load()
+        self.assertEqual(index.get('10.0.0.1'), old.id)
+
+        result, session = start_session(self.bob, '10.0.0.2')
+        index.refresh()
+        self.assertEqual(index.get('10.0.0.2'), session.id)
+        self.assertEqual(index.users[session.id], self.bob.id)
+
+        finish_user_session(self.bob, '10.0.0.2')
+        index.refresh()
+        self.assertEqual(index.get('10.0.0.2'), None)
+        # traffic of the finished session may be flushed yet
+        self.assertEqual(index.users[session.id], self.bob.id)
+        index.prune_users()
+        self.assertEqual(index.users, {old.id: self.alice.id})
+
+    def test_split(self):
+        for user, src in ((self.alice, '10.0.0.1'), (self.bob, '10.0.0.2')):
+            start_session(user, src)
+        index = SessionIndex()
+        index.load()
+
+        new = Session.objects.split(datetime.now() + timedelta(seconds=1))
+        index.replace(new)
+        for src, session_id, user_id in new:
+            self.assertEqual(index.get(src), session_id)
+            self.assertEqual(index.users[session_id], user_id)
+        # changes of the split are consistent with the replaced sessions
+        index.refresh()
+        self.assertEqual(sorted(index.sessions.items()),
+                sorted((src, session_id) for src, session_id, user_id in new))
+
+    def test_late_change(self):
+        index = SessionIndex()
+        index.load()
+        result, late = start_session(self.alice, '10.0.0.1')
+        result, session = start_session(self.bob, '10.0.0.2')
+
+        # the change of alice's login is committed after the one of bob's
+        change = SessionChange.objects.get(session=late)
+        SessionChange.objects.filter(id=change.id).delete()
+        index.refresh()
+        self.assertEqual(index.get('10.0.0.1'), None)
+        self.assertEqual(index.get('10.0.0.2'), session.id)
+
+        change.save()
+        logging.disable(logging.WARNING)
+        try:
+            index.refresh()
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(index.get('10.0.0.1'), late.id)
+        self.assertEqual(index.get('10.0.0.2'), session.id)
+
+
+class SessionControlTest(TestCase):
+
+    def test_start_finish(self):
+        alice = User.objects.create(username='alice')
+        bob = User.objects.create(username='bob')
+
+        result, session = start_session(alice, '10.0.0.1')
+        self.assertEqual(result, STARTED)
+        self.assertEqual(start_session(alice, '10.0.0.1'),
+                (ALREADY_STARTED, session))
+
+        result, taken = start_session(bob, '10.0.0.1')
+        self.assertEqual((result, taken), (TAKEN, session))
+        self.assertNotEqual(Session.objects.get(id=session.id).dt_finish, None)
+        self.assertEqual(Session.objects.filter(dt_finish=None).count(), 0)
+
+        result, session = start_session(bob, '10.0.0.1')
+        self.assertEqual(result, STARTED)
+        self.assertEqual(finish_user_session(alice, '10.0.0.1'), None)
+        self.assertEqual(finish_user_session(bob, '10.0.0.1'), session)
+        self.assertEqual(finish_user_session(bob, '10.0.0.1'), None)
+        self.assertEqual(list(SessionChange.objects.filter(session=session
+            ).values_list('finished', flat=True).order_by('id')), [False, True])
+
+        # concurrent logout has finished the session already
+        self.assertFalse(finish_session(session))
+        self.assertEqual(SessionChange.objects.filter(session=session).count(),
+                2)
+
+    def test_firewall_failure(self):
+        alice = User.objects.create(username='alice')
+        reloads = []
+        schedule_reload = session_control.schedule_reload
+        session_control.schedule_reload = lambda: reloads.append(True)
+        firewall, ipset = settings.FIREWALL, getattr(settings, 'IPSET', None)
+        settings.FIREWALL, settings.IPSET = True, '/nonexistent/ipset'
+        logging.disable(logging.ERROR)
+        try:
+            result, session = start_session(alice, '10.0.0.1')
+            self.assertEqual(result, STARTED)
+            self.assertEqual(finish_user_session(alice, '10.0.0.1'), session)
+        finally:
+            logging.disable(logging.NOTSET)
+            settings.FIREWALL, settings.IPSET = firewall, ipset
+            session_control.schedule_reload = schedule_reload
+        self.assertEqual(reloads, [True, True])
+
+
+class AddTrafficTest(TestCase):
+
+    def setUp(self):
+        user = User.objects.create(username='test')
+        self.session = Session(user=user, src='10.0.0.1')
+        self.session.save()
+
+    def check_add_traffic(self):
+        sid = self.session.id
+        Record.objects.add_traffic({(sid, '1.1.1.1'): [10, 1]})
+        Record.objects.add_traffic({(sid, '1.1.1.1'): [5, 2],
+                                    (sid, '2.2.2.2'): [7, 3]})
+        self.assertEqual(sorted(Record.objects.values_list(
+            'dst', 'traf_in', 'traf_out')), [
+                ('1.1.1.1', 15, 3),
+                ('2.2.2.2', 7, 3),
+            ])
+
+    def test_upsert(self):
+        if not Record.objects.supports_upsert():
+            return
+        self.check_add_traffic()
+
+    def test_update_or_insert(self):
+        supports_upsert = Record.objects.supports_upsert
+        Record.objects.supports_upsert = lambda: False
+        try:
+            self.check_add_traffic()
+        finally:
+            Record.objects.supports_upsert = supports_upsert
+
+
+class EventQueueTest(TestCase):
+
+    def test_drop_oldest(self):
+        queue = EventQueue(2, DROP_OLDEST)
+        for event in 'abc':
+            queue.put(event)
+        self.assertEqual(queue.get(), ['b', 'c'])
+        self.assertEqual((queue.enqueued, queue.dropped, queue.high_watermark),
+                (3, 1, 2))
+
+    def test_spill(self):
+        queue = EventQueue(2, SPILL, TemporaryFile())
+        for event in 'abcde':
+            queue.put(event)
+        self.assertEqual(len(queue), 5)
+        self.assertEqual(queue.get(), ['a', 'b'])
+        self.assertEqual(queue.get(), ['c', 'd'])
+        self.assertEqual(queue.get(), ['e'])
+        self.assertEqual(len(queue), 0)
+        self.assertEqual((queue.enqueued, queue.spilled, queue.dropped),
+                (5, 3, 0))
+
+
+class CaptureTest(TestCase):
+
+    def setUp(self):
+        self.dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def test_dump(self):
+        name = os.path.join(self.dir, 'dump')
+        f = open(name, 'w')
+        f.write('tcp      6 431999 ESTABLISHED src=10.0.0.1 dst=1.2.3.4'
+                ' sport=1024 dport=80 packets=3 bytes=300 src=1.2.3.4'
+                ' dst=10.0.0.1 sport=80 dport=1024 packets=4 bytes=5000'
+                ' [ASSURED] mark=0 use=1\n'
+                'udp      17 29 src=10.0.0.2 dst=8.8.8.8 sport=53 dport=53'
+                ' packets=0 bytes=0 src=8.8.8.8 dst=10.0.0.2 sport=53'
+                ' dport=53 packets=0 bytes=0 mark=0 use=1\n'
+                'conntrack v1.0.0 (conntrack-tools): 2 flow entries have'
+                ' been shown.\n')
+        f.close()
+
+        events = []
+        poller = DumpPoller(FileDump([name]), events.append)
+        self.assertEqual(poller.poll(), 1)
+        self.assertEqual(len(events), 1)
+        self.assertTrue(events[0].startswith('[UPDATE] tcp      6 '))
+        self.assertEqual(poller.poll(), 0)
+        self.assertEqual(poller.dumps, 2)
+
+        def fail():
+            raise OSError('conntrack failed')
+        logging.disable(logging.ERROR)
+        try:
+            self.assertEqual(DumpPoller(fail, events.append).poll(), 0)
+        finally:
+            logging.disable(logging.NOTSET)
+
+    def test_overrun(self):
+        netlink = os.path.join(self.dir, 'netlink')
+        fd_dir = os.path.join(self.dir, 'fd')
+        os.mkdir(fd_dir)
+        os.symlink('socket:[1001]', os.path.join(fd_dir, '3'))
+        os.symlink('/dev/null', os.path.join(fd_dir, '4'))
+
+        def write(drops):
+            f = open(netlink, 'w')
+            f.write('sk       Eth Pid    Groups   Rmem     Wmem     Dump'
+                    '     Locks     Drops     Inode\n')
+            # conntrack socket of the process, other process and
+            # other protocol
+            f.write('ffff0001 12  100    00000004 0        0        0'
+                    '        2        %d         1001\n' % drops)
+            f.write('ffff0002 12  200    00000004 0        0        0'
+                    '        2        7         1002\n')
+            f.write('ffff0003 0   100    00000000 0        0        0'
+                    '        2        9         1001\n')
+            f.close()
+
+        write(5)
+        monitor = OverrunMonitor(netlink, fd_dir)
+        self.assertEqual(monitor.check(), 0)
+        write(8)
+        self.assertEqual(monitor.check(), 3)
+        self.assertEqual(monitor.check(), 0)
+
+        # failed read doesn't reset the counter
+        os.unlink(netlink)
+        self.assertEqual(monitor.check(), 0)
+        write(9)
+        self.assertEqual(monitor.check(), 1)
+
+
+class ShardsTest(TestCase):
+
+    def test_shard_of(self):
+        shards = [shard_of('10.0.0.%d' % i, 4) for i in range(100)]
+        self.assertEqual(set(shards), set(range(4)))
+        self.assertEqual(shard_of('10.0.0.1', 4), shards[1])
+        self.assertEqual(shard_of('10.0.0.1', 1), 0)
+
+    def test_event_sources(self):
+        self.assertEqual(event_sources('[DESTROY] tcp      6 src=10.0.0.1'
+            ' dst=1.2.3.4 sport=1024 dport=80 packets=1 bytes=60 src=1.2.3.4'
+            ' dst=192.168.0.1 sport=80 dport=1024 packets=1 bytes=40'),
+            ('10.0.0.1', '1.2.3.4'))
+
+
+class JournalTest(TestCase):
+
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.filename = os.path.join(self.dir, 'journal')
+        user = User.objects.create(username='test')
+        self.session = Session.objects.create(user=user, src='10.0.0.1')
+        self.users = {self.session.id: user.id}
+        # torn batches and retries are logged
+        logging.disable(logging.ERROR)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        rmtree(self.dir)
+
+    def traffic(self):
+        return sorted(Record.objects.values_list('dst', 'traf_in', 'traf_out'))
+
+    def test_journal(self):
+        sid = self.session.id
+        journal = Journal(self.filename)
+        self.assertEqual(journal.append({(sid, '1.1.1.1'): [10, 1]},
+            self.users, 1300000000), 1)
+        self.assertEqual(journal.append({(sid, '1.1.1.1'): [5, 2],
+            (sid, '2.2.2.2'): [1, 1]}, self.users, 1300000001), 2)
+        journal.close()
+
+        # torn write of the third batch
+        f = open(self.filename, 'ab')
+        f.write('3 0000 {"del')
+        f.close()
+
+        journal = Journal(self.filename)
+        self.assertEqual(journal.last, 2)
+        self.assertEqual([i[0] for i in journal.pending()], [1, 2])
+
+        committer = JournalCommitter(journal)
+        self.assertEqual(committer.drain(), 2)
+        self.assertEqual(self.traffic(), [('1.1.1.1', 15, 3), ('2.2.2.2', 1, 1)])
+        self.assertEqual(journal.pending(), [])
+        self.assertEqual(os.path.getsize(self.filename), 0)
+        self.assertEqual(UsageRollup.objects.get(period=HOUR, dst='').start,
+                datetime(*datetime.fromtimestamp(1300000000).timetuple()[:4]))
+
+        self.assertEqual(journal.append({(sid, '1.1.1.1'): [1, 1]},
+            self.users, 1300000002), 3)
+        journal.close()
+
+        # batch is written, but crash happened before the checkpoint
+        journal = Journal(self.filename)
+        committer = JournalCommitter(journal)
+        batch = journal.pending()[0]
+        self.assertTrue(committer.apply(*batch))
+        journal.close()
+        journal = Journal(self.filename)
+        self.assertEqual(journal.committed, 2)
+        committer = JournalCommitter(journal)
+        self.assertEqual(committer.drain(), 1)
+        self.assertEqual(self.traffic(), [('1.1.1.1', 16, 4), ('2.2.2.2', 1, 1)])
+        self.assertEqual(journal.append({}, {}, 1300000003), 4)
+        journal.close()
+
+    def test_compact(self):
+        sid = self.session.id
+        journal = Journal(self.filename)
+        for i in range(3):
+            journal.append({(sid, '1.1.1.1'): [1, 1]}, self.users, 1300000000)
+        size = os.path.getsize(self.filename)
+        self.assertEqual([i[0] for i in journal.pending()], [1, 2, 3])
+
+        # committed batches are skipped by offset
+        journal.commit(1)
+        self.assertEqual([i[0] for i in journal.pending()], [2, 3])
+        self.assertEqual(os.path.getsize(self.filename), size)
+        offset = journal.offset
+        journal.close()
+        journal = Journal(self.filename)
+        self.assertEqual(journal.offset, offset)
+        self.assertEqual([i[0] for i in journal.pending()], [2, 3])
+
+        # and cut off when they take more than compact_size
+        journal.compact_size = 0
+        journal.commit(2)
+        self.assertEqual(journal.offset, 0)
+        self.assertEqual(os.path.getsize(self.filename), size - 2 * offset)
+        self.assertEqual([i[0] for i in journal.pending()], [3])
+        self.assertEqual(journal.append({}, {}, 1300000001), 4)
+        self.assertEqual(JournalCommitter(journal).drain(), 2)
+        self.assertEqual(os.path.getsize(self.filename), 0)
+        journal.close()
+
+    def test_lost_checkpoint(self):
+        journal = Journal(self.filename)
+        journal.append({(self.session.id, '1.1.1.1'): [1, 1]}, self.users,
+                1300000000)
+        self.assertEqual(JournalCommitter(journal).drain(), 1)
+        journal.close()
+
+        os.unlink(self.filename + '.checkpoint')
+        os.unlink(self.filename)
+        journal = Journal(self.filename)
+        self.assertEqual(journal.append({(self.session.id, '1.1.1.1'): [2, 2]},
+            self.users, 1300000001), 2)
+        self.assertEqual(JournalCommitter(journal).drain(), 1)
+        self.assertEqual(self.traffic(), [('1.1.1.1', 3, 3)])
+        journal.close()
+
+    def test_retry(self):
+        journal = Journal(self.filename)
+        journal.append({(self.session.id, '1.1.1.1'): [1, 1]}, self.users,
+                1300000000)
+        committer = JournalCommitter(journal, retry_interval=0)
+        apply = committer.apply
+        calls = []
+        def failing_apply(*batch):
+            calls.append(batch[0])
+            if len(calls) < 3:
+                raise DatabaseError('database is down')
+            return apply(*batch)
+        committer.apply = failing_apply
+        self.assertEqual(committer.drain(), 1)
+        self.assertEqual(calls, [1, 1, 1])
+        self.assertEqual(self.traffic(), [('1.1.1.1', 1, 1)])
+
+    def test_reject(self):
+        journal = Journal(self.filename)
+        for i in range(3):
+            journal.append({(self.session.id, '1.1.1.1'): [1, 1]}, self.users,
+                    1300000000 + i)
+        committer = JournalCommitter(journal, retry_interval=0)
+        apply = committer.apply
+        def failing_apply(*batch):
+            if batch[0] == 1:
+                raise IntegrityError('session is deleted')
+            if batch[0] == 2:
+                raise DatabaseError('value out of range')
+            return apply(*batch)
+        committer.apply = failing_apply
+        self.assertEqual(committer.drain(), 1)
+        self.assertEqual(committer.rejected, 2)
+        self.assertEqual(self.traffic(), [('1.1.1.1', 1, 1)])
+        self.assertEqual([line.split(' ', 1)[0] for line in
+            open(self.filename + '.rejected')], ['1', '2'])
+        self.assertEqual(os.path.getsize(self.filename), 0)
+        journal.close()
+
+
+class RawStatTest(TestCase):
+
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.basename = os.path.join(self.dir, 'raw')
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def test_write_and_read(self):
+        writer = RawStatWriter(self.basename, block_size=2)
+        records = [
+            (1300000000, 'tcp', '10.0.0.1', 1024, '1.2.3.4', 80, 5000, 300),
+            (1300000001, 'udp', '10.0.0.2', 53, '8.8.8.8', 53, 1 << 40, 60),
+            (1300000002, '99', '10.0.0.3', 0, '1.2.3.5', 0, 0, 0),
+        ]
+        for rec in records:
+            writer.write(*rec)
+        writer.close()
+
+        segments = os.listdir(self.dir)
+        self.assertEqual(len(segments), 1)
+        name = os.path.join(self.dir, segments[0])
+        self.assertEqual(list(read_segment(name)), records)
+
+        compress_segment(name)
+        self.assertEqual(list(read_segment(name + '.gz')), records)
+
+    def test_unknown_protocol(self):
+        self.assertEqual(event_protocol('[DESTROY] dccp     33 src=10.0.0.1',
+            'dccp'), '33')
+        self.assertEqual(event_protocol('[DESTROY] tcp      6 src=10.0.0.1',
+            'tcp'), 'tcp')
+        writer = RawStatWriter(self.basename)
+        logging.disable(logging.WARNING)
+        try:
+            writer.write(1300000000, 'unknown', '10.0.0.1', 0, '1.2.3.4', 0,
+                    1, 1)
+        finally:
+            logging.disable(logging.NOTSET)
+        writer.close()
+        name = os.path.join(self.dir, os.listdir(self.dir)[0])
+        self.assertEqual(list(read_segment(name)), [(1300000000,
+            str(UNKNOWN_PROTOCOL), '10.0.0.1', 0, '1.2.3.4', 0, 1, 1)])
+
+    def test_rotate_by_size(self):
+        writer = RawStatWriter(self.basename, max_size=1, block_size=1)
+        for i in range(3):
+            writer.write(1300000000, 'tcp', '10.0.0.1', 1, '1.2.3.4', 80, 1, 1)
+        writer.close()
+        self.assertEqual(len(os.listdir(self.dir)), 3)
+
+    def test_index(self):
+        writer = RawStatWriter(self.basename)
+        records = []
+        for i in range(100):
+            rec = (1300000000 + i, 'tcp', '10.0.0.%d' % (i % 7), 1024,
+                    '1.2.3.%d' % (i % 10), 80, i, 1)
+            writer.write(*rec)
+            records.append(rec)
+        writer.write(1300000100, 'udp', '1.2.3.4', 53, '10.0.0.9', 53, 1, 1)
+        writer.close()
+        name = os.path.join(self.dir, os.listdir(self.dir)[0])
+        build_index(name, block_records=8)
+
+        index = SegmentIndex(name)
+        self.assertEqual((index.t_min, index.t_max), (1300000000, 1300000100))
+        self.assertEqual(index.find_blocks(ip2int('1.2.3.4'), 1300000000,
+            1300000030), [0, 1, 3])
+        self.assertEqual(index.find_blocks(ip2int('1.2.3.4'), 1300000200,
+            1300000300), [])
+        self.assertEqual(index.find_blocks(ip2int('1.2.3.4'), 1300000090,
+            1300000200, dst=False), [12])
+        index.close()
+
+        def query(name, *args):
+            return [(rec[0], rec[2]) for rec in query_segment(name, *args)]
+
+        expected = [(i, ip2int('10.0.0.%d' % ((i - 1300000000) % 7)))
+                for i in (1300000004, 1300000014, 1300000024)]
+        self.assertEqual(query(name, '1.2.3.4', 1300000000, 1300000030),
+                expected)
+        self.assertEqual(query(name, '1.2.3.4', 1300000095, 1300000200),
+                [(1300000100, ip2int('1.2.3.4'))])
+        self.assertEqual(query(name, '1.2.3.4', 1300000095, 1300000200,
+            False), [])
+
+        compress_segment(name)
+        self.assertEqual(index_name(name + '.gz'), name + '.idx')
+        self.assertEqual(query(name + '.gz', '1.2.3.4', 1300000000,
+            1300000030), expected)
+        os.unlink(name + '.idx')
+        self.assertEqual(query(name + '.gz', '1.2.3.4', 1300000000,
+            1300000030), expected)
+
+
+class ReplayTest(TestCase):
+
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.user = User.objects.create(username='test')
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def test_replay(self):
+        t = datetime(2011, 3, 1, 12, 0)
+        old = Session.objects.create(user=self.user, src='10.0.0.1')
+        old.dt_start = t
+        old.dt_finish = t + timedelta(hours=1)
+        old.save()
+        new = Session.objects.create(user=self.user, src='10.0.0.1')
+        new.dt_start = t + timedelta(hours=1)
+        new.save()
+        earlier = Session.objects.create(user=self.user, src='10.0.0.2')
+        earlier.dt_start = t - timedelta(days=1)
+        earlier.dt_finish = earlier.dt_start + timedelta(hours=1)
+        earlier.save()
+        Record.objects.create(session=earlier, dst='1.2.3.4', traf_in=1,
+                traf_out=1)
+
+        ts = mktime(t.timetuple())
+        writer = RawStatWriter(os.path.join(self.dir, 'raw'))
+        writer.write(ts - 10, 'tcp', '10.0.0.1', 1024, '1.2.3.4', 80, 1, 1)
+        writer.write(ts + 10, 'tcp', '10.0.0.1', 1024, '1.2.3.4', 80, 100, 10)
+        writer.write(ts + 20, 'tcp', '1.2.3.4', 1024, '10.0.0.1', 80, 5, 50)
+        writer.write(ts + 3610, 'tcp', '10.0.0.1', 1024, '1.2.3.4', 80, 7, 3)
+        writer.close()
+
+        filenames = [os.path.join(self.dir, i) for i in os.listdir(self.dir)]
+        count, unhandled = replay(filenames, SessionIntervals.load())
+        self.assertEqual((count, unhandled), (4, 1))
+        records = [
+            (old.id, '1.2.3.4', 150, 15),
+            (new.id, '1.2.3.4', 7, 3),
+        ]
+        records.append((earlier.id, '1.2.3.4', 1, 1))
+        self.assertEqual(sorted(Record.objects.values_list(
+            'session', 'dst', 'traf_in', 'traf_out')), sorted(records))
+        self.assertEqual(UsageRollup.objects.get(period=MONTH, dst=''
+            ).traf_in, 157)
+
+        # replaying again adds traffic, unless records are replaced
+        # and records of sessions out of the segments are kept
+        sessions = SessionIntervals.load(t - timedelta(days=2),
+                t + timedelta(days=1))
+        replay(filenames, sessions, replace=True)
+        replay(filenames, sessions, replace=True)
+        self.assertEqual(sorted(Record.objects.values_list(
+            'session', 'dst', 'traf_in', 'traf_out')), sorted(records))
+        self.assertEqual(UsageRollup.objects.get(period=MONTH, dst=''
+            ).traf_in, 157)
+
+
+class MetricsTest(TestCase):
+
+    def test_render(self):
+        metrics = Metrics('test', {'shard': 1})
+        metrics.inc('events')
+        metrics.inc('events', 2)
+        metrics.set('depth', 5)
+        metrics.observe('seconds', 0.003)
+        metrics.observe('seconds', 20)
+        text = metrics.render()
+        self.assertTrue('test_events_total{shard="1"} 3\n' in text)
+        self.assertTrue('test_depth{shard="1"} 5\n' in text)
+        self.assertTrue('test_seconds_bucket{le="0.001",shard="1"} 0\n' in text)
+        self.assertTrue('test_seconds_bucket{le="0.005",shard="1"} 1\n' in text)
+        self.assertTrue('test_seconds_bucket{le="10.0",shard="1"} 1\n' in text)
+        self.assertTrue('test_seconds_bucket{le="+Inf",shard="1"} 2\n' in text)
+        self.assertTrue('test_seconds_count{shard="1"} 2\n' in text)
+
+
+class DstAggregatorTest(TestCase):
+
+    def test_exact(self):
+        self.assertEqual(DstAggregator().aggregate('1.2.3.4'), '1.2.3.4')
+
+    def test_prefix_len(self):
+        self.assertEqual(DstAggregator(24).aggregate('1.2.3.4'), '1.2.3.0/24')
+
+    def test_longest_prefix_match(self):
+        aggregator = DstAggregator(24, [
+            ('10.0.0.0/8', 'ten'),
+            ('10.1.0.0/16', 'ten-one'),
+            ('0.0.0.0/0', 'world'),
+        ])
+        self.assertEqual(aggregator.aggregate('10.1.2.3'), 'ten-one')
+        self.assertEqual(aggregator.aggregate('10.2.2.3'), 'ten')
+        self.assertEqual(aggregator.aggregate('11.2.2.3'), 'world')
+        aggregator = DstAggregator(24, [('10.0.0.0/8', 'ten')])
+        self.assertEqual(aggregator.aggregate('11.2.2.3'), '11.2.2.0/24')
+
+    def test_ipv6(self):
+        aggregator = DstAggregator(24, [('0.0.0.0/0', 'world')])
+        self.assertEqual(aggregator.aggregate('2001:db8::1'), '2001:db8::1')
+
+    def test_load_prefixes(self):
+        dir = mkdtemp()
+        try:
+            filename = os.path.join(dir, 'prefixes')
+            f = open(filename, 'w')
+            f.write('# comment\n10.0.0.0/8 ten\n\n192.168.0.0/16\n')
+            f.close()
+            self.assertEqual(load_prefixes(filename), [('10.0.0.0/8', 'ten'),
+                ('192.168.0.0/16', '192.168.0.0/16')])
+            f = open(filename, 'a')
+            f.write('172.16.0.0/12 %s\n' % ('x' * 65))
+            f.close()
+            self.assertRaises(ValueError, load_prefixes, filename)
+        finally:
+            rmtree(dir)
+
+
+class UsageRollupTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test')
+        self.session = Session.objects.create(user=self.user, src='10.0.0.1')
+
+    def test_add_session_traffic(self):
+        sid = self.session.id
+        users = {sid: self.user.id}
+        when = datetime(2011, 3, 15, 12, 30)
+        UsageRollup.objects.add_session_traffic({
+            (sid, '1.1.1.1'): [10, 1],
+            (sid, '2.2.2.2'): [20, 2],
+        }, users, when)
+        UsageRollup.objects.add_session_traffic({
+            (sid, '1.1.1.1'): [5, 5],
+        }, users, when.replace(hour=13))
+
+        def rollups(period):
+            return sorted(UsageRollup.objects.filter(period=period
+                ).values_list('start', 'dst', 'traf_in', 'traf_out'))
+
+        self.assertEqual(rollups(MONTH), [
+            (datetime(2011, 3, 1), '', 35, 8),
+            (datetime(2011, 3, 1), '1.1.1.1', 15, 6),
+            (datetime(2011, 3, 1), '2.2.2.2', 20, 2),
+        ])
+        self.assertEqual(len(rollups(DAY)), 3)
+        self.assertEqual(rollups(HOUR), [
+            (datetime(2011, 3, 15, 12), '', 30, 3),
+            (datetime(2011, 3, 15, 12), '1.1.1.1', 10, 1),
+            (datetime(2011, 3, 15, 12), '2.2.2.2', 20, 2),
+            (datetime(2011, 3, 15, 13), '', 5, 5),
+            (datetime(2011, 3, 15, 13), '1.1.1.1', 5, 5),
+        ])
+
+    def test_rebuild(self):
+        other = User.objects.create(username='other')
+        old = Session.objects.create(user=self.user, src='10.0.0.2')
+        Session.objects.filter(id=old.id).update(
+                dt_start=datetime(2011, 2, 28, 23, 30))
+        Session.objects.filter(id=self.session.id).update(
+                dt_start=datetime(2011, 3, 1, 8, 10))
+        Record.objects.create(session=old, dst='1.1.1.1', traf_in=1, traf_out=2)
+        Record.objects.create(session=self.session, dst='1.1.1.1',
+                traf_in=10, traf_out=20)
+        Record.objects.create(session=self.session, dst='2.2.2.2',
+                traf_in=100, traf_out=200)
+        # stale rollups are replaced, other users are kept
+        UsageRollup.objects.create(user=self.user, period=MONTH,
+                start=datetime(2011, 3, 1), dst='', traf_in=1, traf_out=1)
+        UsageRollup.objects.create(user=other, period=MONTH,
+                start=datetime(2011, 3, 1), dst='', traf_in=7, traf_out=7)
+
+        self.assertEqual(UsageRollup.objects.rebuild([self.user.id],
+            datetime(2011, 3, 5)), 1)
+        self.assertEqual(sorted(UsageRollup.objects.filter(period=MONTH
+            ).values_list('user', 'dst', 'traf_in', 'traf_out')), [
+                (self.user.id, '', 110, 220),
+                (self.user.id, '1.1.1.1', 10, 20),
+                (self.user.id, '2.2.2.2', 100, 200),
+                (other.id, '', 7, 7),
+            ])
+        self.assertEqual(set(UsageRollup.objects.filter(period=HOUR,
+            user=self.user).values_list('start', flat=True)),
+            set([datetime(2011, 3, 1, 8)]))
+
+        self.assertEqual(UsageRollup.objects.rebuild(), 2)
+        self.assertEqual(UsageRollup.objects.get(user=self.user, period=MONTH,
+            start=datetime(2011, 2, 1), dst='').traf_in, 1)
+
+
+class UsageCacheTest(TestCase):
+
+    def setUp(self):
+        self.cache = usage_cache.cache
+        usage_cache.cache = get_cache(
+                'django.core.cache.backends.locmem.LocMemCache')
+
+    def tearDown(self):
+        usage_cache.cache = self.cache
+
+    def test_bump_versions(self):
+        calls = []
+
+        def func():
+            calls.append(1)
+            return len(calls)
+
+        self.assertEqual(usage_cache.get_or_set('test', 1, func), 1)
+        self.assertEqual(usage_cache.get_or_set('test', 1, func), 1)
+        usage_cache.bump_versions([2])
+        self.assertEqual(usage_cache.get_or_set('test', 1, func), 1)
+        usage_cache.bump_versions([1])
+        self.assertEqual(usage_cache.get_or_set('test', 1, func), 2)
+        version = usage_cache.get_version(1)
+        usage_cache.bump_versions(set([1]))
+        self.assertEqual(usage_cache.get_version(1), version + 1)
+
+
+class StubDnsServer(object):
+    """
+    Answers PTR queries for addresses from names dict, delaying answers
+    for addresses from delays dict.
+    """
+
+    def __init__(self, names, delays={}):
+        self.names = names
+        self.delays = delays
+        self.queries = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.address = self.sock.getsockname()
+        thread = Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while True:
+            data, addr = self.sock.recvfrom(512)
+            Thread(target=self.answer, args=(data, addr)).start()
+
+    def answer(self, data, addr):
+        qname, offset = read_name(data, 12)
+        ip = '.'.join(qname.split('.')[:4][::-1])
+        self.queries.append(ip)
+        sleep(self.delays.get(ip, 0))
+        question = data[12:offset + 4]
+        header = data[:2]
+        if ip in self.names:
+            rdata = ''.join(chr(len(i)) + i
+                    for i in self.names[ip].split('.')) + '\0'
+            answer = '\xc0\x0c' + struct.pack('!HHIH', 12, 1, 60,
+                    len(rdata)) + rdata
+            header += struct.pack('!HHHHH', 0x8180, 1, 1, 0, 0)
+        else:
+            answer = ''
+            header += struct.pack('!HHHHH', 0x8183, 1, 0, 0, 0)
+        self.sock.sendto(header + question + answer, addr)
+
+
+class ResolverTest(TestCase):
+
+    def setUp(self):
+        self.server = StubDnsServer({
+            '1.2.3.4': 'one.example.com',
+            '5.6.7.8': 'slow.example.com',
+        }, {'5.6.7.8': 0.5})
+        self.resolver = Resolver(DnsLookup(self.server.address, 2),
+                negative_ttl=60)
+
+    def test_lookup(self):
+        lookup = DnsLookup(self.server.address, 2)
+        self.assertEqual(lookup('1.2.3.4'), 'one.example.com')
+        self.assertRaises(socket.herror, lookup, '9.9.9.9')
+
+    def test_resolve_many(self):
+        t0 = time()
+        names = self.resolver.resolve_many(
+                ['1.2.3.4', '5.6.7.8', '9.9.9.9', '1.2.3.0/24'], 0.2)
+        self.assertTrue(time() - t0 < 0.4)
+        self.assertEqual(names, {
+            '1.2.3.4': 'one.example.com',
+            '5.6.7.8': '5.6.7.8',
+            '9.9.9.9': '9.9.9.9',
+            '1.2.3.0/24': '1.2.3.0/24',
+        })
+        # the slow lookup finishes in background
+        sleep(0.5)
+        self.assertEqual(self.resolver.resolve('5.6.7.8'), 'slow.example.com')
+
+    def test_cache(self):
+        self.resolver.resolve_many(['1.2.3.4', '9.9.9.9'], 1)
+        self.assertEqual(self.resolver.resolve('1.2.3.4'), 'one.example.com')
+        self.assertEqual(self.resolver.resolve('9.9.9.9'), '9.9.9.9')
+        self.assertEqual(sorted(self.server.queries), ['1.2.3.4', '9.9.9.9'])
+
+    def test_lru(self):
+        resolver = Resolver(lambda ip: 'name', size=2)
+        for ip in ('1.1.1.1', '2.2.2.2', '3.3.3.3'):
+            resolver.store(ip, 'name')
+        self.assertEqual(list(resolver.cache), ['2.2.2.2', '3.3.3.3'])
@@ -0,0 +1,60 @@
+"""
+Versioned cache of per-user usage data.
+
+Every user has a version number in cache, pages cache their data under
+keys containing it. Conntrack logger bumps versions of users it has
+written new traffic for, so cached data is never stale and is kept
+while nothing changes. The cache must be shared by the logger and the
+web server, see CACHES in settings.
+"""
+
+from time import time
+
+from django.core.cache import cache
+
+
+# cached data expires anyway, in case the cache is not shared with the
+# conntrack logger
+TIMEOUT = 600
+
+# versions live much longer than data, so a version is never reused
+# while data cached under it is alive
+VERSION_TIMEOUT = 30 * 86400
+
+
+def version_key(user_id):
+    return 'usage-version:%d' % user_id
+
+
+def get_version(user_id):
+    return cache.get(version_key(user_id), 0)
+
+
+def bump_versions(user_ids):
+    """
+    Invalidate cached data of users.
+    """
+
+    for user_id in user_ids:
+        key = version_key(user_id)
+        try:
+            # atomic, so concurrent bumps of processes never collide
+            cache.incr(key)
+        except ValueError:
+            # no version yet, it starts from the current time in case an
+            # evicted one is being replaced
+            if not cache.add(key, int(time() * 1000), VERSION_TIMEOUT):
+                cache.incr(key)
+
+
+def get_or_set(name, user_id, func):
+    """
+    Get cached data of user, calling func to get it on cache miss.
+    """
+
+    key = '%s:%d:%d' % (name, user_id, get_version(user_id))
+    data = cache.get(key)
+    if data is None:
+        data = func()
+        cache.set(key, data, TIMEOUT)
+    return data
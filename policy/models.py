@@ -1,7 +1,15 @@
-from django.db import models
+from django.db import models, connection
+from django.dispatch import Signal
+from django.conf import settings
 from django.contrib.auth.models import User
 
 
+# sent when used quota of a policy passes a threshold, a fraction of the
+# full quota
+quota_crossed = Signal(providing_args=['policy_id', 'owner_id',
+    'threshold', 'used', 'full'])
+
+
 class Departament(models.Model):
     name = models.CharField(max_length=256)
     admin = models.ForeignKey(User)
@@ -11,6 +19,57 @@ class UserDepartament(models.Model):
     departament = models.ForeignKey(Departament)
 
 
+class QuotaPolicyManager(models.Manager):
+    """
+    Subclasses set owner to name of the field policy belongs to.
+    """
+
+    owner = None
+
+    def add_used(self, deltas, thresholds=None):
+        """
+        Increment used quota of policies with a single executemany UPDATE.
+
+        @param deltas:
+            dict {owner_id: bytes}
+        @param thresholds:
+            fractions of full quota to report crossings of,
+            settings.QUOTA_THRESHOLDS by default
+
+        Returns list of crossings (policy_id, owner_id, threshold, used,
+        full).
+        """
+
+        if thresholds is None:
+            thresholds = getattr(settings, 'QUOTA_THRESHOLDS', ())
+        deltas = dict((k, v) for k, v in deltas.items() if v)
+        if not deltas:
+            return []
+
+        qn = connection.ops.quote_name
+        connection.cursor().executemany('UPDATE %s SET used = used + %%s'
+                ' WHERE %s = %%s' % (qn(self.model._meta.db_table),
+                    qn(self.model._meta.get_field(self.owner).column)),
+                [(v, k) for k, v in deltas.items()])
+
+        crossings = []
+        for id, owner, full, used in self.filter(**{
+                '%s__in' % self.owner: deltas.keys()}).values_list(
+                        'id', self.owner, 'full', 'used'):
+            if full <= 0:
+                continue
+            before = used - deltas[owner]
+            for threshold in thresholds:
+                if before < threshold * full <= used:
+                    crossings.append((id, owner, threshold, used, full))
+        return crossings
+
+
+class UserQuotaPolicyManager(QuotaPolicyManager):
+
+    owner = 'user'
+
+
 class UserQuotaPolicy(models.Model):
     user = models.ForeignKey(User, unique=True)
     full = models.BigIntegerField()
@@ -18,6 +77,14 @@ class UserQuotaPolicy(models.Model):
     renewed = models.DateTimeField()
     interval = models.IntegerField()
 
+    objects = UserQuotaPolicyManager()
+
+
+class DepartamentQuotaPolicyManager(QuotaPolicyManager):
+
+    owner = 'departament'
+
+
 class DepartamentQuotaPolicy(models.Model):
     departament = models.ForeignKey(Departament, unique=True)
     full = models.BigIntegerField()
@@ -25,3 +92,40 @@ class DepartamentQuotaPolicy(models.Model):
     renewed = models.DateTimeField()
     interval = models.IntegerField()
 
+    objects = DepartamentQuotaPolicyManager()
+
+
+def add_used_quota(deltas, thresholds=None):
+    """
+    Add traffic of users to used quotas of users and their departaments.
+
+    @param deltas:
+        dict {user_id: bytes}
+
+    Returns list of crossings (model, policy_id, owner_id, threshold,
+    used, full), see QuotaPolicyManager.add_used().
+    """
+
+    departaments = {}
+    for user, departament in UserDepartament.objects.filter(
+            user__in=deltas.keys()).values_list('user', 'departament'):
+        departaments[departament] = departaments.get(departament, 0) + \
+                deltas[user]
+
+    crossings = []
+    for model, model_deltas in ((UserQuotaPolicy, deltas),
+            (DepartamentQuotaPolicy, departaments)):
+        crossings.extend((model,) + i for i in
+                model.objects.add_used(model_deltas, thresholds))
+    return crossings
+
+
+def send_crossings(crossings):
+    """
+    Send quota_crossed signals, should be called after the used quotas
+    are committed.
+    """
+
+    for model, id, owner, threshold, used, full in crossings:
+        quota_crossed.send(sender=model, policy_id=id, owner_id=owner,
+                threshold=threshold, used=used, full=full)
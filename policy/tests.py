@@ -5,7 +5,21 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
+from datetime import datetime
+from tempfile import mkdtemp
+from shutil import rmtree
+import os
+import logging
+
 from django.test import TestCase
+from django.contrib.auth.models import User
+
+from netstat.models import Session
+from policy.models import Departament, UserDepartament, UserQuotaPolicy, \
+        DepartamentQuotaPolicy, add_used_quota, send_crossings, quota_crossed
+from netfilter_control import Firewall, FirewallError, FirewallReloader, \
+        enforce_quotas
+from utils import DnTree
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -21,3 +35,274 @@ Another way to test that 1 + 1 is equal to 2.
 True
 """}
 
+
+class FirewallTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.rules = os.path.join(self.tmpdir, 'rules')
+        self.sets = os.path.join(self.tmpdir, 'sets')
+        self.restore = self.fake('iptables-restore', 'echo "$@" > %s; cat >> %s'
+                % (self.rules, self.rules))
+        self.ipset = self.fake('ipset', 'echo "$@" >> %s; cat >> %s' % (
+            self.sets, self.sets))
+
+        admin = User.objects.create(username='admin')
+        alice = User.objects.create(username='alice')
+        bob = User.objects.create(username='bob')
+        carol = User.objects.create(username='carol')
+        dep = Departament.objects.create(name='dep', admin=admin)
+        UserDepartament.objects.create(user=alice, departament=dep)
+        UserDepartament.objects.create(user=carol, departament=dep)
+        now = datetime.now()
+        DepartamentQuotaPolicy.objects.create(departament=dep, full=1000,
+                used=100, renewed=now, interval=30)
+        UserQuotaPolicy.objects.create(user=alice, full=500, used=600,
+                renewed=now, interval=30)
+        Session.objects.create(user=alice, src='10.0.0.1')
+        Session.objects.create(user=bob, src='10.0.0.2')
+        Session.objects.create(user=bob, src='10.0.0.3', dt_finish=now)
+
+        self.alice, self.bob, self.carol, self.dep = alice, bob, carol, dep
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def fake(self, name, command):
+        filename = os.path.join(self.tmpdir, name)
+        f = open(filename, 'w')
+        f.write('#!/bin/sh\n%s\n' % command)
+        f.close()
+        os.chmod(filename, 0755)
+        return filename
+
+    def read_sets(self):
+        if not os.path.exists(self.sets):
+            return ''
+        data = open(self.sets).read()
+        os.unlink(self.sets)
+        return data
+
+    def test_load(self):
+        # rules of other software, a chain of a removed policy and a jump
+        # loaded before
+        save = self.fake('iptables-save', 'cat <<EOF\n%s\nEOF' % '\n'.join([
+            '*nat',
+            ':PREROUTING ACCEPT [0:0]',
+            ':POSTROUTING ACCEPT [0:0]',
+            ':tas-prerouting - [0:0]',
+            '-A PREROUTING -j tas-prerouting',
+            '-A POSTROUTING -o eth0 -j MASQUERADE',
+            'COMMIT',
+            '*filter',
+            ':INPUT ACCEPT [0:0]',
+            ':FORWARD ACCEPT [0:0]',
+            ':tas-forward - [0:0]',
+            ':tas-u999-quota - [0:0]',
+            '-A INPUT -p tcp --dport 22 -j ACCEPT',
+            '-A tas-forward -m set --match-set tas-u999 src -j tas-u999-quota',
+            'COMMIT',
+        ]))
+        firewall = Firewall('eth1', ('192.168.0.1', 8080), self.restore,
+                self.ipset, save)
+        firewall.load()
+
+        user_chain = 'tas-u%d-quota' % self.alice.id
+        user_set = 'tas-u%d' % self.alice.id
+        dep_chain = 'tas-d%d-quota' % self.dep.id
+        dep_set = 'tas-d%d' % self.dep.id
+        self.assertEqual(open(self.rules).read(), '\n'.join([
+            '--noflush',
+            '*filter',
+            ':tas-forward - [0:0]',
+            ':%s - [0:0]' % dep_chain,
+            ':%s - [0:0]' % user_chain,
+            '-F tas-u999-quota',
+            '-X tas-u999-quota',
+            '-I FORWARD 1 -j tas-forward',
+            '-A %s -m quota --quota 900 -j ACCEPT' % dep_chain,
+            '-A %s -j DROP' % dep_chain,
+            '-A tas-forward -m set --match-set %s src -j %s' % (dep_set,
+                dep_chain),
+            '-A tas-forward -m set --match-set %s dst -j %s' % (dep_set,
+                dep_chain),
+            '-A %s -m quota --quota 0 -j %s' % (user_chain, dep_chain),
+            '-A %s -j DROP' % user_chain,
+            '-A tas-forward -m set --match-set %s src -j %s' % (user_set,
+                user_chain),
+            '-A tas-forward -m set --match-set %s dst -j %s' % (user_set,
+                user_chain),
+            '-A tas-forward -m set --match-set tas-free src -j ACCEPT',
+            '-A tas-forward -m set --match-set tas-free dst -j ACCEPT',
+            '-A tas-forward -i eth1 -j DROP',
+            'COMMIT',
+            '*nat',
+            ':tas-prerouting - [0:0]',
+            '-A tas-prerouting -m set --match-set tas-online src -j ACCEPT',
+            '-A tas-prerouting -i eth1 -p tcp --dport 80'
+                ' -j DNAT --to-destination 192.168.0.1:8080',
+            'COMMIT',
+        ]) + '\n')
+
+        def restore(name, type, members):
+            return [
+                'create %s %s -exist' % (name, type),
+                'create %s-new %s -exist' % (name, type),
+                'flush %s-new' % name,
+            ] + ['add %s-new %s' % (name, i) for i in members] + [
+                'swap %s-new %s' % (name, name),
+                'destroy %s-new' % name,
+            ]
+
+        self.assertEqual(self.read_sets(), '\n'.join(['restore'] +
+            restore(dep_set, 'hash:ip', []) +
+            restore(user_set, 'hash:ip', ['10.0.0.1']) +
+            restore('tas-free', 'hash:ip', ['10.0.0.2']) +
+            restore('tas-online', 'list:set', [dep_set, user_set, 'tas-free'])
+            ) + '\n')
+
+    def test_sessions(self):
+        user_set = 'tas-u%d' % self.alice.id
+        self.fake('ipset', '\n'.join([
+            'echo "$@" >> %s' % self.sets,
+            'if [ "$1" = list ]; then',
+            '    printf "Name: tas-online\\nType: list:set\\nMembers:\\n"',
+            '    printf "%s\\ntas-free\\n"' % user_set,
+            'else',
+            '    cat >> %s' % self.sets,
+            'fi',
+        ]))
+        firewall = Firewall(ipset=self.ipset)
+        firewall.add_session(Session(user=self.alice, src='10.0.0.4'))
+        firewall.add_session(Session(user=self.carol, src='10.0.0.5'))
+        # bob could have had a quota policy when he logged in
+        firewall.remove_session(Session(user=self.bob, src='10.0.0.2'))
+        self.assertEqual(self.read_sets(), '\n'.join([
+            'add %s 10.0.0.4 -exist' % user_set,
+            'add tas-d%d 10.0.0.5 -exist' % self.dep.id,
+            'list tas-online',
+            'restore',
+            'del %s 10.0.0.2 -exist' % user_set,
+            'del tas-free 10.0.0.2 -exist',
+        ]) + '\n')
+
+    def test_load_failed(self):
+        self.fake('iptables-restore', 'echo "line 3 failed"; exit 1')
+        save = self.fake('iptables-save', 'true')
+        firewall = Firewall(restore=self.restore, ipset=self.ipset, save=save)
+        self.assertRaises(FirewallError, firewall.load)
+        firewall = Firewall(restore=self.restore,
+                ipset=os.path.join(self.tmpdir, 'nonexistent'))
+        self.assertRaises(FirewallError, firewall.load)
+
+    def test_sync_quotas(self):
+        save = self.fake('iptables-save', 'cat <<EOF\n%s\nEOF' % '\n'.join([
+            '# Generated by iptables-save',
+            '*filter',
+            ':FORWARD ACCEPT [10:1000]',
+            ':tas-d%d-quota - [0:0]' % self.dep.id,
+            ':tas-u%d-quota - [0:0]' % self.alice.id,
+            '[5:300] -A tas-d%d-quota -m quota --quota 700 -j ACCEPT'
+                % self.dep.id,
+            '[0:0] -A tas-d%d-quota -j DROP' % self.dep.id,
+            '[0:0] -A tas-u%d-quota -m quota --quota 0 -j tas-d%d-quota'
+                % (self.alice.id, self.dep.id),
+            '[1:100] -A tas-u%d-quota -j DROP' % self.alice.id,
+            'COMMIT',
+        ]))
+        firewall = Firewall(save=save)
+        self.assertEqual(firewall.sync_quotas(), 1)
+        self.assertEqual(DepartamentQuotaPolicy.objects.get().used, 300)
+        # used quota of alice exceeds the full one, it is kept
+        self.assertEqual(UserQuotaPolicy.objects.get().used, 600)
+        self.assertEqual(firewall.sync_quotas(), 0)
+
+    def test_reloader(self):
+        self.fake('iptables-restore', 'exit 1')
+        save = self.fake('iptables-save', 'true')
+        reloader = FirewallReloader(Firewall(restore=self.restore,
+            ipset=self.ipset, save=save))
+        logging.disable(logging.ERROR)
+        try:
+            self.assertFalse(reloader.reload())
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(reloader.failures, 1)
+
+        requests = []
+        receiver = enforce_quotas(lambda: requests.append(True))
+        try:
+            for threshold in (0.8, 1.0):
+                quota_crossed.send(sender=UserQuotaPolicy, policy_id=1,
+                        owner_id=1, threshold=threshold, used=100, full=100)
+        finally:
+            quota_crossed.disconnect(receiver)
+        self.assertEqual(requests, [True])
+
+
+class QuotaAccountingTest(TestCase):
+
+    def test_add_used_quota(self):
+        admin = User.objects.create(username='admin')
+        alice = User.objects.create(username='alice')
+        bob = User.objects.create(username='bob')
+        dep = Departament.objects.create(name='dep', admin=admin)
+        UserDepartament.objects.create(user=alice, departament=dep)
+        UserDepartament.objects.create(user=bob, departament=dep)
+        now = datetime.now()
+        dep_policy = DepartamentQuotaPolicy.objects.create(departament=dep,
+                full=1000, used=0, renewed=now, interval=30)
+        alice_policy = UserQuotaPolicy.objects.create(user=alice, full=100,
+                used=70, renewed=now, interval=30)
+
+        crossings = add_used_quota({alice.id: 40, bob.id: 400}, (0.8, 1.0))
+        self.assertEqual(sorted(crossings), sorted([
+            (UserQuotaPolicy, alice_policy.id, alice.id, 0.8, 110, 100),
+            (UserQuotaPolicy, alice_policy.id, alice.id, 1.0, 110, 100),
+        ]))
+        self.assertEqual(UserQuotaPolicy.objects.get().used, 110)
+        self.assertEqual(DepartamentQuotaPolicy.objects.get().used, 440)
+
+        crossings = add_used_quota({alice.id: 5, bob.id: 400}, (0.8, 1.0))
+        self.assertEqual(crossings, [(DepartamentQuotaPolicy, dep_policy.id,
+            dep.id, 0.8, 845, 1000)])
+        self.assertEqual(add_used_quota({alice.id: 0}, (0.8, 1.0)), [])
+
+        received = []
+        def receiver(sender, **kwargs):
+            received.append((sender, kwargs['owner_id'], kwargs['threshold']))
+        quota_crossed.connect(receiver)
+        try:
+            send_crossings(crossings)
+        finally:
+            quota_crossed.disconnect(receiver)
+        self.assertEqual(received, [(DepartamentQuotaPolicy, dep.id, 0.8)])
+
+
+class DnTreeTest(TestCase):
+
+    def test_tree(self):
+        names = ['org', 'it.org', 'dev.it.org', 'bob.it.org', 'x.lost.org']
+        for tree in (DnTree.from_iterable(names), DnTree()):
+            if not tree.dn_set:
+                for dn in reversed(names):
+                    tree.add(dn)
+            self.assertEqual(tree.get_roots(), set(['org', 'x.lost.org']))
+            self.assertEqual(tree.get_childs('it.org'),
+                    set(['dev.it.org', 'bob.it.org']))
+            self.assertEqual(list(tree.iter_ancestors('dev.it.org')),
+                    ['it.org', 'org'])
+            self.assertEqual(set(tree.iter_subtree('org')),
+                    set(['org', 'it.org', 'dev.it.org', 'bob.it.org']))
+            self.assertEqual(str(tree), '-org\n |-it\n | |-bob\n | |-dev\n'
+                    '-x.lost.org\n')
+
+            tree.add('lost.org')
+            self.assertEqual(tree.parent['x.lost.org'], 'lost.org')
+            tree.remove('it.org')
+            self.assertEqual(tree.dn_set, set(['org', 'lost.org', 'x.lost.org']))
+            tree.remove('lost.org')
+            self.assertEqual(tree.get_roots(), set(['org']))
+            self.assertEqual(tree.fake_parent, {})
+
+        self.assertRaises(ValueError, DnTree.from_iterable, ['org', 'org'])
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Copyright (c) 2010-2011 Andrew Grigorev <andrew@ei-grad.ru>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Find records of an address in raw statistics archives.
+
+Segments are looked up through their indexes (see netstat.rawstat),
+segments without index are read completely. Indexes of closed segments
+can be built with --build-index.
+"""
+
+import os
+os.environ['DJANGO_SETTINGS_MODULE'] = 'tas.settings'
+
+import sys
+import logging
+
+from time import mktime, strftime, localtime
+from datetime import datetime
+
+from netstat.models import Session
+from netstat.rawstat import query_segment, build_index, index_name, \
+        int2ip, int2proto
+
+
+def parse_datetime(value):
+    for format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise ValueError('bad datetime: %r' % value)
+
+
+def segment_names(filenames):
+    """
+    Filter out indexes and temporary files from list of archive files.
+    """
+
+    return [i for i in filenames if not i.endswith('.idx')
+            and not i.endswith('.tmp')]
+
+
+def query(filenames, ip, t_from, t_to, src=True, dst=True):
+    """
+    Iterate over records of ip within time range in segments.
+    """
+
+    for filename in segment_names(filenames):
+        logging.debug('querying %s...' % filename)
+        for rec in query_segment(filename, ip, t_from, t_to, src, dst):
+            yield rec
+
+
+def format_record(rec, user=None):
+    timestamp, proto, src, sport, dst, dport, bytes_in, bytes_out = rec
+    line = '%s %s %s:%d -> %s:%d %d %d' % (
+            strftime('%Y-%m-%d %H:%M:%S', localtime(timestamp)),
+            int2proto(proto), int2ip(src), sport, int2ip(dst), dport,
+            bytes_in, bytes_out)
+    if user is not None:
+        line += ' ' + user
+    return line
+
+
+if __name__ == "__main__":
+
+    from optparse import OptionParser
+
+    usage = 'Usage: %prog [options] IP FILE...'
+
+    parser = OptionParser(usage=usage, version='0.1.1')
+
+    parser.add_option('-d', '--debug', action='store_true', dest='debug',
+           help='print debug messages',
+           default=False)
+    parser.add_option('-f', '--from', dest='dt_from',
+            metavar='"YYYY-mm-dd[ HH:MM[:SS]]"',
+            help='find records since this time',
+            default=None)
+    parser.add_option('-t', '--to', dest='dt_to',
+            metavar='"YYYY-mm-dd[ HH:MM[:SS]]"',
+            help='find records until this time',
+            default=None)
+    parser.add_option('--src', action='store_true', dest='src_only',
+            help='find records with IP as source only',
+            default=False)
+    parser.add_option('--dst', action='store_true', dest='dst_only',
+            help='find records with IP as destination only',
+            default=False)
+    parser.add_option('-u', '--users', action='store_true', dest='users',
+            help='print users of sessions of sources',
+            default=False)
+    parser.add_option('-b', '--build-index', action='store_true',
+            dest='build_index',
+            help='index segments which have no index, they must be closed',
+            default=False)
+
+    opt, args = parser.parse_args()
+
+    if opt.debug:
+        logging.basicConfig(level=logging.DEBUG, format="%(message)s")
+    else:
+        logging.basicConfig(level=logging.WARNING, format="%(message)s")
+
+    if len(args) < 2:
+        logging.error(usage + '\n' + __doc__)
+        sys.exit(1)
+
+    ip, filenames = args[0], args[1:]
+
+    t_from, t_to = 0, 0xffffffff
+    if opt.dt_from is not None:
+        t_from = int(mktime(parse_datetime(opt.dt_from).timetuple()))
+    if opt.dt_to is not None:
+        t_to = int(mktime(parse_datetime(opt.dt_to).timetuple()))
+
+    if opt.build_index:
+        for filename in segment_names(filenames):
+            if not os.path.exists(index_name(filename)):
+                logging.info('indexing %s...' % filename)
+                build_index(filename)
+
+    records = query(filenames, ip, t_from, t_to, not opt.dst_only,
+            not opt.src_only)
+
+    if opt.users:
+        from replay_rawstat import SessionIntervals
+        records = list(records)
+        if records:
+            sessions = SessionIntervals.load(
+                    datetime.fromtimestamp(min(i[0] for i in records)),
+                    datetime.fromtimestamp(max(i[0] for i in records)))
+            ids = dict((rec, sessions.get(rec[2], rec[0])) for rec in records)
+            users = dict(Session.objects.filter(id__in=set(ids.values())
+                ).values_list('id', 'user__username'))
+        for rec in records:
+            sys.stdout.write(format_record(rec,
+                users.get(ids[rec], '-')) + '\n')
+    else:
+        for rec in records:
+            sys.stdout.write(format_record(rec) + '\n')
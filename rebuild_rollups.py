@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Copyright (c) 2010-2011 Andrew Grigorev <andrew@ei-grad.ru>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Rebuild usage rollups from Records.
+
+Should be run once after upgrade, rollups are filled with the traffic
+accounted before they existed. Traffic of a session is accounted at its
+start, see UsageRollupManager.rebuild().
+"""
+
+import os
+os.environ['DJANGO_SETTINGS_MODULE'] = 'tas.settings'
+
+import logging
+
+from time import time
+from datetime import datetime
+
+from django.db import transaction
+from django.contrib.auth.models import User
+from netstat.models import UsageRollup
+from netstat.usage_cache import bump_versions
+
+
+if __name__ == "__main__":
+
+    from optparse import OptionParser
+
+    usage = 'Usage: %prog [options] [USERNAME...]'
+
+    parser = OptionParser(usage=usage, version='0.1.1')
+
+    parser.add_option('-d', '--debug', action='store_true', dest='debug',
+           help='print debug messages',
+           default=False)
+    parser.add_option('-f', '--from', dest='dt_from', metavar='YYYY-mm',
+            help='rebuild months since this one',
+            default=None)
+    parser.add_option('-t', '--to', dest='dt_to', metavar='YYYY-mm',
+            help='rebuild months until this one',
+            default=None)
+
+    opt, args = parser.parse_args()
+
+    if opt.debug:
+        logging.basicConfig(level=logging.DEBUG, format="%(message)s")
+    else:
+        logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    dt_from = dt_to = None
+    if opt.dt_from is not None:
+        dt_from = datetime.strptime(opt.dt_from, '%Y-%m')
+    if opt.dt_to is not None:
+        dt_to = datetime.strptime(opt.dt_to, '%Y-%m')
+
+    users = None
+    if args:
+        users = list(User.objects.filter(username__in=args
+            ).values_list('id', flat=True))
+
+    t0 = time()
+    with transaction.commit_on_success():
+        count = UsageRollup.objects.rebuild(users, dt_from, dt_to)
+    if users is None:
+        users = User.objects.values_list('id', flat=True)
+    bump_versions(users)
+
+    logging.info('rollups of %d sessions rebuilt in %.1f seconds' % (count,
+        time() - t0))
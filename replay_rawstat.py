@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Copyright (c) 2010-2011 Andrew Grigorev <andrew@ei-grad.ru>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Load raw statistics archives written by conntrack logger into Records.
+
+Each event is accounted to the sessions which were open for its source
+and destination addresses at the event time, like conntrack logger does
+(destination of the original direction is taken as the source of the
+reply direction).
+
+Traffic is added to the existing Records, so a window should be replayed
+once only, or with --replace, which deletes Records of the sessions of
+the window which overlap the time range of the replayed segments first.
+The segments must cover the whole sessions then. Usage rollups of the
+users of replayed sessions are rebuilt from Records afterwards. All of
+it is done in one transaction.
+"""
+
+import os
+os.environ['DJANGO_SETTINGS_MODULE'] = 'tas.settings'
+
+import re
+import sys
+import logging
+
+from time import time, mktime, strptime
+from bisect import bisect_right
+from datetime import datetime
+
+from django.db import reset_queries, transaction
+from netstat.models import Session, Record, UsageRollup
+from netstat.usage_cache import bump_versions
+from netstat.rawstat import read_segment_raw, read_segment, ip2int
+from netstat.prefixes import DstAggregator, load_prefixes
+
+
+class SessionIntervals(object):
+    """
+    Index of sessions by source address and time.
+    """
+
+    def __init__(self, sessions):
+        """
+        Create new SessionIntervals object.
+
+        @param sessions:
+            iterable of (src, session_id, dt_start, dt_finish) tuples
+        """
+
+        intervals = {}
+        for src, session_id, dt_start, dt_finish in sessions:
+            if dt_finish is None:
+                finish = float('inf')
+            else:
+                finish = mktime(dt_finish.timetuple())
+            intervals.setdefault(ip2int(src), []).append(
+                    (mktime(dt_start.timetuple()), finish, session_id))
+
+        self.starts = {}
+        self.intervals = {}
+        for src, items in intervals.items():
+            items.sort()
+            self.starts[src] = [i[0] for i in items]
+            self.intervals[src] = items
+
+    @classmethod
+    def load(cls, dt_from=None, dt_to=None):
+        """
+        Load sessions which intersect [dt_from, dt_to] from database.
+        """
+
+        sessions = Session.objects.all()
+        if dt_from is not None:
+            sessions = sessions.exclude(dt_finish__lt=dt_from)
+        if dt_to is not None:
+            sessions = sessions.filter(dt_start__lte=dt_to)
+        return cls(sessions.values_list('src', 'id', 'dt_start', 'dt_finish'))
+
+    def get(self, src, timestamp):
+        """
+        Get id of session which was open for src at timestamp.
+        """
+
+        starts = self.starts.get(src)
+        if starts is None:
+            return None
+        i = bisect_right(starts, timestamp) - 1
+        if i < 0:
+            return None
+        start, finish, session_id = self.intervals[src][i]
+        if timestamp < finish:
+            return session_id
+        return None
+
+    def overlapping(self, t_from, t_to):
+        """
+        Get ids of sessions which were open within [t_from, t_to).
+        """
+
+        return [session_id for items in self.intervals.values()
+                for start, finish, session_id in items
+                if start < t_to and finish > t_from]
+
+
+# hour of segment in its name, see RawStatWriter
+SEGMENT_HOUR = re.compile(r'\.(\d{10})(\.\d+)?(\.gz)?$')
+
+
+def time_range(filenames):
+    """
+    Get time range (t_from, t_to) of records of segments.
+
+    It is taken from names of segments, segments named otherwise are
+    read.
+    """
+
+    t_from, t_to = float('inf'), float('-inf')
+    for filename in filenames:
+        match = SEGMENT_HOUR.search(filename)
+        if match is not None:
+            start = mktime(strptime(match.group(1), '%Y%m%d%H'))
+            t_from, t_to = min(t_from, start), max(t_to, start + 3600)
+            continue
+        for rec in read_segment(filename):
+            t_from, t_to = min(t_from, rec[0]), max(t_to, rec[0] + 1)
+    return t_from, t_to
+
+
+def replay(filenames, sessions, aggregator=None, max_pairs=1000000,
+        replace=False):
+    """
+    Account records of raw statistics segments.
+
+    @param filenames:
+        segment file names
+    @param sessions:
+        SessionIntervals object
+    @param aggregator:
+        DstAggregator object, exact addresses are used by default
+    @param max_pairs:
+        write accumulated traffic when it has this many (session, dst) pairs
+    @param replace:
+        delete Records of sessions overlapping time range of segments
+        before replaying
+
+    Returns tuple (number of records, number of unhandled records).
+    """
+
+    with transaction.commit_on_success():
+        count, unhandled, users = _replay(filenames, sessions, aggregator,
+                max_pairs, replace)
+    bump_versions(users)
+    return count, unhandled
+
+
+def _replay(filenames, sessions, aggregator, max_pairs, replace):
+
+    if aggregator is None:
+        aggregator = DstAggregator()
+
+    written = set()
+    if replace:
+        written.update(sessions.overlapping(*time_range(filenames)))
+        clear(list(written))
+
+    deltas = {}
+    count = unhandled = 0
+
+    for filename in filenames:
+        t0 = time()
+        logging.info('replaying %s...' % filename)
+
+        for rec in read_segment_raw(filename):
+            timestamp, proto, src, sport, dst, dport, bytes_in, bytes_out = rec
+            count += 1
+            handled = False
+
+            session = sessions.get(src, timestamp)
+            if session is not None:
+                handled = True
+                traf = deltas.get((session, dst))
+                if traf is None:
+                    traf = deltas[session, dst] = [0, 0]
+                traf[0] += bytes_in
+                traf[1] += bytes_out
+
+            session = sessions.get(dst, timestamp)
+            if session is not None:
+                handled = True
+                traf = deltas.get((session, src))
+                if traf is None:
+                    traf = deltas[session, src] = [0, 0]
+                traf[0] += bytes_out
+                traf[1] += bytes_in
+
+            if not handled:
+                unhandled += 1
+
+        if len(deltas) >= max_pairs:
+            written.update(write(deltas, aggregator))
+            deltas = {}
+
+        logging.info('%s replayed in %.1f seconds' % (filename, time() - t0))
+
+    written.update(write(deltas, aggregator))
+    users = rebuild_rollups(list(written))
+
+    return count, unhandled, users
+
+
+def clear(session_ids, chunk=1000):
+    """
+    Delete Records of sessions.
+    """
+
+    for i in range(0, len(session_ids), chunk):
+        Record.objects.filter(session__in=session_ids[i:i + chunk]).delete()
+    logging.info('records of %d sessions deleted' % len(session_ids))
+
+
+def rebuild_rollups(session_ids, chunk=1000):
+    """
+    Rebuild usage rollups of users of sessions for the months of
+    sessions.
+
+    Returns set of ids of users.
+    """
+
+    users = set()
+    dt_from = dt_to = None
+    for i in range(0, len(session_ids), chunk):
+        for user, dt_start in Session.objects.filter(
+                id__in=session_ids[i:i + chunk]).values_list('user', 'dt_start'):
+            users.add(user)
+            dt_from = min(dt_from or dt_start, dt_start)
+            dt_to = max(dt_to or dt_start, dt_start)
+    if users:
+        UsageRollup.objects.rebuild(users, dt_from, dt_to)
+    return users
+
+
+def write(deltas, aggregator):
+    """
+    Add traffic to Records.
+
+    Returns set of session ids.
+    """
+
+    if not deltas:
+        return set()
+    t0 = time()
+    records = {}
+    for (session, dst), traf in deltas.items():
+        key = (session, aggregator.aggregate_int(dst))
+        try:
+            rec = records[key]
+            rec[0] += traf[0]
+            rec[1] += traf[1]
+        except KeyError:
+            records[key] = traf
+    Record.objects.add_traffic(records)
+    reset_queries()
+    logging.info('%d records written in %.1f seconds' % (len(records), time() - t0))
+    return set(session for session, dst in records)
+
+
+if __name__ == "__main__":
+
+    from optparse import OptionParser
+
+    usage = 'Usage: %prog [options] FILE...'
+
+    parser = OptionParser(usage=usage, version='0.1.1')
+
+    parser.add_option('-d', '--debug', action='store_true', dest='debug',
+           help='print debug messages',
+           default=False)
+    parser.add_option('-v', '--verbose', action='store_true', dest='verbose',
+            help='print info messages',
+            default=False)
+    parser.add_option('-f', '--from', dest='dt_from', metavar='YYYY-mm-dd',
+            help='load only sessions finished after this date',
+            default=None)
+    parser.add_option('-t', '--to', dest='dt_to', metavar='YYYY-mm-dd',
+            help='load only sessions started before this date',
+            default=None)
+    parser.add_option('--dst-prefix-len', dest='dst_prefix_len', metavar='BITS',
+            help='account destinations by /BITS networks instead of addresses',
+            default=32)
+    parser.add_option('--dst-prefixes', dest='dst_prefixes', metavar='FILENAME',
+            help='account destinations by labels of prefixes listed in file',
+            default=None)
+    parser.add_option('--replace', action='store_true', dest='replace',
+            help='delete records of sessions of the window overlapping the'
+                ' segments before replaying, requires --from and --to',
+            default=False)
+
+    opt, args = parser.parse_args()
+
+    if opt.debug:
+        logging.basicConfig(level=logging.DEBUG, format="%(message)s")
+    elif opt.verbose:
+        logging.basicConfig(level=logging.INFO, format="%(message)s")
+    else:
+        logging.basicConfig(level=logging.WARNING, format="%(message)s")
+
+    if len(args) == 0:
+        logging.error(usage + '\n' + __doc__)
+        sys.exit(1)
+
+    if opt.replace and (opt.dt_from is None or opt.dt_to is None):
+        logging.error('--replace requires --from and --to')
+        sys.exit(1)
+
+    dt_from = dt_to = None
+    if opt.dt_from is not None:
+        dt_from = datetime.strptime(opt.dt_from, '%Y-%m-%d')
+    if opt.dt_to is not None:
+        dt_to = datetime.strptime(opt.dt_to, '%Y-%m-%d')
+
+    if opt.dst_prefixes is None:
+        prefixes = ()
+    else:
+        prefixes = load_prefixes(opt.dst_prefixes)
+    aggregator = DstAggregator(int(opt.dst_prefix_len), prefixes)
+
+    count, unhandled = replay(args, SessionIntervals.load(dt_from, dt_to),
+            aggregator, replace=opt.replace)
+
+    logging.info('%d records replayed, %d unhandled' % (count, unhandled))
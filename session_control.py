@@ -35,31 +35,152 @@ import traceback
 
 from time import time, sleep
 from datetime import datetime
+from threading import Lock
 
-from django.db import reset_queries, transaction
+from django.conf import settings
+from django.db import reset_queries, transaction, IntegrityError
 from netstat.models import Session, Record
+from netstat.usage_cache import bump_versions
+from netfilter_control import Firewall, FirewallError, FirewallReloader
 
 
+STARTED = 'started'
+ALREADY_STARTED = 'already started'
+TAKEN = 'taken'
+
+# seconds between attempts of a scheduled reload
+RELOAD_INTERVAL = 10
+
+reloader = None
+reloader_lock = Lock()
+
+
+def schedule_reload():
+    """
+    Reload the whole ruleset in background until it succeeds.
+    """
+
+    global reloader
+    with reloader_lock:
+        if reloader is None or not reloader.is_alive():
+            reloader = FirewallReloader(interval=RELOAD_INTERVAL)
+            reloader.start()
+    reloader.request()
+
 def apply_policy(session):
-    raise NotImplemented()
+    """
+    Allow traffic of session on the gateway.
+
+    The whole ruleset is reloaded if session can't be added, e.g. if
+    its ipset doesn't exist yet, and is scheduled to be reloaded if
+    that fails too.
+    """
+
+    logging.debug('apply policy: %s %s' % (session.user_id, session.src))
+    if not settings.FIREWALL:
+        return
+    firewall = Firewall()
+    try:
+        firewall.add_session(session)
+    except FirewallError:
+        logging.warning(traceback.format_exc())
+        try:
+            firewall.load()
+        except FirewallError:
+            logging.error(traceback.format_exc())
+            schedule_reload()
 
 def remove_policy(session):
-    raise NotImplemented()
+    """
+    Deny traffic of session on the gateway.
+
+    Session is finished already, so the ruleset is scheduled to be
+    reloaded if it can't be removed.
+    """
+
+    logging.debug('remove policy: %s %s' % (session.user_id, session.src))
+    if not settings.FIREWALL:
+        return
+    try:
+        Firewall().remove_session(session)
+    except FirewallError:
+        logging.error(traceback.format_exc())
+        schedule_reload()
 
 def start_session(user, src):
-    raise NotImplemented()
+    """
+    Start session of user for address src.
+
+    There may be only one open session per address, which is enforced by
+    a unique index, so concurrent logins from one address are safe and a
+    login takes a single INSERT in the common case.
+
+    Returns tuple (result, session):
+
+        STARTED - new session is started
+        ALREADY_STARTED - user already has the open session for src
+        TAKEN - another user had the open session for src, it is finished
+    """
+
+    while True:
+        with transaction.commit_on_success():
+            sid = transaction.savepoint()
+            try:
+                session = Session(user=user, src=src)
+                session.save()
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+            else:
+                transaction.savepoint_commit(sid)
+                apply_policy(session)
+                return STARTED, session
+
+            try:
+                session = Session.objects.get(src=src, dt_finish=None)
+                break
+            except Session.DoesNotExist:
+                # finished meanwhile, try to start again
+                pass
+
+    if session.user_id == user.id:
+        return ALREADY_STARTED, session
+    finish_session(session)
+    return TAKEN, session
 
 def finish_session(session):
-    raise NotImplemented()
+    """
+    Finish open session.
+
+    Returns False if session was already finished.
+    """
+
+    with transaction.commit_on_success():
+        finished = session.finish()
+    if finished:
+        remove_policy(session)
+    return finished
+
+def finish_user_session(user, src):
+    """
+    Finish open session of user for address src.
+
+    Returns finished session or None if there was no such session.
+    """
+
+    try:
+        session = Session.objects.get(user=user, src=src, dt_finish=None)
+    except Session.DoesNotExist:
+        return None
+    if not finish_session(session):
+        return None
+    return session
 
 def split_sessions():
     now = datetime.now()
     with transaction.commit_on_success():
-        for session in Session.objects.filter(dt_finish=None):
-            session.dt_finish = now
-            session.save()
-            new_session = Session(user=session.user, src=session.src)
-            new_session.save()
+        sessions = Session.objects.split(now)
+    bump_versions(set(user for src, session, user in sessions))
+    logging.debug('%d sessions split' % len(sessions))
 
 if __name__ == "__main__":
 
@@ -117,6 +117,8 @@ INSTALLED_APPS = (
     # Uncomment the next line to enable admin documentation:
     # 'django.contrib.admindocs',
     'netstat',
+    'policy',
+    'billing',
 )
 
 # A sample logging configuration. The only tangible logging
@@ -142,10 +144,52 @@ LOGGING = {
     }
 }
 
+# Conntrack logger invalidates cached usage of users on the index page,
+# so the cache must be shared between processes, e.g. memcached:
+#
+# CACHES = {
+#     'default': {
+#         'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+#         'LOCATION': '127.0.0.1:11211',
+#     }
+# }
+#
+# in local_settings.py. Usage is not cached by default, a per-process
+# cache would show stale usage.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+    }
+}
+
 LOGIN_URL = '/login/'
 LOGIN_REDIRECT_URL = '/'
 
 RESOLV_IP = False
+# DNS server to query PTR records from, system resolver is used if None
+RESOLV_IP_SERVER = None # ('127.0.0.1', 53)
+# timeout of a single query to RESOLV_IP_SERVER
+RESOLV_IP_TIMEOUT = 2.0
+# maximum time to wait for names of all addresses on a page
+RESOLV_IP_RENDER_BUDGET = 0.5
+RESOLV_IP_CACHE_SIZE = 10000
+RESOLV_IP_TTL = 3600
+RESOLV_IP_NEGATIVE_TTL = 300
+RESOLV_IP_THREADS = 4
+
+# manage firewall of the gateway on login and logout
+FIREWALL = False
+# interface of the local network, unauthorized clients are redirected
+# from it to FIREWALL_REDIRECTOR (ip, port)
+FIREWALL_IN_INTERFACE = None # 'eth1'
+FIREWALL_REDIRECTOR = None # ('192.168.0.1', 80)
+IPTABLES_RESTORE = 'iptables-restore'
+IPTABLES_SAVE = 'iptables-save'
+IPSET = 'ipset'
+
+# fractions of full quota, quota_crossed signal is sent when used quota
+# passes them, the ruleset is reloaded when quota is exhausted
+QUOTA_THRESHOLDS = (0.8, 1.0)
 
 from local_settings import *
 
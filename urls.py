@@ -1,6 +1,6 @@
 from django.conf.urls.defaults import *
 
-from tas.billing.views import IndexView, login, logout
+from tas.billing.views import IndexView, login, logout, export, usage_series
 
 # Uncomment the next two lines to enable the admin:
 from django.contrib import admin
@@ -22,6 +22,9 @@ urlpatterns = patterns('',
     (r'^login/$', login,
         { 'template_name': "login.html" }),
     (r'^logout/$', logout),
+
+    (r'^export/$', export),
+    (r'^usage/series/$', usage_series),
 )
 
 from django.contrib.staticfiles.urls import staticfiles_urlpatterns
@@ -1,3 +1,4 @@
+import logging
 from datetime import date
 
 def get_first_day(for_date=None):
@@ -11,11 +12,11 @@ def get_next_month(for_date=None):
         for_date = date.today()
 
     if for_date.month == 12:
-        month = for_date.month + 1
-        year = for_date.year
-    else:
         month = 1
         year = for_date.year + 1
+    else:
+        month = for_date.month + 1
+        year = for_date.year
     return date(year, month, 1)
 
 
@@ -27,48 +28,104 @@ class DnTree:
         
         all_dn --- set of dn to initially add to a tree
         """
-        self.childs = {}
-        self.parent = {}
+        self.childs = {"": set()} # used by get_roots()
+        self.parent = {"": ""}
         self.fake_parent = {} # distinguished name of a node
                               # that should be a parent
                               # but not exists in a current tree
+                              # -> set of its childs
         
         self.dn_set = set() # all nodes in a tree
-        
-        self.parent[""] = ""
-        self.childs[""] = [] # used by get_roots()
-        
+
+        self.load(all_dn)
+
+    @classmethod
+    def from_iterable(cls, all_dn):
+        """Create tree from iterable of distinguished names.
+
+        all_dn --- iterable of dn, they should be unique
+        """
+        return cls(all_dn)
+
+    def load(self, all_dn):
+        """Add nodes to an empty tree in one pass, parents of all nodes
+        are known beforehand so nothing has to be relinked.
+
+        all_dn --- iterable of dn, they should be unique
+        """
+        if self.dn_set:
+            for dn in all_dn:
+                self.add(dn)
+            return
+
+        count = 0
         for dn in all_dn:
-            self.add(dn)
+            self.dn_set.add(dn)
+            count += 1
+        if count != len(self.dn_set):
+            raise ValueError('Distinguished names are not unique!')
+
+        for dn in self.dn_set:
+            fake_parent = self.get_fake_parent_dn(dn)
+            if fake_parent in self.dn_set:
+                parent_dn = fake_parent
+            else:
+                parent_dn = ""
+                if fake_parent != "":
+                    self._link(self.fake_parent, fake_parent, dn)
+            self.parent[dn] = parent_dn
+            self._link(self.childs, parent_dn, dn)
+
+    def _link(self, nodes, parent_dn, dn):
+        try:
+            nodes[parent_dn].add(dn)
+        except KeyError:
+            nodes[parent_dn] = set([dn])
             
     def __str__(self):
         """Draw tree in ASCII graphics."""
-        
-        def print_node(dn, prefix=""):
+
+        lines = []
+        stack = [(dn, "") for dn in sorted(self.get_roots(), reverse=True)]
+        while stack:
+            dn, prefix = stack.pop()
             if self.parent[dn] == "":
-                ret1 = "%s-%s\n" % ( prefix, dn)
+                lines.append("%s-%s\n" % (prefix, dn))
             else:
-                ret1 = "%s-%s\n" % ( prefix, self.get_rdn(dn))
-            for i in self.get_childs(dn):
-                ret1 += print_node(i, prefix+" |")
-            return ret1
-            
-        ret = ""
-        for i in self.get_roots():
-            ret += print_node(i)
-        return ret
+                lines.append("%s-%s\n" % (prefix, self.get_rdn(dn)))
+            stack.extend((i, prefix + " |")
+                    for i in sorted(self.get_childs(dn), reverse=True))
+        return "".join(lines)
     
     def get_roots(self):
-        """Get list root nodes without parent."""
-        try:
-            return self.childs[""]
-        except KeyError:
-            return []
+        """Get set of root nodes without parent."""
+        return self.childs[""]
             
     def get_childs(self, dn):
-        if dn in self.childs.keys():
-            return self.childs[dn]
-        return []
+        """Get set of child nodes."""
+        return self.childs.get(dn, ())
+
+    def iter_subtree(self, dn):
+        """Iterate over node and all its descendants, parents go before
+        their childs.
+        
+        dn --- distinguished name of node
+        """
+        stack = [dn]
+        while stack:
+            dn = stack.pop()
+            yield dn
+            stack.extend(self.get_childs(dn))
+
+    def iter_ancestors(self, dn):
+        """Iterate over ancestors of node from its parent to root.
+        
+        dn --- distinguished name of node
+        """
+        dn = self.parent[dn]
+        while dn != "":
+            yield dn
+            dn = self.parent[dn]
         
     def get_parent_dn(self, dn):
         """Returns distinguished name of parent node (if it belongs to tree,
@@ -117,36 +174,22 @@ class DnTree:
         if dn in self.dn_set:
             raise ValueError('A record with dn=%s already exists!' % dn)
             
-        if DEBUG:
-            print 'tree add %s' % dn
+        logging.debug('tree add %s' % dn)
         
         parent_dn = self.get_parent_dn(dn)
         fake_parent = self.get_fake_parent_dn(dn)
 
         if parent_dn != fake_parent:
-            try:
-                self.fake_parent[fake_parent].append(dn)
-            except KeyError:
-                self.fake_parent[fake_parent] = [dn]
+            self._link(self.fake_parent, fake_parent, dn)
                 
         self.parent[dn] = parent_dn
-        try:
-            self.childs[parent_dn].append(dn)
-        except KeyError:
-            self.childs[parent_dn] = [dn]
+        self._link(self.childs, parent_dn, dn)
             
-        try:
-            for i in self.fake_parent.pop(dn):
-                if DEBUG:
-                    print 'dntree: add: removing %s from childs[""]' % i
-                self.childs[""].remove(i)
-                self.parent[i] = dn
-                try:
-                    self.childs[dn].append(i)
-                except KeyError:
-                    self.childs[dn] = [i]
-        except KeyError:
-            pass
+        for i in self.fake_parent.pop(dn, ()):
+            logging.debug('dntree: add: removing %s from childs[""]' % i)
+            self.childs[""].remove(i)
+            self.parent[i] = dn
+            self._link(self.childs, dn, i)
         
         self.dn_set.add(dn)
         
@@ -164,7 +207,7 @@ class DnTree:
         self.add(new_dn)
         
     def remove(self, dn):
-        """Remove node from tree.
+        """Remove node with its subtree from tree.
         
         dn --- distinguished name of node.
         """
@@ -172,20 +215,15 @@ class DnTree:
         if dn not in self.dn_set:
             raise ValueError('A record with dn=%s doesn\'t exists!' % dn)
         
-        parent = self.get_parent_dn(dn)
-        fake_parent = self.get_fake_parent_dn(dn)
-        
-        if parent != fake_parent:
-            self.fake_parent[fake_parent].remove(dn)
-        
-        self.childs[parent].remove(dn)
-        
-        if dn in self.childs.keys():
-            childs = tuple(self.childs[dn])
-            for i in childs:
-                self.remove(i)
-            self.childs.pop(dn)
-            
-        self.parent.pop(dn)
-        self.dn_set.remove(dn)
+        self.childs[self.parent[dn]].remove(dn)
 
+        for i in list(self.iter_subtree(dn)):
+            fake_parent = self.get_fake_parent_dn(i)
+            if self.parent[i] != fake_parent:
+                childs = self.fake_parent[fake_parent]
+                childs.remove(i)
+                if not childs:
+                    del self.fake_parent[fake_parent]
+            self.childs.pop(i, None)
+            self.parent.pop(i)
+            self.dn_set.remove(i)